@@ -0,0 +1,222 @@
+"""
+AccuracySweep.py: Parallel, resumable accuracy sweeps for PlotCardinalityAccuracy.py and PlotSimilarityAccuracy.py
+
+A sweep estimates a measure (cardinality, intersection, jaccard, forbes or sd) for num_cards cardinalities
+spaced logarithmically between 10^base_start and 10^base_stop, num_trials times each. Every (cardinality, trial)
+cell is independent: its random sets are drawn from a numpy Generator seeded with (seed, cell index), so a cell
+gives the same result whichever process runs it and in whatever order.
+
+Instead of generating random read strings and hashing them one by one, each set is drawn as read codes with
+the Random_Generators generate_codes() functions and inserted with HLL.insert_codes(). The number of shared
+reads follows the generator's formula for the target value, and the percent error is measured against the
+exact value of the generated sets.
+
+Results go to an output directory:
+    params.json     the sweep parameters, a resumed sweep must use the same ones
+    cells.csv       one row per finished cell, appended as cells finish; a rerun skips the cells already in it
+    summary.csv     cardinality, mean and standard deviation of the percent error over the trials
+    summary.npz     cardinalities, the (num_cards, num_trials) percent errors, and their means
+    plot.png        the mean percent errors, with --png (rendered without a display)
+"""
+import csv
+import json
+import math
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import Similarity
+from HLL import HLL
+from Random_Generators import Rangen_jaccard, Rangen_forbes, Rangen_sorensen_dice
+
+MEASURES = ('cardinality', 'intersection', 'jaccard', 'forbes', 'sd')
+CELL_FIELDS = ['index', 'cardinality', 'trial', 'observed', 'expected', 'error']
+
+# generator of the two sets of each measure
+GENERATORS = {
+    'intersection': Rangen_jaccard,
+    'jaccard': Rangen_jaccard,
+    'forbes': Rangen_forbes,
+    'sd': Rangen_sorensen_dice,
+}
+READ_LENGTH = 40
+
+"""
+AccuracySweep.exact_value():
+Exact value of a measure for two sets of card elements with overlap shared elements
+"""
+def exact_value(measure, card, overlap):
+    union = 2 * card - overlap
+    if measure == 'intersection':
+        return overlap
+    if measure == 'jaccard':
+        return overlap / union
+    if measure == 'sd':
+        return overlap / card
+    excl = card - overlap
+    return (overlap * union) / (overlap * union + 1.5 * excl * excl)
+
+"""
+AccuracySweep.run_cell():
+Estimates a measure for one (cardinality, trial) cell, see the module docstring
+
+Input: measure, target, p, seed, as in run_sweep(); index, the cell index; card, the set size; trial, the trial number
+Output: a dict with the CELL_FIELDS of the cell
+"""
+def run_cell(measure, target, p, seed, index, card, trial):
+    rng = np.random.default_rng((seed, index))
+    if measure == 'cardinality':
+        h = HLL(p)
+        h.insert_codes(Rangen_jaccard.generate_random_codes(card, READ_LENGTH, rng))
+        observed, expected = h.cardinality(), card
+    else:
+        generator = GENERATORS[measure]
+        a, b = generator.generate_codes(target, card, card, READ_LENGTH, rng)[:2]
+        if a is None:
+            raise ValueError('{} = {} is not reachable with sets of {} elements'.format(measure, target, card))
+        h1 = HLL(p)
+        h2 = HLL(p)
+        h1.insert_codes(a)
+        h2.insert_codes(b)
+        expected = exact_value(measure, card, generator.overlapped_reads(target, card, card))
+
+        a_excl, b_excl, intersection = Similarity.getJointEstimators(h1, h2)
+        if measure == 'intersection':
+            observed = intersection
+        elif measure == 'jaccard':
+            observed = intersection / Similarity.union(h1, h2).cardinality()
+        elif measure == 'sd':
+            observed = 2 * intersection / (h1.cardinality() + h2.cardinality())
+        else:
+            union = Similarity.union(h1, h2).cardinality()
+            observed = (intersection * union) / ((intersection * union) + 3 / 2 * (a_excl * b_excl))
+
+    error = 100 * (observed - expected) / expected if expected else math.nan
+    return {'index': index, 'cardinality': card, 'trial': trial,
+            'observed': float(observed), 'expected': float(expected), 'error': float(error)}
+
+"""
+AccuracySweep.read_cells():
+Reads the finished cells of a sweep
+
+Input: path, a cells.csv file
+Output: a dict from cell index to the cell's row
+"""
+def read_cells(path):
+    cells = {}
+    if os.path.exists(path):
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                # a row cut short by an interruption has empty trailing fields and is run again
+                if row.get('error') not in (None, ''):
+                    cells[int(row['index'])] = row
+    return cells
+
+"""
+AccuracySweep.truncate_partial_row():
+Drops a last row left without its newline by an interrupted write, so rows appended after it stay separate
+"""
+def truncate_partial_row(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+    return
+
+"""
+AccuracySweep.run_sweep():
+Runs every cell of a sweep that is not already in the output directory, on a process pool
+
+Input: out, the output directory; measure, one of MEASURES; num_cards, base_start, base_stop, num_trials, as in
+       PlotCardinalityAccuracy.main(); target, the expected value of the measure (ignored for cardinality)
+       p, the HLL precision; seed, the base seed of the cells; workers, the number of processes
+       png, whether to render plot.png; title, the plot title
+Output: cardinalities, an array of num_cards set sizes; errors, a (num_cards, num_trials) array of percent errors
+"""
+def run_sweep(out, measure, num_cards, base_start, base_stop, num_trials, target=None, p=12, seed=0, workers=1,
+              png=False, title=None):
+    if measure not in MEASURES:
+        raise ValueError('Unknown measure {}, expected one of {}'.format(measure, ', '.join(MEASURES)))
+    os.makedirs(out, exist_ok=True)
+    params = {'measure': measure, 'num_cards': num_cards, 'base_start': base_start, 'base_stop': base_stop,
+              'num_trials': num_trials, 'target': target, 'p': p, 'seed': seed}
+    params_path = os.path.join(out, 'params.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            previous = json.load(f)
+        if previous != params:
+            raise ValueError('{} holds a sweep with different parameters: {}'.format(out, previous))
+    else:
+        with open(params_path, 'w') as f:
+            json.dump(params, f, indent=1)
+
+    cardinalities = np.logspace(base_start, base_stop, num_cards).astype(np.int64)
+    cells_path = os.path.join(out, 'cells.csv')
+    done = read_cells(cells_path)
+    todo = [(i * num_trials + j, int(cardinalities[i]), j) for i in range(num_cards) for j in range(num_trials)
+            if i * num_trials + j not in done]
+    print('{} of {} cells already done, running {}'.format(len(done), num_cards * num_trials, len(todo)))
+
+    truncate_partial_row(cells_path)
+    new_file = not os.path.exists(cells_path) or os.path.getsize(cells_path) == 0
+    with open(cells_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CELL_FIELDS)
+        if new_file:
+            writer.writeheader()
+        # cells are written and flushed as soon as they finish, so an interrupted sweep loses at most the running cells
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(run_cell, measure, target, p, seed, *cell) for cell in todo]
+                for future in as_completed(futures):
+                    writer.writerow(future.result())
+                    f.flush()
+        else:
+            for cell in todo:
+                writer.writerow(run_cell(measure, target, p, seed, *cell))
+                f.flush()
+
+    errors = np.full((num_cards, num_trials), np.nan)
+    for index, row in read_cells(cells_path).items():
+        if index < num_cards * num_trials:
+            errors[index // num_trials, index % num_trials] = float(row['error'])
+    write_summary(out, cardinalities, errors)
+    if png:
+        render_plot(os.path.join(out, 'plot.png'), cardinalities, errors.mean(axis=1),
+                    title or '{} accuracy'.format(measure.capitalize()), num_trials)
+    return cardinalities, errors
+
+"""
+AccuracySweep.write_summary():
+Writes summary.csv and summary.npz for a sweep
+"""
+def write_summary(out, cardinalities, errors):
+    mean = errors.mean(axis=1)
+    std = errors.std(axis=1)
+    np.savez(os.path.join(out, 'summary.npz'), cardinalities=cardinalities, errors=errors, mean=mean)
+    with open(os.path.join(out, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['cardinality', 'mean_error', 'std_error'])
+        for row in zip(cardinalities, mean, std):
+            writer.writerow(row)
+    return
+
+"""
+AccuracySweep.render_plot():
+Saves a scatter plot of mean percent errors against cardinality, in the style of the Plot*Accuracy scripts,
+without needing a display
+"""
+def render_plot(path, cardinalities, mean_errors, title, num_trials):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.figure()
+    plt.xscale('log')
+    plt.title(title)
+    plt.xlabel('Cardinality')
+    plt.ylabel('% Error (mean of {})'.format(num_trials))
+    plt.ylim(-100, 100)
+    plt.scatter(cardinalities, mean_errors)
+    plt.savefig(path)
+    plt.close()
+    return
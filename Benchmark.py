@@ -0,0 +1,310 @@
+"""
+Benchmark.py: Performance benchmarks for the HLL insert, estimate and compare paths
+
+Usage: python Benchmark.py [--output results.json] [--data Data/0.5x] [--repeat 5] [--seed 0] [--quick]
+                           [--baseline old.json]
+
+Every benchmark is run --repeat times on inputs generated from --seed, and the minimum and median times are
+recorded. Results are written as JSON together with the environment (Python, numpy and scipy versions,
+platform, CPU count, git commit), so runs from different releases can be compared for regressions.
+With --baseline, the minimum time of every benchmark is also printed relative to an earlier results file.
+
+Benchmarks:
+    hll_insert              HLL.insert() throughput in k-mers/s
+    hll_insert_many         HLL.insert_many() throughput in k-mers/s
+    estimate_cardinality    Cardinality.estimateCardinality() latency per sketch
+    union                   Similarity.union() latency per pair
+    joint_estimators        Similarity.getJointEstimators() latency per pair, for each solver
+    get_sketches            Sketching.get_sketches() throughput in MB/s of input files
+    calculate_rankings      GNome.calculate_rankings() time for n sketches, for several n
+    sketch_index            SketchIndex build time over n references, and latency of its queries against
+                            Query.ReferenceIndex.query() over every reference
+    kendall_tau             GenomeRankings.kendall_tau_rows() time per row of n rankings, for several n, and
+                            its speedup over calling scipy.stats.kendalltau() on each row
+    codec                   SketchCodec encode and decode throughput in GB/s of registers and compressed size
+                            ratio of p = 14 sketches, plain, entropy coded and with zlib
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy
+from scipy.stats import kendalltau
+import Cardinality
+import GNome
+import GenomeRankings
+import Query
+import Similarity
+import SketchCodec
+import SketchIndex
+import Sketching
+from HLL import HLL
+
+"""
+Benchmark.timed():
+Runs a function repeat times
+
+Input: function, called without arguments; repeat, the number of runs
+Output: a dict with the minimum and median time in seconds
+"""
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        # GNome prints progress, which is not part of the measurement
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        times.append(time.perf_counter() - start)
+    return {'min_s': min(times), 'median_s': statistics.median(times), 'repeat': repeat}
+
+"""
+Benchmark.random_sketches():
+HLLs of random k-mer codes, with cardinalities spread log-uniformly between 10^2 and 10^max_exponent
+
+Input: rng, a numpy Generator; n, the number of sketches; p, the precision
+Output: a list of n HLLs
+"""
+def random_sketches(rng, n, p=12, max_exponent=5):
+    sketches = []
+    for cardinality in np.power(10, rng.uniform(2, max_exponent, n)).astype(np.int64):
+        hll = HLL(p)
+        hll.insert_codes(rng.integers(0, 2**62, cardinality, dtype=np.uint64))
+        sketches.append(hll)
+    return sketches
+
+"""
+Benchmark.clade_sketches():
+HLLs of related genomes: each keeps a random 80-100% of a shared core of k-mer codes and adds codes of its own
+
+Input: rng, a numpy Generator; n, the number of sketches; p, the precision; core, the size of the shared core
+Output: a list of n HLLs
+"""
+def clade_sketches(rng, n, p=14, core=100000):
+    codes = rng.integers(0, 2**62, core, dtype=np.uint64)
+    sketches = []
+    for _ in range(n):
+        hll = HLL(p)
+        hll.insert_codes(codes[rng.random(core) < rng.uniform(0.8, 1)])
+        hll.insert_codes(rng.integers(0, 2**62, int(rng.integers(1000, 20000)), dtype=np.uint64))
+        sketches.append(hll)
+    return sketches
+
+def bench_hll_insert(rng, repeat, quick):
+    reads = [''.join(rng.choice(list('ACGT'), 25)) for _ in range(2000 if quick else 20000)]
+    def run():
+        hll = HLL(12)
+        for read in reads:
+            hll.insert(read)
+    result = timed(run, repeat)
+    result['kmers'] = len(reads)
+    result['kmers_per_s'] = len(reads) / result['min_s']
+    return result
+
+def bench_hll_insert_many(rng, repeat, quick):
+    reads = [''.join(rng.choice(list('ACGT'), 150)) for _ in range(1000 if quick else 10000)]
+    k = 25
+    result = timed(lambda: HLL(12).insert_many(reads, k), repeat)
+    result['kmers'] = len(reads) * (150 - k + 1)
+    result['kmers_per_s'] = result['kmers'] / result['min_s']
+    return result
+
+def bench_estimate_cardinality(rng, repeat, quick):
+    counts = [Cardinality.getMultiplicity(h) for h in random_sketches(rng, 20 if quick else 100)]
+    result = timed(lambda: [Cardinality.estimateCardinality(C) for C in counts], repeat)
+    result['sketches'] = len(counts)
+    result['latency_s'] = result['min_s'] / len(counts)
+    return result
+
+def bench_union(rng, repeat, quick):
+    sketches = random_sketches(rng, 20 if quick else 100)
+    pairs = list(zip(sketches[::2], sketches[1::2]))
+    result = timed(lambda: [Similarity.union(a, b) for a, b in pairs], repeat)
+    result['pairs'] = len(pairs)
+    result['latency_s'] = result['min_s'] / len(pairs)
+    return result
+
+def bench_joint_estimators(rng, repeat, quick):
+    sketches = random_sketches(rng, 10 if quick else 40)
+    pairs = list(zip(sketches[::2], sketches[1::2]))
+    results = {}
+    for solver in ('lbfgs', 'newton'):
+        result = timed(lambda: [Similarity.getJointEstimators(a, b, solver=solver) for a, b in pairs], repeat)
+        result['pairs'] = len(pairs)
+        result['latency_s'] = result['min_s'] / len(pairs)
+        results[solver] = result
+    return results
+
+def bench_get_sketches(data, repeat):
+    if not os.path.isdir(data):
+        return {'skipped': 'no data folder {}'.format(data)}
+    megabytes = sum(os.path.getsize(os.path.join(data, f)) for f in os.listdir(data)) / 1e6
+    result = timed(lambda: Sketching.get_sketches(data), repeat)
+    result['megabytes'] = megabytes
+    result['megabytes_per_s'] = megabytes / result['min_s']
+    return result
+
+def bench_codec(rng, repeat, quick):
+    n = 256 if quick else 4096
+    collections = {'random': random_sketches(rng, n, p=14), 'clade': clade_sketches(rng, n)}
+    results = {}
+    for collection, sketches in collections.items():
+        names = ['sketch_{}'.format(i) for i in range(n)]
+        raw_bytes = n * 2 ** 14
+        for variant, entropy, zlib_level in (('plain', False, 0), ('entropy', True, 0), ('zlib', False, 6)):
+            def encode():
+                f = io.BytesIO()
+                with SketchCodec.SketchWriter(f, 14, sketches[0].hash_name, entropy=entropy,
+                                              zlib_level=zlib_level) as writer:
+                    for name, hll in zip(names, sketches):
+                        writer.write(name, hll)
+                return f.getvalue()
+            stream = encode()
+            result = {'encode': timed(encode, repeat),
+                      'decode': timed(lambda: SketchCodec.SketchReader(io.BytesIO(stream)).read_registers(), repeat)}
+            result['encode']['gigabytes_per_s'] = raw_bytes / result['encode']['min_s'] / 1e9
+            result['decode']['gigabytes_per_s'] = raw_bytes / result['decode']['min_s'] / 1e9
+            result['sketches'] = n
+            result['size_ratio'] = len(stream) / raw_bytes
+            results['{}_{}'.format(collection, variant)] = result
+    return results
+
+def bench_calculate_rankings(rng, repeat, quick):
+    sizes = (10, 20, 40) if quick else (10, 25, 50, 100, 200)
+    sketches = random_sketches(rng, max(sizes), max_exponent=4)
+    results = {}
+    for n in sizes:
+        result = timed(lambda: GNome.calculate_rankings(sketches[:n]), repeat)
+        result['pairs'] = n * (n + 1) // 2
+        result['pairs_per_s'] = result['pairs'] / result['min_s']
+        results[str(n)] = result
+    return results
+
+def bench_sketch_index(rng, repeat, quick):
+    n = 1000 if quick else 10000
+    # unrelated references, and a clade whose other members are the queries
+    clade = clade_sketches(rng, 50, p=12)
+    sketches = random_sketches(rng, n - 40) + clade[:40]
+    queries = clade[40:]
+    references = Query.ReferenceIndex.from_sketches(sketches, ['sketch_{}'.format(i) for i in range(n)])
+    result = {'references': n, 'queries': len(queries), 'build': timed(lambda: SketchIndex.SketchIndex(references), repeat)}
+    index = SketchIndex.SketchIndex(references)
+    result['candidates'] = timed(lambda: [index.candidates(hll) for hll in queries], repeat)
+    result['query'] = timed(lambda: [index.query(hll) for hll in queries], repeat)
+    result['full_query'] = timed(lambda: [references.query(hll) for hll in queries], repeat)
+    for name in ('candidates', 'query', 'full_query'):
+        result[name]['latency_s'] = result[name]['min_s'] / len(queries)
+    result['mean_candidates'] = float(np.mean([len(index.candidates(hll)) for hll in queries]))
+    # fraction of the top 10 over every reference that the index also returns
+    found = [len({name for name, _ in index.query(hll)[0]} & {name for name, _ in references.query(hll)[0]})
+             for hll in queries]
+    result['recall_at_10'] = sum(found) / (10 * len(queries))
+    return result
+
+def bench_kendall_tau(rng, repeat, quick):
+    sizes = (300,) if quick else (1000, 3000)
+    results = {}
+    for n in sizes:
+        # rankings of random similarities have few ties, as for real genomes; rows are a sample of the n x n matrix
+        rows = min(n, 100 if quick else 300)
+        a = GenomeRankings.rank_genomes(np.triu(rng.random((n, n))))[:rows]
+        b = GenomeRankings.rank_genomes(np.triu(rng.random((n, n))))[:rows]
+        result = timed(lambda: GenomeRankings.kendall_tau_rows(a, b), repeat)
+        scipy_loop = timed(lambda: [kendalltau(x, y) for x, y in zip(a, b)], repeat)
+        result['rows'] = rows
+        result['latency_s'] = result['min_s'] / rows
+        result['scipy_latency_s'] = scipy_loop['min_s'] / rows
+        result['speedup'] = scipy_loop['min_s'] / result['min_s']
+        results[str(n)] = result
+    return results
+
+"""
+Benchmark.environment():
+Metadata of the machine and software the benchmarks ran on
+"""
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version,
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'git_commit': commit,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Performance benchmarks for HLL sketching and comparison')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write (default benchmark.json)')
+    parser.add_argument('--data', default=os.path.join('Data', '0.5x'), help='folder of reads for get_sketches')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark (default 5)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated inputs (default 0)')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs, for a fast smoke run')
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run (default all)')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    benchmarks = {
+        'hll_insert': lambda rng: bench_hll_insert(rng, args.repeat, args.quick),
+        'hll_insert_many': lambda rng: bench_hll_insert_many(rng, args.repeat, args.quick),
+        'estimate_cardinality': lambda rng: bench_estimate_cardinality(rng, args.repeat, args.quick),
+        'union': lambda rng: bench_union(rng, args.repeat, args.quick),
+        'joint_estimators': lambda rng: bench_joint_estimators(rng, args.repeat, args.quick),
+        'get_sketches': lambda rng: bench_get_sketches(args.data, 1 if args.quick else args.repeat),
+        'calculate_rankings': lambda rng: bench_calculate_rankings(rng, args.repeat, args.quick),
+        'sketch_index': lambda rng: bench_sketch_index(rng, args.repeat, args.quick),
+        'kendall_tau': lambda rng: bench_kendall_tau(rng, args.repeat, args.quick),
+        'codec': lambda rng: bench_codec(rng, args.repeat, args.quick),
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        # every benchmark gets its own generator, so its inputs do not depend on which others ran
+        results[name] = benchmark(np.random.default_rng(args.seed))
+        print('{}: {}'.format(name, json.dumps(results[name])))
+
+    report = {'environment': environment(), 'parameters': vars(args), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote {}'.format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        for name, ratio in compare(baseline, results):
+            print('{}: {:.2f}x the baseline time'.format(name, ratio))
+
+"""
+Benchmark.compare():
+Ratios of the minimum times of two sets of results, for every benchmark (and sub-benchmark) in both
+
+Input: baseline, results, the 'results' of two results files
+Output: a list of (name, new time / baseline time) pairs
+"""
+def compare(baseline, results, prefix=''):
+    ratios = []
+    for name, result in results.items():
+        if name not in baseline or not isinstance(result, dict):
+            continue
+        if 'min_s' in result and 'min_s' in baseline[name]:
+            ratios.append((prefix + name, result['min_s'] / baseline[name]['min_s']))
+        else:
+            ratios += compare(baseline[name], result, prefix + name + '.')
+    return ratios
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,47 @@ Ertl, O. (2017). New cardinality estimation algorithms for HyperLogLog sketches.
 """
 import numpy as np
 import math
+from functools import lru_cache
+
+# register values are at most q+1 <= 64 for 64-bit hashes
+MAX_RANK = 64
+
+"""
+Cardinality.power_table():
+Cached table of 2^-k for k = 0..n-1, shared by every caller (read-only)
+
+Input: n, the number of entries
+Output: a numpy float64 array
+"""
+@lru_cache(maxsize=None)
+def power_table(n=MAX_RANK + 1):
+    table = np.ldexp(1.0, -np.arange(n))
+    table.setflags(write=False)
+    return table
+
+"""
+Cardinality.scale_table():
+Cached table of 1/(m*2^k) for k = 0..q, the factor turning a cardinality into the x of Equation 73 (read-only)
+
+Input: q, m
+Output: a numpy float64 array of q+1 values
+"""
+@lru_cache(maxsize=None)
+def scale_table(q, m):
+    table = power_table(q + 1) / m
+    table.setflags(write=False)
+    return table
+
+"""
+Cardinality.alpha():
+Bias correction factor of the harmonic mean estimator for m registers
+
+Input: m, the number of registers
+Output: a float
+"""
+@lru_cache(maxsize=None)
+def alpha(m):
+    return 0.7213/(1+1.079/m)
 
 """
 Cardinality.getMultiplicity():
@@ -14,21 +55,15 @@ Get count vector from HLL registers. This is a helper method for the maximum lik
 Comes from Algorithm 4 in Ertl paper
 
 Input: hll, a HLL object
-Output: C, a list of integers, where C[i] represents the count of i in hll's registers.
+Output: C, a numpy array of q+2 integers, where C[i] represents the count of i in hll's registers.
 """
 def getMultiplicity(hll):
-    registers = hll.getRegisters()
-    m = len(registers)
+    # a sparse HLL only stores its nonzero registers, the rest are counted in C[0]
+    _, ranks = hll.nonzero_registers()
 
-    one_position = hll.q
-    C = []
-    # Fills C with times K[i] appears in K
-    for q in range(0, one_position + 1):
-        C.append(0)
-
-    # K[i] is a value in the range [1, q+1]
-    for i in range(1,m):
-        C[registers[i]] += 1
+    # K[i] is a value in the range [0, q+1]
+    C = np.bincount(ranks, minlength=hll.q + 2)
+    C[0] += hll.m - len(ranks)
     return C
 
 """
@@ -36,10 +71,13 @@ Cardinality.estimateCardinality():
 Calculate maximum likelihood estimator for cardinality of HLL
 Comes from Algorithm 8 in Ertl paper
 
-Input: counts, a count vector from Cardinality.getMultiplicity()
+Input: counts, a count vector (list or numpy array) from Cardinality.getMultiplicity()
+       tolerance, the iteration stops once the relative change in the estimate is below tolerance/sqrt(m)
+       max_iterations, an upper bound on the number of secant iterations
 Output: a float representing the cardinality estimate for counts
 """
-def estimateCardinality(counts):
+def estimateCardinality(counts, tolerance=1e-2, max_iterations=100):
+    counts = [float(c) for c in counts]
     numCounts = len(counts) - 1
     q = numCounts - 1
 
@@ -55,43 +93,39 @@ def estimateCardinality(counts):
     k_max = numCounts - k_max
     k_prime_max = min(k_max, q)
 
+    # z = sum of C[k] * 2^-k over [k'_min, k'_max]
     z = 0
     for k in range(k_prime_max, k_prime_min-1, -1):
         z = 0.5 * (z) + counts[k]
-    z = z * 2 ** (-1 * k_prime_min)
+    z = math.ldexp(z, -k_prime_min)
 
     c = counts[q+1]
     if q >= 1:
         c = c + counts[k_prime_max]
-    g_prev = 0
     a = z + counts[0]
-    b = z + counts[q+1] * (2 ** (-1 * q))
+    b = z + math.ldexp(counts[q+1], -q)
     m_prime = m - counts[0]
     if b <= (1.5 * a):
         x = m_prime / (0.5 * b + a)  # weak lower bound
     else:
-        x = (m_prime / (b)) * np.log(1 + b/a)  # strong lower bound
+        x = (m_prime / (b)) * math.log1p(b/a)  # strong lower bound
 
     delta_x = x
-    delta = (10 ** -2) / np.sqrt(m)
+    delta = tolerance / math.sqrt(m)
     g_prev = 0
-    while delta_x > x * delta: # maximum likelihood by Taylor approximation
-        ka = math.floor(np.log2(x))
-        x_prime = x * (2 ** (-1*max(k_prime_max+1, ka+1)))
+    iterations = 0
+    while delta_x > x * delta and iterations < max_iterations: # maximum likelihood by secant method
+        ka = math.floor(math.log2(x))
+        x_prime = math.ldexp(x, -max(k_prime_max+1, ka+1))
         x_dprime = x_prime * x_prime
         #taylor approximation
         h = x_prime - x_dprime / 3 + (x_dprime * x_dprime) * (1/45 - x_dprime/472.5)
         for k in range(ka-1, k_prime_max-1, -1):
-            print(x / (2 ** (k + 2)))
-            top = x_prime + h*(1-h)
-            bottom = x_prime + (1-h)
-            h = top/bottom
+            h = (x_prime + h*(1-h)) / (x_prime + (1-h))
             x_prime = 2 * x_prime
         g = c * h
         for k in range(k_prime_max - 1, k_prime_min-1, -1):
-            top = x_prime + h * (1-h)
-            bottom = x_prime + (1-h)
-            h = top/bottom
+            h = (x_prime + h*(1-h)) / (x_prime + (1-h))
             g = g + counts[k] * h
             x_prime = 2 * x_prime
         g = g + x * a
@@ -101,26 +135,111 @@ def estimateCardinality(counts):
             delta_x = 0
         x = x + delta_x
         g_prev = g
+        iterations += 1
     return m * x
 
+"""
+Cardinality.estimateCardinalities():
+Batched form of estimateCardinality(), runs Algorithm 8 on many count vectors at once
+Every row iterates in lockstep, rows that have converged are left unchanged
+
+Input: counts, an (N, q+2) array of count vectors
+       tolerance, max_iterations, as in estimateCardinality()
+Output: a numpy array of N cardinality estimates
+"""
+def estimateCardinalities(counts, tolerance=1e-2, max_iterations=100):
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    N, numCounts = counts.shape[0], counts.shape[1] - 1
+    q = numCounts - 1
+    rows = np.arange(N)
+    ks = np.arange(numCounts + 1)
+
+    m = counts.sum(axis=1)
+    saturated = counts[:, numCounts] == m
+
+    # min and max K with a nonzero count
+    nonzero = counts != 0
+    k_min = np.argmax(nonzero, axis=1)
+    k_max = numCounts - np.argmax(nonzero[:, ::-1], axis=1)
+    k_prime_min = np.maximum(k_min, 1)
+    k_prime_max = np.minimum(k_max, q)
+
+    in_range = (ks >= k_prime_min[:, None]) & (ks <= k_prime_max[:, None])
+    z = np.sum(np.where(in_range, counts * power_table(numCounts + 1), 0), axis=1)
+
+    c = counts[:, q+1]
+    if q >= 1:
+        c = c + counts[rows, k_prime_max]
+    a = z + counts[:, 0]
+    b = z + np.ldexp(counts[:, q+1], -q)
+    m_prime = m - counts[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(b <= 1.5 * a,
+                     m_prime / (0.5 * b + a),  # weak lower bound
+                     (m_prime / b) * np.log1p(b / a))  # strong lower bound
+    x[saturated] = 0
+
+    delta_x = x.copy()
+    delta = tolerance / np.sqrt(m)
+    g_prev = np.zeros(N)
+    for _ in range(max_iterations): # maximum likelihood by secant method
+        active = delta_x > x * delta
+        if not active.any():
+            break
+        x_safe = np.where(active, x, 1)
+        ka = np.floor(np.log2(x_safe)).astype(np.int64)
+        x_prime = np.ldexp(x_safe, -np.maximum(k_prime_max+1, ka+1))
+        x_dprime = x_prime * x_prime
+        #taylor approximation
+        h = x_prime - x_dprime / 3 + (x_dprime * x_dprime) * (1/45 - x_dprime/472.5)
+
+        # each row takes ka - k'_max steps down to k'_max
+        steps = np.maximum(ka - k_prime_max, 0)
+        for j in range(steps.max(initial=0)):
+            step = j < steps
+            h = np.where(step, (x_prime + h*(1-h)) / (x_prime + (1-h)), h)
+            x_prime = np.where(step, 2 * x_prime, x_prime)
+        g = c * h
+
+        # then k'_max - k'_min steps down to k'_min, accumulating counts
+        steps = np.maximum(k_prime_max - k_prime_min, 0)
+        for j in range(steps.max(initial=0)):
+            step = j < steps
+            k = np.where(step, k_prime_max - 1 - j, 0)
+            h = np.where(step, (x_prime + h*(1-h)) / (x_prime + (1-h)), h)
+            g = np.where(step, g + counts[rows, k] * h, g)
+            x_prime = np.where(step, 2 * x_prime, x_prime)
+        g = g + x * a
+
+        increasing = (g > g_prev) & (m_prime >= g)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_delta_x = np.where(increasing, delta_x * (m_prime - g) / (g - g_prev), 0)
+        delta_x = np.where(active, new_delta_x, delta_x)
+        x = np.where(active, x + delta_x, x)
+        g_prev = np.where(active, g, g_prev)
+
+    return np.where(saturated, np.inf, m * x)
+
 """
 Cardinality.simpleCardinality():
 Calculate cardinality of HLL by bias-corrected harmonic mean
 Comes from Algorithm 5 in Ertl paper
 
-Input: registers, a list representing the registers of the HyperLogLog
+Input: registers, an array representing the registers of the HyperLogLog
 Output: a float representing the cardinality estimate for registers
 """
 def simpleCardinality(registers):
+    registers = np.asarray(registers)
     m = len(registers)
-    alpha_m = 0.7213/(1+1.079/m) # bias correction factor
+    alpha_m = alpha(m) # bias correction factor
 
-    # raw estimation via harmonic mean
-    n_raw = alpha_m * (m ** 2) / sum([(2 ** -x) for x in registers])
+    # raw estimation via harmonic mean, summing 2^-k over the counts of each register value
+    counts = np.bincount(registers, minlength=MAX_RANK + 1)
+    n_raw = alpha_m * (m ** 2) / np.dot(counts, power_table(len(counts)))
 
     # for sufficiently small cardinalities, we can just count number of 0 registers
     if (n_raw <= m*5/2): #small correction
-        c0 = registers.count(0)
+        c0 = counts[0]
         if c0 != 0:
             return m*np.log2(m/c0)
         else:
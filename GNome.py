@@ -1,65 +1,58 @@
 """
 GNome.py: Similarity estimation for simulated bacterial genome reads
 
-Usage: accepts one argument which is the path to read Data
+Usage: python GNome.py COMMAND [options], with one of the commands
+       sketch INPUT... -o OUT          sketches folders or FASTA/FASTQ files into the sketch file OUT
+       dist SKETCHES -o OUT            writes the Jaccard, Sorensen-Dice and Forbes similarity of every pair,
+                                       as TSV rows (name1, name2, jaccard, sd, forbes) for every pair name1 < name2
+                                       in input order, or with --format npy as a (3, n, n) array of the three
+                                       similarity matrices; rows are written as they are computed
+       rank SKETCHES -o OUT            writes the n best matches of every genome by --measure, as TSV rows
+                                       (genome, rank, match, similarity), or with --format npy the full ranking
+                                       matrix of GenomeRankings.rank_genomes()
+       query QUERY... REFERENCES -o OUT
+                                       writes the n references most similar to each query, as TSV rows
+                                       (query, rank, reference, similarity), see Query.py
+       evaluate SKETCHES [--truth FILE]
+                                       writes the Kendall tau between each measure's rankings and a ground truth
+                                       ranking matrix (a text or .npy file; the matrix of get_ground_truth() for
+                                       the bundled data by default)
+       SKETCHES is a sketch file (plain, compressed or legacy pickled) or a folder of reads, sketched on the fly
+       OUT may be - for standard output (except for sketch files and npy output), progress goes to standard error
+
+       the original form, a folder of reads or a sketch file evaluated against get_ground_truth(), still works:
        python GNome.py Data/0.5x
 
-       alternatively, one argument which is a path to a sketch file
-       python GNome.py 5x.sketch
+Options:
+       --threads N sketches files and computes pairwise similarities with N processes (default 1),
+       the output is the same for any N
+       -k K and -p P set the k-mer length and HLL precision (default 25 and 12)
+       --canonical sketches canonical k-mers (the smaller of each k-mer and its reverse complement)
+       query sketches FASTA/FASTQ queries with the k and canonical flag of the references by default, and fails
+       if -k, --canonical or a query sketch file disagree with them
+       --hash NAME selects the hash function, one of wang64 (default), murmur3 or xxhash64
+       --db DIR keeps sketches and pairwise similarities in a sketch database (see SketchDatabase.py),
+       so files and pairs seen in an earlier run are not computed again
+       sketch files are written in the SketchFile format; --compress writes the compressed SketchCodec format
+       instead, --entropy entropy codes its registers, smaller but slower to decode, and --zlib LEVEL adds zlib
+       compression of its chunks, for archival
 """
 
-import Cardinality
-import os
+import argparse
+import contextlib
 import sys
+import os
 import numpy as np
 from HLL import HLL
-import Similarity
-import glob
+import SimilarityMatrix
+import Hash
 import GenomeRankings
+import Query
+import SketchCodec
+import SketchFile
+import SketchDatabase
 import pickle
-
-"""
-get_HLL():
-Generates and returns HLL by inserting 25-mers from reads
-
-Input: reads from FASTA and number of reads in file
-Returns: filled HLL from set of reads
-"""
-def get_HLL(reads, numReads):
-    hll = HLL(12)
-    for i in range(numReads):
-        seq = reads[(i*2)+1].rstrip().upper()
-        # add all 25-mers to HLL
-        for i in range(0,len(seq)-25):
-            hll.insert(seq[i:i+25])
-    return hll
-
-"""
-get_sketches():
-Generates a set of sketches given a folder_path
-
-Input: folder_path, a string containing a path to a folder of FASTA files containing Illumina reads
-Output:
-    sketches, a list of HLLs for each FASTA file
-    species, a list of filenames the same length as sketches
-"""
-def get_sketches(folder_path):
-    sketches = []
-    species = []
-    i = 0
-
-    files = glob.glob(os.path.join(folder_path, '*.fasta'))
-    files.sort()
-    for filename in files:
-        with open(filename) as myFile:
-            inputLines = myFile.readlines()
-        species.append(filename)
-        print('\tReading file: {}'.format(filename))
-        totalReads = int(len(inputLines) / 2)
-        sketches.append(get_HLL(inputLines, totalReads))
-        i += 1
-
-    return sketches, species
+from Sketching import get_sketches
 
 """
 calculate_rankings():
@@ -67,32 +60,22 @@ Creates similarity matrices for three separate similarity coefficients
 and calls rank_genomes to create vectors based on similarities
 
 Input: array of sketches
+       jobs, the number of processes computing pairwise similarities
+       database, a SketchDatabase.SketchDatabase (optional); pairs cached in it are not recomputed,
+       and new pairs are added to it
 Returns: matrix of each genomes similarity rankings
 """
-def calculate_rankings(sketches):
-    n_genomes = len(sketches)
-
-    jaccard_matrix = np.zeros((n_genomes,n_genomes))
-    sd_matrix = np.zeros((n_genomes,n_genomes))
-    forbes_matrix = np.zeros((n_genomes,n_genomes))
-
+def calculate_rankings(sketches, jobs=1, database=None):
     print('Calculating pairwise similarities...')
-    for i in range(n_genomes):
-        for j in range(i, n_genomes):
-            h1 = sketches[i]
-            h2 = sketches[j]
-            union = Similarity.union(h1, h2).cardinality()
-            a_excl, b_excl, intersection = Similarity.getJointEstimators(h1, h2)
-            a = h1.cardinality()
-            b = h2.cardinality()
-
-            jaccard = intersection / union
-            sd = 2*intersection/(a + b)
-            forbes = (intersection*union)/(intersection*union + 1.5*a_excl*b_excl)
-
-            jaccard_matrix[i, j] = jaccard
-            sd_matrix[i, j] = sd
-            forbes_matrix[i, j] = forbes
+    if database is not None:
+        jaccard_matrix, sd_matrix, forbes_matrix = database.similarity_matrices(sketches, workers=jobs)
+    else:
+        jaccard_matrix, sd_matrix, forbes_matrix = SimilarityMatrix.similarity_matrices(sketches, workers=jobs)
+
+    # rank_genomes() takes upper triangular matrices
+    jaccard_matrix = np.triu(jaccard_matrix)
+    sd_matrix = np.triu(sd_matrix)
+    forbes_matrix = np.triu(forbes_matrix)
 
     jaccard_rankings = GenomeRankings.rank_genomes(jaccard_matrix)
     sd_rankings = GenomeRankings.rank_genomes(sd_matrix)
@@ -117,25 +100,291 @@ def get_ground_truth():
        [2., 9., 9., 9., 3., 1., 9., 9., 9., 0.]]) # from ANI data
 
 """
+check_ground_truth():
+Exits with an error message unless a ground truth ranking matrix has one row and column per genome
+
+Input: ground_truth, a ranking matrix; species, the names of the genomes
+"""
+def check_ground_truth(ground_truth, species):
+    if ground_truth.shape != (len(species), len(species)):
+        raise SystemExit('Ground truth is {}x{} but there are {} genomes'.format(*ground_truth.shape, len(species)))
+
+"""
+load_sketches():
+Loads the sketches of a sketch file, or sketches a folder of reads (or a list of folders and files)
+
+Input: path, a sketch file (SketchFile, compressed SketchCodec or legacy pickled), a folder, or a list of
+       folders and FASTA/FASTQ files; workers, k, p, canonical, hash_name, database, as in get_sketches()
+Output: sketches, a list of HLLs; species, a list of names the same length as sketches
+"""
+def load_sketches(path, workers=1, k=25, p=12, canonical=False, hash_name=Hash.DEFAULT_HASH, database=None):
+    if isinstance(path, str) and os.path.isfile(path):
+        if SketchFile.is_sketch_file(path):
+            return SketchFile.read_sketches(path)
+        if SketchCodec.is_compressed_file(path):
+            return SketchCodec.read_sketches(path)
+        if path.rstrip()[-7:] == '.sketch':
+            # legacy pickled list of HLLs
+            with open(path, 'rb') as f:
+                sketches = pickle.load(f)
+            return sketches, [str(i) for i in range(len(sketches))]
+    print('Reading Files...')
+    return get_sketches(path, workers=workers, k=k, p=p, canonical=canonical, hash_name=hash_name, database=database)
+
+"""
+load_ground_truth():
+Reads a ground truth ranking matrix, in the form of get_ground_truth()
+
+Input: path, a .npy file or a whitespace or tab separated text file, or None for get_ground_truth()
+Output: a square numpy float64 array
+"""
+def load_ground_truth(path=None):
+    if path is None:
+        return get_ground_truth()
+    if path.endswith('.npy'):
+        return np.load(path).astype(np.float64)
+    return np.loadtxt(path, ndmin=2)
+
+"""
+open_output():
+Opens an output text file, or standard output for -
+"""
+def open_output(path):
+    if path == '-':
+        return contextlib.nullcontext(sys.stdout)
+    return open(path, 'w')
+
+"""
+write_similarities():
+Streams the pairwise similarities of a collection of sketches to a file, block of rows by block of rows (see
+SimilarityMatrix.iter_similarities()), so the pairs are never all held in memory
+
+Input: sketches, names; out, the output path (- for standard output with TSV)
+       fmt, 'tsv' for one line per pair i < j, or 'npy' for a (3, n, n) array of the jaccard, sd and forbes matrices
+       workers, the number of processes; rows_per_block, the number of rows of the upper triangle per block
+"""
+def write_similarities(sketches, names, out, fmt='tsv', workers=1, rows_per_block=64):
+    blocks = SimilarityMatrix.iter_similarities(sketches, rows_per_block=rows_per_block, workers=workers)
+    if fmt == 'npy':
+        n = len(sketches)
+        matrices = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=(3, n, n))
+        for rows, cols, *values in blocks:
+            for matrix, pairs in zip(matrices, values):
+                matrix[rows, cols] = matrix[cols, rows] = pairs
+        matrices.flush()
+        del matrices
+        return
+    with open_output(out) as f:
+        f.write('genome1\tgenome2\tjaccard\tsd\tforbes\n')
+        for rows, cols, jaccard, sd, forbes in blocks:
+            pairs = rows < cols
+            f.writelines('{}\t{}\t{:.6g}\t{:.6g}\t{:.6g}\n'.format(names[i], names[j], a, b, c) for i, j, a, b, c in zip(
+                rows[pairs], cols[pairs], jaccard[pairs], sd[pairs], forbes[pairs]))
+    return
+
+def add_sketch_options(parser):
+    parser.add_argument('--threads', '--jobs', dest='threads', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('-k', '--k', type=int, default=25, help='k-mer length, at most 32 (default 25)')
+    parser.add_argument('-p', '--p', type=int, default=12, help='HLL precision, sketches have 2^p registers (default 12)')
+    parser.add_argument('--canonical', action='store_true',
+                        help='insert canonical k-mers, so reads from either strand give the same k-mers')
+    parser.add_argument('--hash', default=Hash.DEFAULT_HASH, choices=sorted(Hash.HASHES),
+                        help='hash function used to build sketches (default {})'.format(Hash.DEFAULT_HASH))
+    parser.add_argument('--db', help='sketch database directory, reusing and storing sketches and pairwise similarities')
+
+def open_database(args):
+    if args.db is None:
+        return None
+    return SketchDatabase.SketchDatabase(args.db, p=args.p, hash_name=args.hash, k=args.k, canonical=args.canonical)
+
+def load_input(args, path, database=None):
+    # progress messages go to standard error, so standard output only holds results
+    with contextlib.redirect_stdout(sys.stderr):
+        return load_sketches(path, workers=args.threads, k=args.k, p=args.p, canonical=args.canonical,
+                             hash_name=args.hash, database=database)
+
+def run_sketch(args):
+    database = open_database(args)
+    sketches, species = load_input(args, args.inputs, database)
+    if database is not None:
+        database.save()
+    if args.compress:
+        SketchCodec.write_sketches(args.output, sketches, species, k=args.k, canonical=args.canonical,
+                                   entropy=args.entropy, zlib_level=args.zlib)
+    else:
+        SketchFile.write_sketches(args.output, sketches, species, k=args.k, canonical=args.canonical)
+
+def run_dist(args):
+    database = open_database(args)
+    sketches, species = load_input(args, args.sketches, database)
+    if database is not None:
+        database.save()
+    write_similarities(sketches, species, args.output, args.format, args.threads, args.rows_per_block)
+    if args.names is not None:
+        with open(args.names, 'w') as f:
+            f.writelines(name + '\n' for name in species)
+
+def run_rank(args):
+    database = open_database(args)
+    sketches, species = load_input(args, args.sketches, database)
+    if database is not None:
+        # pairs cached in the database are not computed again, new ones are added to it
+        matrices = database.similarity_matrices(sketches, workers=args.threads)
+        database.save()
+    else:
+        matrices = SimilarityMatrix.similarity_matrices(sketches, workers=args.threads)
+    matrices = dict(zip(Query.MEASURES, matrices))
+    similarities = np.triu(matrices[args.measure])
+    if args.format == 'npy':
+        np.save(args.output, GenomeRankings.rank_genomes(similarities))
+        return
+    n = len(species) if args.n is None else args.n
+    indices, rankings = GenomeRankings.top_rankings(similarities, n)
+    full = similarities + similarities.T - np.diagflat(similarities.diagonal())
+    with open_output(args.output) as f:
+        f.write('genome\trank\tmatch\t{}\n'.format(args.measure))
+        for i, name in enumerate(species):
+            f.writelines('{}\t{:g}\t{}\t{:.6g}\n'.format(name, rank, species[j], full[i, j])
+                         for j, rank in zip(indices[i], rankings[i]))
+
+def run_query(args):
+    index = Query.ReferenceIndex.from_path(args.references)
+    queries, names = [], []
+    try:
+        # FASTA/FASTQ queries are sketched with the k-mers of the references, and sketch files must match them
+        k, canonical = index.sketch_options(args.k, args.canonical)
+        for path in args.queries:
+            if SketchFile.is_sketch_file(path):
+                header = SketchFile.SketchFile(path)
+                index.sketch_options(header.k, header.canonical)
+                sketches, species = load_sketches(path)
+            elif SketchCodec.is_compressed_file(path):
+                registers, species, reader = SketchCodec.read_registers(path)
+                index.sketch_options(reader.k, reader.canonical)
+                sketches = [HLL(reader.p, row, hash_name=reader.hash_name) for row in registers]
+            else:
+                with contextlib.redirect_stdout(sys.stderr):
+                    sketches, species = get_sketches([path], workers=args.threads, k=k, p=index.p,
+                                                     canonical=canonical, hash_name=index.hash_name)
+            queries += sketches
+            names += species
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if queries and min(h.p for h in queries) < index.p:
+        index = index.reduce_precision(min(h.p for h in queries))
+    results = index.query_batch(queries, args.n, args.measure)
+    with open_output(args.output) as f:
+        f.write('query\trank\treference\t{}\n'.format(args.measure))
+        for name, (matches, _) in zip(names, results):
+            f.writelines('{}\t{}\t{}\t{:.6g}\n'.format(name, rank, match, similarity)
+                         for rank, (match, similarity) in enumerate(matches, 1))
+
+def run_evaluate(args):
+    database = open_database(args)
+    sketches, species = load_input(args, args.sketches, database)
+    with contextlib.redirect_stdout(sys.stderr):
+        jaccard_rankings, forbes_rankings, sd_rankings = calculate_rankings(sketches, jobs=args.threads, database=database)
+    if database is not None:
+        database.save()
+    ground_truth = load_ground_truth(args.truth)
+    check_ground_truth(ground_truth, species)
+    with open_output(args.output) as f:
+        f.write('measure\tkendall_tau\n')
+        for measure, rankings in (('jaccard', jaccard_rankings), ('sd', sd_rankings), ('forbes', forbes_rankings)):
+            f.write('{}\t{:.6g}\n'.format(measure, GenomeRankings.compare_rankings(rankings, ground_truth)))
+
+COMMANDS = ('sketch', 'dist', 'rank', 'query', 'evaluate')
+
+"""
+main():
+Parses the command line and runs one of the commands in the module docstring
+"""
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] not in COMMANDS and not argv[0].startswith('-'):
+        return legacy_main(argv)
+
+    parser = argparse.ArgumentParser(description='Sketching-based similarity estimation for genomes')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sketch = commands.add_parser('sketch', help='sketch folders or FASTA/FASTQ files into a sketch file')
+    sketch.add_argument('inputs', nargs='+', help='folders of reads or FASTA/FASTQ files')
+    sketch.add_argument('-o', '--output', required=True, help='sketch file to write')
+    sketch.add_argument('--compress', action='store_true',
+                        help='write the compressed SketchCodec format, for transfer and archival')
+    sketch.add_argument('--entropy', action='store_true',
+                        help='entropy code the registers of compressed sketches, smaller but slower to decode')
+    sketch.add_argument('--zlib', type=int, default=0, metavar='LEVEL',
+                        help='zlib level of compressed sketch chunks, 0 for none (default 0)')
+    add_sketch_options(sketch)
+
+    dist = commands.add_parser('dist', help='similarity of every pair of sketches')
+    dist.add_argument('sketches', help='sketch file or folder of reads')
+    dist.add_argument('-o', '--output', default='-', help='output file, - for standard output (default -)')
+    dist.add_argument('--format', default='tsv', choices=('tsv', 'npy'), help='output format (default tsv)')
+    dist.add_argument('--names', help='also write the genome names, one per line, in matrix order')
+    dist.add_argument('--rows-per-block', type=int, default=64, help='rows computed and written at once (default 64)')
+    add_sketch_options(dist)
+
+    rank = commands.add_parser('rank', help='best matches of every genome')
+    rank.add_argument('sketches', help='sketch file or folder of reads')
+    rank.add_argument('-o', '--output', default='-', help='output file, - for standard output (default -)')
+    rank.add_argument('--measure', default='jaccard', choices=Query.MEASURES, help='similarity measure (default jaccard)')
+    rank.add_argument('-n', type=int, help='matches per genome (default all)')
+    rank.add_argument('--format', default='tsv', choices=('tsv', 'npy'), help='output format (default tsv)')
+    add_sketch_options(rank)
+
+    query = commands.add_parser('query', help='references most similar to each query')
+    query.add_argument('queries', nargs='+', help='FASTA/FASTQ or sketch files of the queries')
+    query.add_argument('references', help='sketch file or sketch database directory of the references')
+    query.add_argument('-o', '--output', default='-', help='output file, - for standard output (default -)')
+    query.add_argument('--measure', default='jaccard', choices=Query.MEASURES, help='similarity measure (default jaccard)')
+    query.add_argument('-n', type=int, default=10, help='references per query (default 10)')
+    add_sketch_options(query)
+    # -k and --canonical default to the values recorded with the references
+    query.set_defaults(k=None, canonical=None)
+
+    evaluate = commands.add_parser('evaluate', help='agreement of the rankings of each measure with a ground truth')
+    evaluate.add_argument('sketches', help='sketch file or folder of reads')
+    evaluate.add_argument('--truth', help='ground truth ranking matrix, a text or .npy file (default get_ground_truth())')
+    evaluate.add_argument('-o', '--output', default='-', help='output file, - for standard output (default -)')
+    add_sketch_options(evaluate)
+
+    args = parser.parse_args(argv)
+    {'sketch': run_sketch, 'dist': run_dist, 'rank': run_rank, 'query': run_query, 'evaluate': run_evaluate}[args.command](args)
+
+"""
+legacy_main():
 For each genome in given file, generates k-mers from reads and sketches HLL.
 Then, calculates similarity ranking matrices for Jaccard, Forbes, and
 Sorensen-Dice and compares to ground truth matrix.
+Offers to save the sketches when run from a terminal.
 
 Output: Similarity accuracies (percent matches between similarity matrix and
 ground truth)
 """
-def main():
-    if sys.argv[1].rstrip()[-7:] == '.sketch':
-        sketches = pickle.load(open(sys.argv[1], 'rb'))
+def legacy_main(argv):
+    parser = argparse.ArgumentParser(description='Similarity estimation for simulated bacterial genome reads')
+    parser.add_argument('path', help="folder of reads ('Data/0.5x' or 5x/50x for other coverages) or a .sketch file")
+    add_sketch_options(parser)
+    parser.add_argument('--compress', action='store_true',
+                        help='save sketches in the compressed SketchCodec format, for transfer and archival')
+    parser.add_argument('--entropy', action='store_true',
+                        help='entropy code the registers of compressed sketches, smaller but slower to decode')
+    parser.add_argument('--zlib', type=int, default=0, metavar='LEVEL',
+                        help='zlib level of compressed sketch chunks, 0 for none (default 0)')
+    args = parser.parse_args(argv)
 
-    else:
-        folder_path = sys.argv[1]  # path: 'Data/0.5x' or 5x/50x for other coverages
-        print('Reading Files...')
-        sketches, species = get_sketches(folder_path)
-
-
-    jaccard_rankings, forbes_rankings, sd_rankings = calculate_rankings(sketches)
+    database = open_database(args)
+    sketches, species = load_sketches(args.path, workers=args.threads, k=args.k, p=args.p, canonical=args.canonical,
+                                      hash_name=args.hash, database=database)
     ground_truth = get_ground_truth()
+    check_ground_truth(ground_truth, species)
+
+    jaccard_rankings, forbes_rankings, sd_rankings = calculate_rankings(sketches, jobs=args.threads, database=database)
+    if database is not None:
+        database.save()
 
     jaccard_acc = GenomeRankings.compare_rankings(jaccard_rankings, ground_truth)
     sd_acc = GenomeRankings.compare_rankings(sd_rankings, ground_truth)
@@ -144,10 +393,14 @@ def main():
     print('Sorensen-Dice Similarity Accuracy: {}'.format(sd_acc))
     print('Forbes Similarity Accuracy: {}'.format(forbes_acc))
 
+    if not sys.stdin.isatty():
+        return
     outfile = input('Output Sketch Filename (enter for none): ')
-    if outfile.rstrip() != '':
-        with open(outfile+'.sketch', 'wb') as sketchfile:
-          pickle.dump(sketches, sketchfile)
+    if outfile.rstrip() != '' and args.compress:
+        SketchCodec.write_sketches(outfile+'.sketch', sketches, species, k=args.k, canonical=args.canonical,
+                                   entropy=args.entropy, zlib_level=args.zlib)
+    elif outfile.rstrip() != '':
+        SketchFile.write_sketches(outfile+'.sketch', sketches, species, k=args.k, canonical=args.canonical)
 
 if (__name__ == '__main__'):
     main()
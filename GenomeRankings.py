@@ -4,8 +4,6 @@ GenomeRanking.py: Ranking genomes and calculating correlations from ranking matr
 This file supplies helper methods for GNome.py
 """
 import numpy as np
-from scipy.stats import rankdata
-from scipy.stats import kendalltau
 
 """
 rank_genomes():
@@ -28,13 +26,74 @@ def rank_genomes(sim_matrix):
     # pairwise-rank each genome based on similarities
     # lower ranks are better matches
     # each row is a ranking vector for that corresponding genome
-    # ties are ranked with the minimum ranking
+    # ties are ranked with the minimum ranking, as rankdata(row, method='min') does
+    # rows with a nan similarity are all nan, as rankdata() leaves them
+    return sim_matrix.shape[1] - rank_rows(sim_matrix)
 
-    rankings = np.zeros(sim_matrix.shape)
-    # iterate through rows since scipy doesn't have basic matrix functionality
-    for idx,row in enumerate(sim_matrix):
-        rankings[idx,:] = len(row) - rankdata(row, method='min')
-    return rankings
+"""
+rank_rows():
+Ranks every row of a matrix at once, from a single argsort along the rows
+Equal values share the minimum rank of their group, as scipy.stats.rankdata(row, method='min') ranks them.
+A row containing nan is ranked all nan, as rankdata() does by default.
+
+Input: a 2-D array
+Output: a float64 array of the same shape with ranks from 1 to the number of columns
+"""
+def rank_rows(values):
+    n = values.shape[1]
+    missing = nan_rows(values)
+    if missing.any():
+        values = np.where(missing[:, None], 0, values)
+    order = np.argsort(values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    # every element of a group of equal values takes the sorted position of the group's first element
+    first = np.broadcast_to(np.arange(n), values.shape).copy()
+    first[:, 1:][sorted_values[:, 1:] == sorted_values[:, :-1]] = 0
+    np.maximum.accumulate(first, axis=1, out=first)
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, first + 1, axis=1)
+    ranks[missing] = np.nan
+    return ranks
+
+"""
+nan_rows():
+Whether each row of a matrix contains a nan
+
+Input: a 2-D array
+Output: a boolean array with one entry per row
+"""
+def nan_rows(values):
+    if not np.issubdtype(values.dtype, np.floating):
+        return np.zeros(len(values), dtype=bool)
+    return np.isnan(values).any(axis=1)
+
+"""
+top_rankings():
+The k best matches of each genome and their rankings, without ranking every genome
+Rankings are the same as the corresponding entries of rank_genomes()
+
+Input: a square upper triangular matrix of similarity values, as for rank_genomes(); k, the number of matches to keep
+Output: indices, an (n, k) array of the best matching genomes of each genome, best first
+        rankings, an (n, k) array of their rankings
+"""
+def top_rankings(sim_matrix, k):
+    sim_matrix = sim_matrix + sim_matrix.T - np.diagflat(sim_matrix.diagonal())
+    k = min(k, sim_matrix.shape[1])
+    indices = np.argpartition(-sim_matrix, k - 1, axis=1)[:, :k]
+    values = np.take_along_axis(sim_matrix, indices, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+
+    # the ranking of a genome is the number of other genomes at least as similar, which within the top k is the
+    # position of the last genome of its group of ties
+    last = np.broadcast_to(np.arange(k), values.shape).copy()
+    last[:, :-1][values[:, :-1] == values[:, 1:]] = k
+    last = np.minimum.accumulate(last[:, ::-1], axis=1)[:, ::-1]
+    # ties with the k-th match can continue past the top k
+    boundary = values == values[:, -1:]
+    beyond = (sim_matrix == values[:, -1:]).sum(axis=1) - boundary.sum(axis=1)
+    return indices, (last + boundary * beyond[:, None]).astype(np.float64)
 
 """
 compare_rankings():
@@ -44,9 +103,113 @@ Compare two ranking matrices using average Kendall's tau distance
 Input: two ranking matrices from the rank_genomes() function
 Output: a float between -1 and 1; 1 indicates perfect agreement, -1 indicates perfect disagreement"""
 def compare_rankings(mat1, mat2):
-    n = mat1.shape[0]
-    kt_sum = 0
-    for idx in range(n):
-        tau,_ = kendalltau(mat1[idx,:], mat2[idx,:])
-        kt_sum += tau
-    return kt_sum / n
+    return np.mean(kendall_tau_rows(mat1, mat2))
+
+"""
+kendall_tau_rows():
+Kendall's tau-b between corresponding rows of two matrices, the value scipy.stats.kendalltau() gives for each pair
+of rows, computed for block_size rows at a time. As in kendalltau(), the pairs of each row are sorted by (x, y)
+and the discordant pairs are counted as the inversions of y with a merge sort.
+
+Input: two 2-D arrays of the same shape; block_size, the number of rows handled at once
+Output: an array with one tau per row (nan where a row is constant or either row contains nan)
+"""
+def kendall_tau_rows(x, y, block_size=64):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    # as in kendalltau(), a nan in either row makes its tau nan
+    missing = nan_rows(x) | nan_rows(y)
+    if missing.any():
+        x = np.where(missing[:, None], 0, x)
+        y = np.where(missing[:, None], 0, y)
+    tau = np.empty(len(x))
+    for start in range(0, len(x), block_size):
+        tau[start:start+block_size] = _kendall_tau_block(x[start:start+block_size], y[start:start+block_size])
+    tau[missing] = np.nan
+    return tau
+
+def _kendall_tau_block(x, y):
+    n = x.shape[1]
+    # ranks are small integers that keep the ties of the values, rankings from rank_genomes() already are
+    dtype = key_dtype((n + 1) ** 2)
+    x = (x if is_ranking(x) else rank_rows(x)).astype(dtype)
+    y = (y if is_ranking(y) else rank_rows(y)).astype(dtype)
+    pairs = np.sort(x * (n + 1) + y, axis=1)
+    x, y = np.divmod(pairs, n + 1)
+
+    total = n * (n - 1) // 2
+    x_ties = tied_pairs(x)
+    y_ties = tied_pairs(np.sort(y, axis=1))
+    # pairs tied in both x and y are adjacent after sorting by (x, y)
+    joint = np.zeros(x.shape, dtype=np.int64)
+    joint[:, 1:] = (x[:, 1:] == x[:, :-1]) & (y[:, 1:] == y[:, :-1])
+    joint_ties = tied_pairs(np.cumsum(1 - joint, axis=1))
+    discordant = count_inversions(y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (total - x_ties - y_ties + joint_ties - 2 * discordant) / np.sqrt((total - x_ties) * (total - y_ties))
+
+"""
+is_ranking():
+Whether every value of a matrix is an integer between 0 and the number of columns, as in rank_genomes()
+"""
+def is_ranking(values):
+    n = values.shape[1]
+    return values.size == 0 or (values.min() >= 0 and values.max() <= n and np.array_equal(values, np.floor(values)))
+
+"""
+tied_pairs():
+Number of pairs of equal values in each row of a matrix whose rows are sorted
+
+Input: a 2-D array with sorted rows
+Output: an int64 array with one count per row
+"""
+def tied_pairs(values):
+    n = values.shape[1]
+    first = np.broadcast_to(np.arange(n), values.shape).copy()
+    first[:, 1:][values[:, 1:] == values[:, :-1]] = 0
+    np.maximum.accumulate(first, axis=1, out=first)
+    # each element is tied with the elements of its group before it
+    return (np.arange(n) - first).sum(axis=1)
+
+"""
+count_inversions():
+Number of pairs i < j with values[i] > values[j] in each row of a matrix, by a bottom-up merge sort of all rows at once
+Sorted blocks of width w are merged pairwise by one stable sort of the whole matrix, with each value offset by its
+block so that merges stay inside their pair of blocks, and tagged with whether it comes from the right block so that
+equal values keep left before right. A right element moves left in the merge past exactly the left elements
+greater than it. Each pair of blocks is two sorted runs, which the stable sort (timsort) finds and merges in linear
+time, and blocks already in order are passed over, so a pass costs the same at every width.
+
+Input: a 2-D array of integers in [0, number of columns]
+Output: an int64 array with one count per row
+"""
+def count_inversions(values):
+    n = values.shape[1]
+    # keys are below 2(n+1)^2, int32 halves the memory each pass goes through where they fit
+    dtype = key_dtype(2 * (n + 1) ** 2)
+    positions = np.arange(n, dtype=dtype)
+    inversions = np.zeros(len(values), dtype=np.int64)
+    keys = values.astype(dtype) * 2
+    offset = np.zeros(n, dtype=dtype)
+    width = 1
+    while width < n:
+        block_start = positions // (2 * width) * (2 * width)
+        right = (positions - block_start >= width).astype(dtype)
+        # the keys are updated in place from the offsets of the previous pass, merges keep each key in its block
+        new_offset = block_start * (2 * n + 2)
+        keys += right + new_offset - offset
+        keys.sort(axis=1, kind='stable')
+        tags = keys & 1
+        inversions += int(right @ positions) - tags @ positions
+        keys -= tags
+        offset = new_offset
+        width *= 2
+    return inversions
+
+"""
+key_dtype():
+The smallest of int32 and int64 that holds every integer below a bound
+"""
+def key_dtype(bound):
+    return np.int32 if bound <= np.iinfo(np.int32).max else np.int64
@@ -1,6 +1,8 @@
 import Cardinality
 import Hash
+import Kmers
 import sys
+import numpy as np
 
 from Random_Generators import Rangen_jaccard
 # HyperLogLog implementation for our project
@@ -10,17 +12,42 @@ from Random_Generators import Rangen_jaccard
 class HLL:
     """HyperLogLog implementation"""
 
-    def __init__(self, p, registers=None):
-        # Initialize HLL with 2^p registers
+    def __init__(self, p, registers=None, packed=False, hash_name=Hash.DEFAULT_HASH, sparse=False):
+        # Initialize HLL with 2^p registers, stored as one byte each
         self.p = p
         self.q = 64 - p  # assuming 64-bit hash value
         self.m = 2 ** p
+        self.packed = False
+        self.sparse = False
+        self.hash_name = hash_name
+        self.hash, self.hash_array = Hash.get_hash(hash_name)
 
-        if registers != None:
+        if registers is not None:
             assert len(registers) == self.m
-            self.registers = registers
+            self.registers = np.asarray(registers, dtype=np.uint8)
         else:
-            self.registers = [0 for i in range(self.m)]
+            self.registers = np.zeros(self.m, dtype=np.uint8)
+
+        if sparse:
+            self.to_sparse()
+        if packed:
+            self.pack()
+
+    def __getstate__(self):
+        # hash functions are looked up by name when unpickling
+        state = dict(self.__dict__)
+        del state['hash'], state['hash_array']
+        return state
+
+    def __setstate__(self, state):
+        # HLLs pickled before registers were numpy arrays have no packed or sparse flag or hash name
+        self.__dict__.update(state)
+        self.packed = state.get('packed', False)
+        self.sparse = state.get('sparse', False)
+        if not self.sparse:
+            self.registers = np.asarray(self.registers, dtype=np.uint8)
+        self.hash_name = state.get('hash_name', Hash.DEFAULT_HASH)
+        self.hash, self.hash_array = Hash.get_hash(self.hash_name)
 
     """
     HLL.insert():
@@ -53,7 +80,7 @@ class HLL:
             read_len = read_len - 1
 
         # Call to hash function, returns a 64-bit hash value
-        read_hash = Hash.hash64shift(b_ten_read)
+        read_hash = self.hash(b_ten_read)
 
         read_hash = "{0:b}".format(read_hash)  # Converts into binary
 
@@ -68,16 +95,192 @@ class HLL:
         b = read_hash[self.p:]  # Following q bits of (p + q)-bit hash value of read
 
         k = b.find('1') + 1  # be sure to add 1 to match match from Ertl paper
-        if k == -1:
+        if k == 0:  # no 1 bit in the q bits
             k = self.q + 1
 
         i = int(a, 2)  # Indexing into HLL
 
         # Insert into HLL
-        if k > self.registers[i]:
-            self.registers[i] = k
+        if self.sparse:
+            self.update(np.array([i]), np.array([k]))
+            return
+        registers = self.getRegisters()
+        if k > registers[i]:
+            registers[i] = k
+            self.setRegisters(registers)
+        return
+
+    """
+    HLL.insert_many():
+    Inserts every k-mer of a read (or of each read in a list of reads) into the HLL at once
+    K-mers are 2-bit encoded into uint64 codes, hashed in bulk and the registers updated with np.maximum.at
+    Gives the same registers as calling insert() on each k-mer; k-mers containing non-ACGT characters are skipped
+
+    Input: The HLL, a read or iterable of reads, the k-mer length (at most 32)
+           canonical, if True insert the smaller of each k-mer and its reverse complement (see Kmers.kmer_codes())
+    """
+    def insert_many(self, reads, k=25, canonical=False):
+        codes = Kmers.kmer_codes(Kmers.encode_reads(reads), k, canonical)
+        self.insert_codes(codes)
+        return
+
+    """
+    HLL.insert_codes():
+    Inserts already-encoded uint64 k-mer codes into the HLL, see insert_many()
+
+    Input: The HLL, a numpy array of k-mer codes
+    """
+    def insert_codes(self, codes):
+        hashes = self.hash_array(codes)
+
+        # first p bits index the register, the rank is the position of the first 1 in the following q bits
+        idx = (hashes >> np.uint64(self.q)).astype(np.intp)
+        w = hashes & np.uint64((1 << self.q) - 1)
+        k = self.q + 1 - bit_length(w)
+
+        self.update(idx, k)
+        return
+
+    """
+    HLL.update():
+    Raises registers to the given ranks, register idx[i] becomes max(register, ranks[i])
+    A sparse HLL that ends up with too many nonzero registers is converted to dense
+
+    Input: The HLL, an array of register indices, an array of ranks of the same length
+    """
+    def update(self, idx, ranks):
+        if self.sparse and len(idx) <= self.m:
+            self.registers = merge_sparse(self.registers, idx, ranks)
+            if len(self.registers) > sparse_limit(self.m):
+                self.to_dense()
+            return
+        # a batch larger than m is likely to fill most registers anyway, so update the expanded registers
+        registers = self.getRegisters()
+        np.maximum.at(registers, idx, np.asarray(ranks).astype(np.uint8))
+        self.setRegisters(registers)
+        return
+
+    """
+    HLL.merge_inplace():
+    Merges another HLL into this one, every register becomes the maximum of the two
+    A sparse HLL stays sparse while the other is sparse and the result has few enough nonzero registers
+
+    Input: The HLL, another compatible HLL
+    """
+    def merge_inplace(self, other):
+        self.check_compatible(other)
+        if self.sparse and other.sparse:
+            self.update(*other.nonzero_registers())
+        elif self.packed or self.sparse:
+            self.setRegisters(np.maximum(self.getRegisters(), other.getRegisters()))
+        else:
+            np.maximum(self.registers, other.getRegisters(), out=self.registers)
+        return
+
+    """
+    HLL.union_all():
+    Returns the union of any number of compatible HLLs as one new HLL
+    Dense registers are stacked chunk_size sketches at a time and reduced with np.maximum.reduce,
+    nonzero registers of sparse sketches are scattered in with np.maximum.at
+
+    Input: sketches, an iterable of compatible HLLs (at least one)
+           chunk_size, the number of dense sketches stacked at once; memory use grows with chunk_size * m
+    Output: an HLL, sparse if every input is sparse and few enough registers are nonzero
+    """
+    @staticmethod
+    def union_all(sketches, chunk_size=1024):
+        first = None
+        registers = None
+        all_sparse = True
+        chunk = []
+        sparse_idx, sparse_ranks = [], []
+        for h in sketches:
+            if first is None:
+                first = h
+                registers = np.zeros(h.m, dtype=np.uint8)
+            first.check_compatible(h)
+            if h.sparse:
+                idx, ranks = h.nonzero_registers()
+                sparse_idx.append(idx)
+                sparse_ranks.append(ranks)
+            else:
+                all_sparse = False
+                chunk.append(h.getRegisters())
+            if len(chunk) == chunk_size:
+                np.maximum(registers, np.maximum.reduce(np.stack(chunk)), out=registers)
+                chunk = []
+        assert first is not None
+        if chunk:
+            np.maximum(registers, np.maximum.reduce(np.stack(chunk)), out=registers)
+        if sparse_idx:
+            np.maximum.at(registers, np.concatenate(sparse_idx), np.concatenate(sparse_ranks))
+
+        new_hll = HLL(first.p, hash_name=first.hash_name, sparse=all_sparse)
+        new_hll.setRegisters(registers)
+        return new_hll
+
+    """
+    HLL.copy():
+    Returns an independent copy of the HLL, with the same storage (packed, sparse or dense)
+
+    Input: The HLL
+    Output: a new HLL
+    """
+    def copy(self):
+        new_hll = HLL(self.p, hash_name=self.hash_name)
+        new_hll.registers = self.registers.copy()
+        new_hll.packed = self.packed
+        new_hll.sparse = self.sparse
+        return new_hll
+
+    """
+    HLL.compatible():
+    Checks whether two HLLs can be merged or compared, which needs the same precision and hash function
+
+    Input: The HLL, another HLL
+    Output: True if the HLLs are compatible
+    """
+    def compatible(self, other):
+        return self.p == other.p and self.hash_name == other.hash_name
+
+    """
+    HLL.check_compatible():
+    Raises a ValueError if another HLL cannot be merged with or compared to this one
+
+    Input: The HLL, another HLL
+    """
+    def check_compatible(self, other):
+        if self.p != other.p:
+            raise ValueError('Cannot combine HLLs with precision {} and {}'.format(self.p, other.p))
+        if self.hash_name != other.hash_name:
+            raise ValueError('Cannot combine HLLs built with hash functions {} and {}'.format(self.hash_name, other.hash_name))
         return
 
+    """
+    HLL.reduce_precision():
+    Folds the HLL down to 2^p registers, giving the HLL that inserting the same elements at precision p would give
+    Register i becomes part of register i >> (self.p - p), and the dropped low bits t of its index become the
+    leading bits of the rank: a nonzero register's new rank is the position of the first 1 in t if t != 0,
+    or its rank plus the number of dropped bits if t == 0 (as described in the Ertl paper)
+
+    Input: The HLL, the new precision p (at most the HLL's precision)
+    Output: a new HLL with the same hash function and storage (packed, sparse or dense)
+    """
+    def reduce_precision(self, p):
+        if not 0 < p <= self.p:
+            raise ValueError('Cannot reduce an HLL with precision {} to precision {}'.format(self.p, p))
+        new_hll = HLL(p, hash_name=self.hash_name, sparse=self.sparse)
+        if self.sparse:
+            idx, ranks = self.nonzero_registers()
+            d = self.p - p
+            t = (idx & ((1 << d) - 1)).astype(np.uint64)
+            new_hll.update(idx >> d, np.where(t == 0, ranks.astype(np.int64) + d, d + 1 - bit_length(t)))
+        else:
+            new_hll.setRegisters(fold_registers(self.getRegisters(), self.p, p))
+        if self.packed:
+            new_hll.pack()
+        return new_hll
+
     """
     HLL.cardinality():
     Calls the getMultiplicity() function to get the count vector from HLL registers
@@ -102,21 +305,239 @@ class HLL:
 
     """
     HLL.getRegisters():
-    Returns the registers of the HLL, a list of values
+    Returns the registers of the HLL, a numpy uint8 array of values (unpacked if the HLL is packed)
 
     Input: The HLL
     Output: The registers
     """
     def getRegisters(self):
+        if self.packed:
+            return unpack_registers(self.registers, self.m)
+        if self.sparse:
+            return sparse_to_dense(self.registers, self.m)
         return self.registers
 
+    """
+    HLL.setRegisters():
+    Replaces the registers of the HLL, packing them if the HLL is packed
+    and keeping a sparse HLL sparse while few enough registers are nonzero
+
+    Input: The HLL, the new registers (one value per register)
+    """
+    def setRegisters(self, registers):
+        registers = np.asarray(registers, dtype=np.uint8)
+        assert len(registers) == self.m
+        if self.packed:
+            self.registers = pack_registers(registers)
+        elif self.sparse and np.count_nonzero(registers) <= sparse_limit(self.m):
+            self.registers = dense_to_sparse(registers)
+        else:
+            self.registers = registers
+            self.sparse = False
+        return
+
+    """
+    HLL.pack():
+    Switches the HLL to 6-bit packed storage (3 bytes per 4 registers), for long-term storage and transfer
+
+    Input: The HLL
+    """
+    def pack(self):
+        if not self.packed:
+            self.to_dense()
+            self.registers = pack_registers(self.registers)
+            self.packed = True
+        return
+
+    """
+    HLL.unpack():
+    Switches the HLL back to one byte per register
+
+    Input: The HLL
+    """
+    def unpack(self):
+        if self.packed:
+            self.registers = unpack_registers(self.registers, self.m)
+            self.packed = False
+        return
+
+    """
+    HLL.to_sparse():
+    Switches the HLL to sparse storage, a sorted array of (index, rank) entries for the nonzero registers
+    Stays dense if more than sparse_limit() registers are nonzero
+
+    Input: The HLL
+    """
+    def to_sparse(self):
+        if not self.sparse:
+            assert self.p <= SPARSE_MAX_P
+            registers = self.getRegisters()
+            if np.count_nonzero(registers) <= sparse_limit(self.m):
+                self.registers = dense_to_sparse(registers)
+                self.packed = False
+                self.sparse = True
+        return
+
+    """
+    HLL.to_dense():
+    Switches a sparse HLL to one byte per register
+
+    Input: The HLL
+    """
+    def to_dense(self):
+        if self.sparse:
+            self.registers = sparse_to_dense(self.registers, self.m)
+            self.sparse = False
+        return
+
+    """
+    HLL.nonzero_registers():
+    Returns the indices and values of the nonzero registers, without expanding a sparse HLL
+
+    Input: The HLL
+    Output: a sorted numpy intp array of register indices, a numpy uint8 array of their values
+    """
+    def nonzero_registers(self):
+        if self.sparse:
+            return (self.registers >> np.uint32(RANK_BITS)).astype(np.intp), (self.registers & RANK_MASK).astype(np.uint8)
+        registers = self.getRegisters()
+        idx = np.flatnonzero(registers)
+        return idx, registers[idx]
+
+# sparse entries are uint32 values (index << RANK_BITS) | rank, sorted by index
+# register values are at most q+1 <= 64 - SPARSE_MAX_P + 1, so they fit in RANK_BITS bits
+RANK_BITS = 6
+RANK_MASK = np.uint32((1 << RANK_BITS) - 1)
+SPARSE_MAX_P = 32 - RANK_BITS
+# sparse storage is used while it is smaller than the dense registers: 4 bytes per entry against 1 byte per register
+SPARSE_FRACTION = 0.25
+
+"""
+sparse_limit():
+The largest number of nonzero registers a sparse HLL with m registers keeps before it is converted to dense
+
+Input: m, the number of registers
+Output: an int
+"""
+def sparse_limit(m):
+    return int(m * SPARSE_FRACTION)
+
+"""
+dense_to_sparse():
+Converts registers to sparse entries
+
+Input: registers, a numpy uint8 array
+Output: a sorted numpy uint32 array with one entry per nonzero register
+"""
+def dense_to_sparse(registers):
+    idx = np.flatnonzero(registers).astype(np.uint32)
+    return (idx << np.uint32(RANK_BITS)) | registers[idx].astype(np.uint32)
+
+"""
+sparse_to_dense():
+Inverse of dense_to_sparse()
+
+Input: entries, a sorted numpy uint32 array of sparse entries; m, the number of registers
+Output: a numpy uint8 array of m register values
+"""
+def sparse_to_dense(entries, m):
+    registers = np.zeros(m, dtype=np.uint8)
+    registers[entries >> np.uint32(RANK_BITS)] = entries & RANK_MASK
+    return registers
+
+"""
+merge_sparse():
+Merges (index, rank) pairs into sparse entries, keeping the largest rank for each index
+
+Input: entries, a sorted numpy uint32 array of sparse entries; idx, ranks, arrays of register indices and ranks
+Output: a sorted numpy uint32 array of sparse entries
+"""
+def merge_sparse(entries, idx, ranks):
+    new = (np.asarray(idx).astype(np.uint32) << np.uint32(RANK_BITS)) | np.asarray(ranks).astype(np.uint32)
+    merged = np.concatenate((entries, new))
+    merged.sort()
+    # after sorting, the last entry of each index has the largest rank
+    index = merged >> np.uint32(RANK_BITS)
+    last = np.ones(len(merged), dtype=bool)
+    last[:-1] = index[1:] != index[:-1]
+    return merged[last & ((merged & RANK_MASK) > 0)]
+
+"""
+pack_registers():
+Packs register values into 6 bits each, every 4 registers become 3 bytes
+Register values are at most q+1, so this requires p >= 2
+
+Input: registers, a numpy uint8 array whose length is a multiple of 4
+Output: a numpy uint8 array of 3/4 the length
+"""
+def pack_registers(registers):
+    r = np.asarray(registers, dtype=np.uint32).reshape(-1, 4)
+    assert r.max(initial=0) < 64
+    v = (r[:, 0] << 18) | (r[:, 1] << 12) | (r[:, 2] << 6) | r[:, 3]
+    packed = np.empty((len(v), 3), dtype=np.uint8)
+    packed[:, 0] = v >> 16
+    packed[:, 1] = (v >> 8) & 0xFF
+    packed[:, 2] = v & 0xFF
+    return packed.reshape(-1)
+
+"""
+unpack_registers():
+Inverse of pack_registers()
+
+Input: packed, a numpy uint8 array from pack_registers(); m, the number of registers
+Output: a numpy uint8 array of m register values
+"""
+def unpack_registers(packed, m):
+    b = np.asarray(packed, dtype=np.uint32).reshape(-1, 3)
+    v = (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+    registers = np.empty((len(v), 4), dtype=np.uint8)
+    registers[:, 0] = v >> 18
+    registers[:, 1] = (v >> 12) & 0x3F
+    registers[:, 2] = (v >> 6) & 0x3F
+    registers[:, 3] = v & 0x3F
+    return registers.reshape(-1)[:m]
+
+"""
+fold_registers():
+Folds registers of precision p down to precision p_new, see HLL.reduce_precision()
+The 2^(p - p_new) registers folded into one are adjacent, so every sketch of a stack is folded at once
+
+Input: registers, a numpy uint8 array of 2^p registers, or an (n, 2^p) array of the registers of n sketches
+       p, the precision of the registers; p_new, the new precision (at most p)
+Output: a numpy uint8 array of 2^p_new registers, or an (n, 2^p_new) array
+"""
+def fold_registers(registers, p, p_new):
+    d = p - p_new
+    registers = np.asarray(registers, dtype=np.uint8)
+    groups = registers.reshape(registers.shape[:-1] + (2 ** p_new, 2 ** d))
+    # the first register of a group has no 1 in the dropped bits, the others have their first 1 at a fixed position
+    folded = np.where(groups[..., 0] > 0, groups[..., 0] + np.uint8(d), 0).astype(np.uint8)
+    if d > 0:
+        first_one = (d + 1 - bit_length(np.arange(1, 2 ** d, dtype=np.uint64))).astype(np.uint8)
+        np.maximum(folded, np.where(groups[..., 1:] > 0, first_one, 0).max(axis=-1).astype(np.uint8), out=folded)
+    return folded
+
+"""
+bit_length():
+Vectorized int.bit_length() for a numpy uint64 array, by binary search over the shift width
+
+Input: w, a numpy uint64 array
+Output: a numpy int64 array with the number of bits needed to represent each value
+"""
+def bit_length(w):
+    n = np.zeros(len(w), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = w >= np.uint64(1 << shift)
+        n += big * shift
+        w = w >> (big * np.uint64(shift))
+    return n + (w > 0)
+
 # Test basic HLL functionality
 def main(args):
     h = HLL(12)
     n = int(args[0])
 
-    for i in range(n):
-        h.insert(Rangen_jaccard.generate_random_string(50)) # probabilistically these are all distinct
+    h.insert_codes(Rangen_jaccard.generate_random_codes(n, 50)) # probabilistically these are all distinct
     print('Actual: {}\nRaw: {}\nMLE: {}'.format(n, h.simple_cardinality(), h.cardinality()))
 
 if __name__ == "__main__":
@@ -1,3 +1,5 @@
+import numpy as np
+
 
 """
 Hash.rshift32()
@@ -35,6 +37,135 @@ def hash64shift(key):
     key = (key + (key << 31)) % 0x10000000000000000
     return key
 
+"""
+Hash.hash64shift_array()
+Vectorized hash64shift() over a numpy uint64 array, numpy integer arithmetic wraps
+at 64 bits so no modulo is needed and the result is bit-identical to hash64shift()
+Input: A numpy array of values to be hashed
+Output: A numpy uint64 array of 64-bit hash values
+"""
+def hash64shift_array(keys):
+    key = np.asarray(keys, dtype=np.uint64)
+    key = (~key) + (key << np.uint64(21))  # key = (key << 21) - key - 1
+    key = key ^ (key >> np.uint64(24))
+    key = (key + (key << np.uint64(3))) + (key << np.uint64(8))  # key * 265
+    key = key ^ (key >> np.uint64(14))
+    key = (key + (key << np.uint64(2))) + (key << np.uint64(4))  # key * 21
+    key = key ^ (key >> np.uint64(28))
+    key = key + (key << np.uint64(31))
+    return key
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# Source: Austin Appleby, MurmurHash3
+# https://github.com/aappleby/smhasher/blob/master/src/MurmurHash3.cpp
+
+"""
+Hash.fmix64()
+MurmurHash3 64-bit finalizer, a multiply-xorshift mixer
+Input: The value to be hashed
+"""
+def fmix64(key):
+    key = key & MASK64
+    key = key ^ (key >> 33)
+    key = (key * 0xff51afd7ed558ccd) & MASK64
+    key = key ^ (key >> 33)
+    key = (key * 0xc4ceb9fe1a85ec53) & MASK64
+    key = key ^ (key >> 33)
+    return key
+
+"""
+Hash.fmix64_array()
+Vectorized fmix64() over a numpy uint64 array, bit-identical to fmix64()
+Input: A numpy array of values to be hashed
+Output: A numpy uint64 array of 64-bit hash values
+"""
+def fmix64_array(keys):
+    key = np.asarray(keys, dtype=np.uint64)
+    key = key ^ (key >> np.uint64(33))
+    key = key * np.uint64(0xff51afd7ed558ccd)
+    key = key ^ (key >> np.uint64(33))
+    key = key * np.uint64(0xc4ceb9fe1a85ec53)
+    key = key ^ (key >> np.uint64(33))
+    return key
+
+# Source: Yann Collet, xxHash
+# https://github.com/Cyan4973/xxHash/blob/dev/doc/xxhash_spec.md
+
+XXH_PRIME64_1 = 0x9E3779B185EBCA87
+XXH_PRIME64_2 = 0xC2B2AE3D27D4EB4F
+XXH_PRIME64_3 = 0x165667B19E3779F9
+XXH_PRIME64_4 = 0x85EBCA77C2B2AE63
+XXH_PRIME64_5 = 0x27D4EB2F165667C5
+
+"""
+Hash.xxhash64()
+xxHash64 (seed 0) of a single 64-bit value taken as 8 little-endian bytes:
+one lane round, the 8-byte tail step and the final avalanche
+Input: The value to be hashed
+"""
+def xxhash64(key):
+    key = key & MASK64
+    h = (XXH_PRIME64_5 + 8) & MASK64
+
+    lane = (key * XXH_PRIME64_2) & MASK64
+    lane = ((lane << 31) | (lane >> 33)) & MASK64
+    lane = (lane * XXH_PRIME64_1) & MASK64
+    h = h ^ lane
+    h = ((h << 27) | (h >> 37)) & MASK64
+    h = (h * XXH_PRIME64_1 + XXH_PRIME64_4) & MASK64
+
+    h = h ^ (h >> 33)
+    h = (h * XXH_PRIME64_2) & MASK64
+    h = h ^ (h >> 29)
+    h = (h * XXH_PRIME64_3) & MASK64
+    h = h ^ (h >> 32)
+    return h
+
+"""
+Hash.xxhash64_array()
+Vectorized xxhash64() over a numpy uint64 array, bit-identical to xxhash64()
+Input: A numpy array of values to be hashed
+Output: A numpy uint64 array of 64-bit hash values
+"""
+def xxhash64_array(keys):
+    key = np.asarray(keys, dtype=np.uint64)
+    h = np.uint64((XXH_PRIME64_5 + 8) & MASK64)
+
+    lane = key * np.uint64(XXH_PRIME64_2)
+    lane = (lane << np.uint64(31)) | (lane >> np.uint64(33))
+    lane = lane * np.uint64(XXH_PRIME64_1)
+    h = h ^ lane
+    h = (h << np.uint64(27)) | (h >> np.uint64(37))
+    h = h * np.uint64(XXH_PRIME64_1) + np.uint64(XXH_PRIME64_4)
+
+    h = h ^ (h >> np.uint64(33))
+    h = h * np.uint64(XXH_PRIME64_2)
+    h = h ^ (h >> np.uint64(29))
+    h = h * np.uint64(XXH_PRIME64_3)
+    h = h ^ (h >> np.uint64(32))
+    return h
+
+# hash functions that HLLs can be built with, name: (scalar function, vectorized function)
+# sketches built with different hash functions cannot be compared or merged
+HASHES = {
+    'wang64': (hash64shift, hash64shift_array),
+    'murmur3': (fmix64, fmix64_array),
+    'xxhash64': (xxhash64, xxhash64_array),
+}
+DEFAULT_HASH = 'wang64'
+
+"""
+Hash.get_hash()
+Looks up a hash function by name
+Input: The name of the hash function, a key of HASHES
+Output: The scalar and vectorized implementations
+"""
+def get_hash(name):
+    if name not in HASHES:
+        raise ValueError('Unknown hash function {}, expected one of {}'.format(name, ', '.join(HASHES)))
+    return HASHES[name]
+
 """
 Hash.hash32shift()
 Creates a 32-bit hash value, uniform hashing function
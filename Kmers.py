@@ -0,0 +1,101 @@
+"""
+Kmers.py: 2-bit encoding and k-mer extraction for batched HLL insertion
+
+Bases are encoded as A=0, C=1, G=2, T=3 (the same base 4 digits HLL.insert() uses),
+so a k-mer of up to 32 bases packs into a single uint64 code.
+"""
+import numpy as np
+
+# lookup table from ASCII byte to 2-bit base code, anything that is not ACGT maps to INVALID
+INVALID = 4
+BASE_CODES = np.full(256, INVALID, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = code
+    BASE_CODES[ord(base.lower())] = code
+
+"""
+Kmers.encode():
+Converts a read to an array of 2-bit base codes
+
+Input: read, a string of bases
+Output: a numpy uint8 array with one entry per base (INVALID for non-ACGT characters)
+"""
+def encode(read):
+    return BASE_CODES[np.frombuffer(read.encode('ascii'), dtype=np.uint8)]
+
+"""
+Kmers.encode_reads():
+Concatenates reads into a single array of base codes, separated by an INVALID entry
+so that no k-mer spans two reads
+
+Input: reads, a string or an iterable of strings
+Output: a numpy uint8 array of base codes
+"""
+def encode_reads(reads):
+    if isinstance(reads, str):
+        return encode(reads)
+    return encode('\0'.join(reads))
+
+"""
+Kmers.window_codes():
+Computes the base 4 value of every window of k bases, and of its reverse complement
+Windows of length 1, 2, 4, ... are built by doubling and the binary digits of k combined,
+so only O(log k) array passes are needed rather than one per base
+
+Input: digits, a numpy uint64 array of 2-bit base codes; k, the window length (at most 32)
+Output: forward and reverse_complement, numpy uint64 arrays with len(digits)-k+1 entries
+"""
+def window_codes(digits, k):
+    N = len(digits)
+    forward = reverse = None
+    length = 0
+
+    # codes of every window of the current width, the reverse complement reads the window backwards
+    block_forward = digits
+    block_reverse = np.uint64(3) - digits
+    width = 1
+    while width <= k:
+        if k & width:
+            count = N - (length + width) + 1
+            if forward is None:
+                forward = block_forward[:count]
+                reverse = block_reverse[:count]
+            else:
+                # append the window of this width that starts where the current windows end
+                forward = (forward[:count] << np.uint64(2*width)) | block_forward[length:length+count]
+                reverse = (block_reverse[length:length+count] << np.uint64(2*length)) | reverse[:count]
+            length += width
+
+        if 2*width <= k:
+            count = N - 2*width + 1
+            block_forward = (block_forward[:count] << np.uint64(2*width)) | block_forward[width:width+count]
+            block_reverse = (block_reverse[width:width+count] << np.uint64(2*width)) | block_reverse[:count]
+        width *= 2
+
+    return forward, reverse
+
+"""
+Kmers.kmer_codes():
+Computes the uint64 code of every k-mer in an array of base codes
+K-mers containing a non-ACGT character are skipped
+
+Input: bases, an array from encode() or encode_reads(); k, the k-mer length (at most 32)
+       canonical, if True each k-mer is replaced by the smaller of its code and its reverse complement's code,
+       so a read and its reverse complement give the same k-mers
+Output: a numpy uint64 array with the base 4 value of each valid k-mer, in order
+"""
+def kmer_codes(bases, k, canonical=False):
+    assert 0 < k <= 32
+    n = len(bases) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    digits = bases.astype(np.uint64) & np.uint64(3)
+    codes, reverse = window_codes(digits, k)
+    if canonical:
+        codes = np.minimum(codes, reverse)
+
+    # a window is valid if it contains no INVALID entries
+    invalid = np.concatenate(([0], np.cumsum(bases == INVALID)))
+    valid = invalid[k:] == invalid[:n]
+    return codes[valid]
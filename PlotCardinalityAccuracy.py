@@ -3,7 +3,9 @@ from Random_Generators import Rangen_jaccard
 
 import numpy as np
 import matplotlib.pyplot as plt
-import sys
+import argparse
+import os
+import AccuracySweep
 
 """
 PlotCardinalityAccuracy.main():
@@ -24,9 +26,8 @@ def main(num_cards, base_start, base_stop, num_trials, read_length):
         results = np.zeros(num_trials)
         for j in range(num_trials):
             h = HLL(12)
-            for k in range(card):
-                # Generates a random sequence of length read_length and inserts it into HLL
-                h.insert(Rangen_jaccard.generate_random_string(read_length))
+            # Generates card random reads of length read_length as codes and inserts them into HLL
+            h.insert_codes(Rangen_jaccard.generate_random_codes(card, read_length))
 
             obs_cardinality = h.cardinality()  # Retrieves the cardinality
 
@@ -46,10 +47,24 @@ def main(num_cards, base_start, base_stop, num_trials, read_length):
 
 if (__name__ == '__main__'):
     # Hyperparameters used for this project: num_c = 80, card_s = 1, card_sp = 6.7, num_t = 10, read_length = 40
-    num_c = int(sys.argv[1])
-    card_s = float(sys.argv[2])
-    card_sp = float(sys.argv[3])
-    num_t = int(sys.argv[4])
+    # With --out DIR the sweep runs on --jobs processes through AccuracySweep.run_sweep(), checkpointing to DIR
+    parser = argparse.ArgumentParser(description='Cardinality accuracy over a logspace of cardinalities')
+    parser.add_argument('num_c', type=int)
+    parser.add_argument('card_s', type=float)
+    parser.add_argument('card_sp', type=float)
+    parser.add_argument('num_t', type=int)
+    parser.add_argument('--out', help='output directory of a parallel, resumable sweep')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='processes of the sweep (default all CPUs)')
+    parser.add_argument('--seed', type=int, default=0, help='base seed of the sweep cells (default 0)')
+    parser.add_argument('--png', action='store_true', help='save the plot of the sweep as DIR/plot.png')
+    args = parser.parse_args()
     read_length = 40
-    print(num_c, card_s, card_sp, num_t, read_length)
-    main(num_c, card_s, card_sp, num_t, read_length)
+    print(args.num_c, args.card_s, args.card_sp, args.num_t, read_length)
+    if args.out is None:
+        main(args.num_c, args.card_s, args.card_sp, args.num_t, read_length)
+    else:
+        cardinalities, errors = AccuracySweep.run_sweep(args.out, 'cardinality', args.num_c, args.card_s, args.card_sp,
+                                                        args.num_t, seed=args.seed, workers=args.jobs, png=args.png,
+                                                        title='Cardinality Accuracy')
+        print('Mean Errors:')
+        print(errors.mean(axis=1))
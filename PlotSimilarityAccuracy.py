@@ -2,7 +2,9 @@ from HLL import HLL
 import Similarity
 from Random_Generators import Rangen_jaccard, Rangen_forbes, Rangen_sorensen_dice
 
-import sys
+import argparse
+import os
+import AccuracySweep
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -38,12 +40,10 @@ def intersection(num_cards, base_start, base_stop, num_trials, exp_jaccard, read
         for j in range(num_trials):
             h1 = HLL(12)
             h2 = HLL(12)
-            # Random read (length 40) generator based on the cardinalities and the expected Jaccard value
-            a, b, exp_jaccard, forbes, sd = Rangen_jaccard.generate_reads(exp_jaccard, card, card, read_lengths)
-            for s in a:
-                h1.insert(s)
-            for s in b:
-                h2.insert(s)
+            # Random read (length 40) code generator based on the cardinalities and the expected Jaccard value
+            a, b, exp_jaccard, forbes, sd = Rangen_jaccard.generate_codes(exp_jaccard, card, card, read_lengths)
+            h1.insert_codes(a)
+            h2.insert_codes(b)
             intersection = Similarity.intersection(h1,h2) # Calculation of the intersection between 2 HLLs
             num_overlapped = math.ceil(0.02 * (card * 2) / (0.02 + 1)) # Calculation of the expected intersection based on the Jaccard formula
             error = 100 * (intersection - num_overlapped) / num_overlapped  # Percent error calculation
@@ -79,11 +79,9 @@ def jaccard(num_cards, base_start, base_stop, num_trials, exp_jaccard, read_leng
             h1 = HLL(12)
             h2 = HLL(12)
             # Generate reads of length 40 based on the expected Jaccard, 0.02
-            a, b, exp_jaccard, forbes, sd = Rangen_jaccard.generate_reads(exp_jaccard, card, card, read_lengths)
-            for s in a:
-                h1.insert(s)
-            for s in b:
-                h2.insert(s)
+            a, b, exp_jaccard, forbes, sd = Rangen_jaccard.generate_codes(exp_jaccard, card, card, read_lengths)
+            h1.insert_codes(a)
+            h2.insert_codes(b)
             # Union and intersection calculations for Jaccard calculations
             union = Similarity.union(h1,h2).cardinality()
             intersection = Similarity.intersection(h1,h2)
@@ -122,11 +120,9 @@ def forbes(num_cards, base_start, base_stop, num_trials, exp_forbes, read_length
             h1 = HLL(12)
             h2 = HLL(12)
             # Generate reads of length 40 based on the expected Forbes, 0.1
-            a,b,exp_forbes = Rangen_forbes.generate_reads(exp_forbes, card, card, read_lengths)
-            for s in a:
-                h1.insert(s)
-            for s in b:
-                h2.insert(s)
+            a,b,exp_forbes = Rangen_forbes.generate_codes(exp_forbes, card, card, read_lengths)
+            h1.insert_codes(a)
+            h2.insert_codes(b)
             union = Similarity.union(h1,h2).cardinality()
             intersection = Similarity.intersection(h1,h2)
             b_size, c_size, a_size = Similarity.getJointEstimators(h1, h2)
@@ -165,11 +161,9 @@ def sd(num_cards, base_start, base_stop, num_trials, exp_sd, read_lengths):
             h1 = HLL(12)
             h2 = HLL(12)
             # Generate reads of length 40 based on the expected Sorensen-Dice, 0.04
-            a,b,exp_sd = Rangen_sorensen_dice.generate_reads(exp_sd, card, card, read_lengths)
-            for s in a:
-                h1.insert(s)
-            for s in b:
-                h2.insert(s)
+            a,b,exp_sd = Rangen_sorensen_dice.generate_codes(exp_sd, card, card, read_lengths)
+            h1.insert_codes(a)
+            h2.insert_codes(b)
             # Calculation of intersection between two HLLs, necessary for SD calculation
             intersection = Similarity.intersection(h1,h2)
             obs_sd = 2 * intersection / (h1.cardinality() + h2.cardinality()) # Calculation of expected Sorensen-Dice
@@ -208,12 +202,27 @@ if (__name__ == '__main__'):
     # Intersection and Jaccard: exp_const = 0.02, read_lengths = 40
     # Forbes: exp_const = 0.1, read_lengths = 40
     # Sorensen-Dice: exp_const = 0.04, read_lengths = 40
-    arg = sys.argv[1]
-    num_c = int(sys.argv[2])
-    card_s = float(sys.argv[3])
-    card_sp = float(sys.argv[4])
-    num_t = int(sys.argv[5])
-    exp_const = float(sys.argv[6])
+    # With --out DIR the sweep runs on --jobs processes through AccuracySweep.run_sweep(), checkpointing to DIR
+    parser = argparse.ArgumentParser(description='Similarity accuracy over a logspace of cardinalities')
+    parser.add_argument('arg', choices=['intersection', 'jaccard', 'forbes', 'sd'])
+    parser.add_argument('num_c', type=int)
+    parser.add_argument('card_s', type=float)
+    parser.add_argument('card_sp', type=float)
+    parser.add_argument('num_t', type=int)
+    parser.add_argument('exp_const', type=float)
+    parser.add_argument('--out', help='output directory of a parallel, resumable sweep')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='processes of the sweep (default all CPUs)')
+    parser.add_argument('--seed', type=int, default=0, help='base seed of the sweep cells (default 0)')
+    parser.add_argument('--png', action='store_true', help='save the plot of the sweep as DIR/plot.png')
+    args = parser.parse_args()
     read_lengths = 40
-    print(arg, num_c, card_s, num_t, exp_const, read_lengths)
-    main(arg, num_c, card_s, card_sp, num_t, exp_const, read_lengths)
+    print(args.arg, args.num_c, args.card_s, args.num_t, args.exp_const, read_lengths)
+    if args.out is None:
+        main(args.arg, args.num_c, args.card_s, args.card_sp, args.num_t, args.exp_const, read_lengths)
+    else:
+        cardinalities, errors = AccuracySweep.run_sweep(args.out, args.arg, args.num_c, args.card_s, args.card_sp,
+                                                        args.num_t, target=args.exp_const, seed=args.seed,
+                                                        workers=args.jobs, png=args.png,
+                                                        title='{} Accuracy, expected {}'.format(args.arg.capitalize(), args.exp_const))
+        print('Mean Errors:')
+        print(errors.mean(axis=1))
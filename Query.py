@@ -0,0 +1,415 @@
+"""
+Query.py: Top-k nearest references to a query sketch
+
+Usage: python Query.py QUERY REFERENCES [-n N] [--measure jaccard|sd|forbes]
+
+       QUERY is a FASTA/FASTQ file (sketched with the references' k, canonical flag, p and hash function)
+       or a sketch file, whose first sketch is used
+       -k and --canonical may be given for references that do not record them, and must agree with those that do
+       REFERENCES is a sketch file or a sketch database directory (see SketchDatabase.py)
+
+Instead of estimating the similarity of the query to every reference with the joint MLE, every reference is
+first given an upper bound on its similarity, from two batched cardinality estimates over all its registers:
+    the register-wise maximum of the query and the reference is the HLL of their union
+    the register-wise minimum has every register at least as high as the HLL of their intersection would, so its
+    estimate bounds the intersection from above (as do the cardinalities of the two sets)
+Jaccard is then at most min(|A n B|, |A|, |B|) / |A u B|, which is at most min(|A|, |B|) / max(|A|, |B|), and
+Sorensen-Dice at most 2 min(|A n B|, |A|, |B|) / (|A| + |B|). References are estimated with the joint MLE in order
+of decreasing upper bound, stopping once no remaining reference can beat the k-th best estimate, so the results
+are those of estimating every reference. The bounds are raised by BOUND_TOLERANCE to allow for the tolerance of
+the joint MLE.
+The bounds only prune references that are far from the query while the k-th best match is close to it. When every
+reference is unrelated to the query, its k best matches are near 0 and nearly every reference is estimated.
+The Forbes coefficient is not bounded by the cardinalities: it is 1 whenever one set is contained in the other,
+however small, and a bound from the register-wise minimum does not carry over to the joint MLE's estimates of
+the exclusive parts of A and B it uses. Forbes queries therefore estimate every reference.
+"""
+import argparse
+import os
+import numpy as np
+from multiprocessing import shared_memory
+import Cardinality
+import HLL as HLL_module
+import SimilarityMatrix
+import SketchCodec
+import SketchDatabase
+import SketchFile
+import Sketching
+
+MEASURES = ('jaccard', 'sd', 'forbes')
+
+# the joint MLE is solved to about 1e-6 of the union (see Similarity.newton_joint_mle()), upper bounds are raised by
+# ten times that so a reference is never skipped for the tolerance of its estimate
+BOUND_TOLERANCE = 1e-5
+
+"""
+Query.similarity_upper_bounds():
+Upper bounds of a similarity measure from the cardinalities of two sets and of their union and an upper bound of
+their intersection, see the module docstring
+
+Input: measure, one of MEASURES; a, b, the cardinalities of the sets; union, the cardinality of their union
+       intersection, an upper bound of the intersection (all arrays of the same length)
+Output: an array of upper bounds in [0, 1]; 1 for Forbes, which they do not bound
+"""
+def similarity_upper_bounds(measure, a, b, union, intersection):
+    intersection = np.minimum(intersection, np.minimum(a, b))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if measure == 'jaccard':
+            high = intersection / union
+        elif measure == 'sd':
+            high = 2*intersection / (a + b)
+        else:
+            high = np.ones(len(union))
+    return np.clip(np.nan_to_num(high, nan=1) + BOUND_TOLERANCE, 0, 1)
+
+
+class ReferenceIndex:
+    """Stacked registers and cardinalities of a collection of reference sketches"""
+
+    def __init__(self, registers, names, p, hash_name, block_size=256, k=None, canonical=None):
+        # registers is an (n, m) array of unpacked registers, e.g. from SimilarityMatrix.stack_registers()
+        # k and canonical are how the references were sketched, None where that is not known
+        self.registers = registers
+        self.k = k
+        self.canonical = canonical
+        self.names = list(names)
+        self.p = p
+        self.q = 64 - p
+        self.m = 2 ** p
+        self.hash_name = hash_name
+        self.block_size = block_size
+        assert registers.shape == (len(self.names), self.m)
+
+        # multiplicity histograms and cardinalities of the sketches are computed once
+        self.multiplicities = self.histograms(registers)
+        self.cardinalities = Cardinality.estimateCardinalities(self.multiplicities)
+
+    def __len__(self):
+        return len(self.names)
+
+    """
+    ReferenceIndex.histograms():
+    Multiplicity histograms of the rows of a register array, block_size rows at a time
+    so the bincount keys of SimilarityMatrix.multiplicities() stay small
+
+    Input: registers, an (n, m') register array
+    Output: an (n, q+2) array of counts
+    """
+    def histograms(self, registers):
+        counts = np.zeros((len(registers), self.q+2), dtype=np.int64)
+        for start in range(0, len(registers), self.block_size):
+            counts[start:start+self.block_size] = SimilarityMatrix.multiplicities(registers[start:start+self.block_size], self.q)
+        return counts
+
+    """
+    ReferenceIndex.combined_histograms():
+    Multiplicity histograms of the register-wise maximum and minimum of a query with every row of a register array
+    Both come from one bincount per block, of the pairs (minimum, maximum) of every register: the histogram of the
+    maxima sums these counts over the minima and the other way round, which costs less than two passes
+
+    Input: registers, an (n, m) register array; query, an array of m registers
+    Output: the (n, q+2) histograms of the maxima and of the minima
+    """
+    def combined_histograms(self, registers, query):
+        maxima = np.zeros((len(registers), self.q+2), dtype=np.int64)
+        minima = np.zeros((len(registers), self.q+2), dtype=np.int64)
+        for start in range(0, len(registers), self.block_size):
+            block = registers[start:start+self.block_size]
+            # register values above the highest one in the block have no counts, leaving them out keeps the keys few
+            top = max(int(block.max(initial=0)), int(query.max(initial=0))) + 1
+            keys = np.minimum(block, query).astype(np.intp)
+            keys *= top
+            keys += np.maximum(block, query)
+            keys += top * top * np.arange(len(block))[:, None]
+            pairs = np.bincount(keys.ravel(), minlength=len(block) * top * top).reshape(len(block), top, top)
+            maxima[start:start+len(block), :top] = pairs.sum(axis=1)
+            minima[start:start+len(block), :top] = pairs.sum(axis=2)
+        return maxima, minima
+
+    """
+    ReferenceIndex.estimate():
+    Batched cardinality estimates of the rows of a register array, see histograms()
+    """
+    def estimate(self, registers):
+        return Cardinality.estimateCardinalities(self.histograms(registers))
+
+    """
+    ReferenceIndex.from_sketches():
+    Builds an index from a list of compatible HLLs and their names
+    """
+    @staticmethod
+    def from_sketches(sketches, names, **kwargs):
+        registers = SimilarityMatrix.stack_registers(sketches)
+        return ReferenceIndex(registers, names, sketches[0].p, sketches[0].hash_name, **kwargs)
+
+    """
+    ReferenceIndex.from_path():
+    Builds an index from a sketch file (plain or compressed) or a sketch database directory
+    """
+    @staticmethod
+    def from_path(path, **kwargs):
+        if os.path.isdir(path):
+            database = SketchDatabase.SketchDatabase(path)
+            names = database.names()
+            return ReferenceIndex.from_sketches([database.get(name) for name in names], names, k=database.k,
+                                                canonical=database.canonical, **kwargs)
+        if SketchCodec.is_compressed_file(path):
+            registers, names, reader = SketchCodec.read_registers(path)
+            return ReferenceIndex(registers, names, reader.p, reader.hash_name, k=reader.k, canonical=reader.canonical,
+                                  **kwargs)
+
+        sketch_file = SketchFile.SketchFile(path)
+        m = 2 ** sketch_file.p
+        if sketch_file.packed:
+            registers = HLL_module.unpack_registers(sketch_file.blocks.ravel(), len(sketch_file) * m).reshape(-1, m)
+        else:
+            registers = np.array(sketch_file.blocks)
+        return ReferenceIndex(registers, sketch_file.names(), sketch_file.p, sketch_file.hash_name, k=sketch_file.k,
+                              canonical=sketch_file.canonical, **kwargs)
+
+    """
+    ReferenceIndex.share():
+    Copies the arrays of the index (registers, multiplicity histograms and cardinalities) into one block of
+    shared memory, so worker processes can attach to the index with attach() instead of loading and building it again
+
+    Output: the SharedMemory block, which the caller closes and unlinks once the workers are done with it
+            the state to pass to attach(): the block's name, the offset, shape and dtype of every array,
+            and the other attributes
+    """
+    def share(self):
+        attributes = {name: value for name, value in vars(self).items()
+                      if not isinstance(value, np.ndarray) and name != 'shared_memory'}
+        layout = {}
+        size = 0
+        for name, value in vars(self).items():
+            if isinstance(value, np.ndarray):
+                layout[name] = (size, value.shape, value.dtype.str)
+                # every array starts on a cache line
+                size += -(-value.nbytes // 64) * 64
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            for name, (offset, shape, dtype) in layout.items():
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = getattr(self, name)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        return shm, (shm.name, layout, attributes)
+
+    """
+    ReferenceIndex.attach():
+    The index shared by share(), with read-only arrays backed by its shared memory block
+    The block stays mapped as long as the index exists; only the process that called share() unlinks it
+    """
+    @staticmethod
+    def attach(state):
+        name, layout, attributes = state
+        shm = shared_memory.SharedMemory(name=name)
+        index = ReferenceIndex.__new__(ReferenceIndex)
+        vars(index).update(attributes)
+        for key, (offset, shape, dtype) in layout.items():
+            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            array.flags.writeable = False
+            setattr(index, key, array)
+        index.shared_memory = shm
+        return index
+
+    """
+    ReferenceIndex.sketch_options():
+    The k-mer length and canonical flag to sketch queries with, so their k-mers match the references'
+    Values recorded with the references are used unless given; given values must agree with recorded ones
+
+    Input: k, canonical, the values requested for the queries, None for the references' own
+    Output: k, canonical (25 and False where neither is known)
+    """
+    def sketch_options(self, k=None, canonical=None):
+        if k is not None and self.k is not None and k != self.k:
+            raise ValueError('References were sketched with k = {}, not k = {}'.format(self.k, k))
+        if canonical is not None and self.canonical is not None and canonical != self.canonical:
+            raise ValueError('References were sketched {} canonical k-mers'.format('with' if self.canonical else 'without'))
+        k = k if k is not None else (self.k if self.k is not None else 25)
+        canonical = canonical if canonical is not None else bool(self.canonical)
+        return k, canonical
+
+    """
+    ReferenceIndex.reduce_precision():
+    Folds every reference down to precision p (see HLL.reduce_precision()), e.g. to compare them to a query
+    sketched at a lower precision or for a cheaper screening pass
+
+    Input: p, the new precision (at most the index's precision); keyword arguments of the new ReferenceIndex
+    Output: a new ReferenceIndex
+    """
+    def reduce_precision(self, p, **kwargs):
+        if not 0 < p <= self.p:
+            raise ValueError('Cannot reduce references with precision {} to precision {}'.format(self.p, p))
+        kwargs.setdefault('block_size', self.block_size)
+        kwargs.setdefault('k', self.k)
+        kwargs.setdefault('canonical', self.canonical)
+        registers = HLL_module.fold_registers(self.registers, self.p, p)
+        return ReferenceIndex(registers, self.names, p, self.hash_name, **kwargs)
+
+    """
+    ReferenceIndex.bounds():
+    Upper bounds of the similarity of the query to every reference, see the module docstring
+
+    Input: hll, the query HLL; measure, one of MEASURES
+           references, indices of the references to bound (default all)
+    Output: the upper bounds, an array with one value per reference
+            the cardinality of the query
+    """
+    def bounds(self, hll, measure='jaccard', references=None):
+        if references is None:
+            references = slice(None)
+        query = hll.getRegisters()
+        a = self.estimate(query[None])[0]
+        b = self.cardinalities[references]
+        if measure == 'forbes':
+            return np.ones(len(b)), a
+        registers = self.registers[references]
+        maxima, minima = self.combined_histograms(registers, query)
+        union = Cardinality.estimateCardinalities(maxima)
+        intersection = Cardinality.estimateCardinalities(minima)
+        return similarity_upper_bounds(measure, a, b, union, intersection), a
+
+    """
+    ReferenceIndex.query():
+    Finds the references most similar to a query sketch, see query_batch()
+
+    Input: hll, the query HLL, built with the references' hash function and folded down if its precision is higher
+           k, the number of references to return
+           measure, one of MEASURES
+           block_size, the number of references estimated with the joint MLE at once
+           references, indices of the only references to consider, e.g. from SketchIndex.candidates() (default all)
+    Output: a list of up to k (name, similarity) pairs, most similar first
+            the number of references estimated with the joint MLE
+    """
+    def query(self, hll, k=10, measure='jaccard', block_size=256, references=None):
+        return self.query_batch([hll], k, measure, block_size, references)[0]
+
+    """
+    ReferenceIndex.query_batch():
+    Finds the references most similar to each of several query sketches
+    Every query is bounded and its candidates ordered on its own, then the joint MLE runs in rounds: each query
+    still in the running adds its next block_size candidates, and the pairs of all queries are estimated together
+    by one SimilarityMatrix.pair_similarities() call. A query drops out once none of its remaining candidates
+    can beat its k-th best estimate, so each query gets the same results as on its own.
+
+    Input: hlls, a list of query HLLs, as in query(); k and measure, one value for every query or a list
+           with one per query; block_size, references, as in query()
+    Output: a list with one (results, estimated) pair per query, as returned by query()
+    """
+    def query_batch(self, hlls, k=10, measure='jaccard', block_size=256, references=None):
+        ks = np.broadcast_to(k, len(hlls))
+        measures = np.broadcast_to(np.asarray(measure, dtype=object), len(hlls))
+        if references is None:
+            references = np.arange(len(self))
+        queries = []
+        for hll, measure in zip(hlls, measures):
+            if measure not in MEASURES:
+                raise ValueError('Unknown measure {}, expected one of {}'.format(measure, ', '.join(MEASURES)))
+            if hll.p > self.p:
+                hll = hll.reduce_precision(self.p)
+            if hll.p != self.p or hll.hash_name != self.hash_name:
+                raise ValueError('Cannot compare a query with p = {} and hash {} to references with p = {} and hash {}'.format(
+                    hll.p, hll.hash_name, self.p, self.hash_name))
+            queries.append(hll)
+
+        # candidates of each query, by decreasing upper bound, and the cardinality of the query
+        candidates, highs, sizes = [], [], []
+        for hll, k, measure in zip(queries, ks, measures):
+            if len(references) == 0 or k <= 0:
+                candidates.append(references[:0])
+                highs.append(np.zeros(0))
+                sizes.append(0.0)
+                continue
+            high, a = self.bounds(hll, measure, references)
+            order = np.argsort(-high, kind='stable')
+            candidates.append(references[order])
+            highs.append(high[order])
+            sizes.append(a)
+
+        query_registers = np.stack([hll.getRegisters() for hll in queries]) if queries else np.zeros((0, self.m), np.uint8)
+        found = [np.zeros(0, dtype=np.intp) for _ in queries]
+        values = [np.zeros(0) for _ in queries]
+        start = 0
+        active = list(range(len(queries)))
+        while active:
+            still_active, rows, cols = [], [], []
+            for i in active:
+                k = ks[i]
+                if start >= len(candidates[i]):
+                    continue
+                if len(values[i]) >= k and highs[i][start] < np.partition(values[i], -k)[-k]:
+                    continue
+                block = candidates[i][start:start+block_size]
+                still_active.append(i)
+                rows.append(np.full(len(block), i, dtype=np.intp))
+                cols.append(block)
+            active = still_active
+            if not active:
+                break
+            start += block_size
+
+            # rows 0..len(queries)-1 are the queries, followed by the references of this round
+            needed = np.unique(np.concatenate(cols))
+            registers = np.concatenate([query_registers, self.registers[needed]])
+            cardinalities = np.concatenate([sizes, self.cardinalities[needed]])
+            similarities = SimilarityMatrix.pair_similarities(
+                registers, cardinalities, np.concatenate(rows), len(queries) + np.searchsorted(needed, np.concatenate(cols)),
+                self.q, block_size=block_size)
+            offset = 0
+            for i, block in zip(active, cols):
+                column = MEASURES.index(measures[i])
+                found[i] = np.concatenate([found[i], block])
+                values[i] = np.concatenate([values[i], np.nan_to_num(similarities[column][offset:offset+len(block)])])
+                offset += len(block)
+
+        results = []
+        for i in range(len(queries)):
+            top = np.argsort(-values[i], kind='stable')[:ks[i]]
+            results.append(([(self.names[found[i][j]], float(values[i][j])) for j in top], len(found[i])))
+        return results
+
+"""
+main()
+
+Prints the top-k references for a query FASTA/FASTQ or sketch file
+"""
+def main():
+    parser = argparse.ArgumentParser(description='Top-k most similar reference genomes to a query')
+    parser.add_argument('query', help='FASTA/FASTQ file or sketch file of the query')
+    parser.add_argument('references', help='sketch file or sketch database directory of the references')
+    parser.add_argument('-n', type=int, default=10, help='number of references to report (default 10)')
+    parser.add_argument('--measure', default='jaccard', choices=MEASURES, help='similarity measure (default jaccard)')
+    parser.add_argument('-k', type=int,
+                        help="k-mer length used to sketch a FASTA/FASTQ query (default: the references' k)")
+    parser.add_argument('--canonical', action='store_const', const=True,
+                        help='sketch a FASTA/FASTQ query from canonical k-mers (default: as the references were)')
+    args = parser.parse_args()
+
+    index = ReferenceIndex.from_path(args.references)
+    try:
+        if SketchFile.is_sketch_file(args.query):
+            sketch_file = SketchFile.SketchFile(args.query)
+            index.sketch_options(sketch_file.k, sketch_file.canonical)
+            hll = sketch_file[0]
+        elif SketchCodec.is_compressed_file(args.query):
+            sketches, _, reader = SketchCodec.read_registers(args.query)
+            index.sketch_options(reader.k, reader.canonical)
+            hll = HLL_module.HLL(reader.p, sketches[0], hash_name=reader.hash_name)
+        else:
+            k, canonical = index.sketch_options(args.k, args.canonical)
+            registers = Sketching.sketch_file(args.query, k, index.p, canonical, index.hash_name)
+            hll = HLL_module.HLL(index.p, registers, hash_name=index.hash_name)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if hll.p < index.p:
+        index = index.reduce_precision(hll.p)
+    results, estimated = index.query(hll, args.n, args.measure)
+    for rank, (name, similarity) in enumerate(results, 1):
+        print('{}\t{}\t{:.6f}'.format(rank, name, similarity))
+    print('Estimated {} of {} references with the joint MLE'.format(estimated, len(index)))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 import sys
 import math
 import random
+import numpy as np
+
+# ASCII codes of the bases, indexed by 2-bit base code
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
 
 # Function that takes in command line arguments and
 # parses it while assertin that they are correct
@@ -18,21 +22,35 @@ def variable_assertions(argv):
 
 # Function that generates random strings given a read length
 def generate_random_string(read_length):
-    ACGT = "ACGT"
-    string = ""
-
-    for i in range(read_length):
-        string += random.choice(ACGT)
-        
-    return string
+    return "".join(random.choices("ACGT", k=read_length))
+
+# Function that generates n random strings of a read length at once
+def generate_random_strings(n, read_length, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    bases = BASES[rng.integers(0, 4, (n, read_length), dtype=np.uint8)]
+    return [s.decode("ascii") for s in bases.view("S" + str(read_length)).ravel()]
+
+# Function that generates n random reads at once as 2-bit packed uint64 codes
+# (A=0, C=1, G=2, T=3, first base in the high bits), the value HLL.insert()
+# hashes for a read string. Hashing only keeps the low 64 bits, which are the
+# last 32 bases, so longer reads are drawn as their last 32 bases
+def generate_random_codes(n, read_length, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    return rng.integers(0, 1 << (2 * min(read_length, 32)), n, dtype=np.uint64, endpoint=False)
+
+# Function that gives the number of reads shared by sets A and B for a Jaccard value
+def overlapped_reads(jaccard_val, num_reads_a, num_reads_b):
+    return math.ceil(jaccard_val * (num_reads_a + num_reads_b) / (jaccard_val + 1))
 
 # Function that generates set A and B given command line arguments
-def generate_reads(jaccard_val, num_reads_a, num_reads_b, read_length):
+def generate_reads(jaccard_val, num_reads_a, num_reads_b, read_length, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
     # Instantiate key variables
     total_reads = num_reads_a + num_reads_b
-    num_overlapped = math.ceil(jaccard_val * (total_reads) / (jaccard_val + 1))
-    a = []
-    b = []
+    num_overlapped = overlapped_reads(jaccard_val, num_reads_a, num_reads_b)
     # If the num_overlapped amount is greater than either read
     # amount, then tell user and print the maximum jaccard value
     # in this case
@@ -41,28 +59,36 @@ def generate_reads(jaccard_val, num_reads_a, num_reads_b, read_length):
         print(str(min(num_reads_a, num_reads_b) / total_reads))
         return None, None, None, None
 
-    # Handle overlaps
-    for i in range(num_overlapped):
-        string = generate_random_string(read_length)
-        a.append(string)
-        b.append(string)
-    
-    for i in range(num_reads_a - num_overlapped):
-        string = generate_random_string(read_length)
-        a.append(string)
-
-    for i in range(num_reads_b - num_overlapped):
-        string = generate_random_string(read_length)
-        b.append(string)
+    # Handle overlaps, the first num_overlapped reads are in both sets
+    reads = generate_random_strings(num_reads_a + num_reads_b - num_overlapped, read_length, rng)
+    a = reads[:num_reads_a]
+    b = reads[:num_overlapped] + reads[num_reads_a:]
 
     # Calculate new jaccard value - if changed at all
     ret_jaccard = num_overlapped / (num_reads_a + num_reads_b - num_overlapped)
     forbes = num_overlapped / (num_reads_a * num_reads_b)
     sd = 2 * num_overlapped / (num_reads_a + num_reads_b)
         
-    random.shuffle(a)
-    random.shuffle(b)
+    a = [a[i] for i in rng.permutation(len(a))]
+    b = [b[i] for i in rng.permutation(len(b))]
+
+    return a, b, ret_jaccard, forbes, sd
 
+# Function that generates sets A and B like generate_reads(), as numpy arrays of
+# read codes (see generate_random_codes()) that HLL.insert_codes() takes directly,
+# without building any strings
+def generate_codes(jaccard_val, num_reads_a, num_reads_b, read_length, rng=None):
+    num_overlapped = overlapped_reads(jaccard_val, num_reads_a, num_reads_b)
+    if num_overlapped > num_reads_a or num_overlapped > num_reads_b:
+        return None, None, None, None, None
+    # the first num_overlapped codes are in both sets
+    codes = generate_random_codes(num_reads_a + num_reads_b - num_overlapped, read_length, rng)
+    a = codes[:num_reads_a]
+    b = np.concatenate([codes[:num_overlapped], codes[num_reads_a:]])
+
+    ret_jaccard = num_overlapped / (num_reads_a + num_reads_b - num_overlapped)
+    forbes = num_overlapped / (num_reads_a * num_reads_b)
+    sd = 2 * num_overlapped / (num_reads_a + num_reads_b)
     return a, b, ret_jaccard, forbes, sd
 
 def main(argv):
@@ -1,6 +1,14 @@
 import sys
 import math
 import random
+import numpy as np
+
+# The bulk read generators are shared with the Jaccard generator; the fallback
+# covers running this file directly as a script
+try:
+    from Random_Generators.Rangen_jaccard import generate_random_strings, generate_random_codes
+except ImportError:
+    from Rangen_jaccard import generate_random_strings, generate_random_codes
 
 # Function that takes in command line arguments and
 # parses it while assertin that they are correct
@@ -18,20 +26,18 @@ def variable_assertions(argv):
 
 # Function that generates random strings given a read length
 def generate_random_string(read_length):
-    ACGT = "ACGT"
-    string = ""
+    return "".join(random.choices("ACGT", k=read_length))
 
-    for i in range(read_length):
-        string += random.choice(ACGT)
-        
-    return string
+# Function that gives the number of reads shared by sets A and B for a Sorenson-Dice value
+def overlapped_reads(sd, num_reads_a, num_reads_b):
+    return math.ceil(sd * (num_reads_a + num_reads_b) / 2)
 
 # Function that generates set A and B given command line arguments
-def generate_reads(sd, num_reads_a, num_reads_b, read_length):
+def generate_reads(sd, num_reads_a, num_reads_b, read_length, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
     # Instantiate key variables
-    num_overlapped = math.ceil(sd * (num_reads_a + num_reads_b) / 2)
-    a = []
-    b = []
+    num_overlapped = overlapped_reads(sd, num_reads_a, num_reads_b)
 
     # If the num_overlapped amount is greater than either read
     # amount, then tell user and print the maximum sorenson-dice value
@@ -41,25 +47,31 @@ def generate_reads(sd, num_reads_a, num_reads_b, read_length):
         print(str(2 * min(num_overlapped, num_reads_a, num_reads_b) / (num_reads_a + num_reads_b)))
         return None, None, None
 
-    # Handle overlaps
-    for i in range(num_overlapped):
-        string = generate_random_string(read_length)
-        a.append(string)
-        b.append(string)
-    
-    for i in range(num_reads_a - num_overlapped):
-        string = generate_random_string(read_length)
-        a.append(string)
-
-    for i in range(num_reads_b - num_overlapped):
-        string = generate_random_string(read_length)
-        b.append(string)
+    # Handle overlaps, the first num_overlapped reads are in both sets
+    reads = generate_random_strings(num_reads_a + num_reads_b - num_overlapped, read_length, rng)
+    a = reads[:num_reads_a]
+    b = reads[:num_overlapped] + reads[num_reads_a:]
 
     sd_val = num_overlapped / (num_reads_a * num_reads_b)
 
-    random.shuffle(a)
-    random.shuffle(b)
+    a = [a[i] for i in rng.permutation(len(a))]
+    b = [b[i] for i in rng.permutation(len(b))]
+
+    return a, b, sd_val
+
+# Function that generates sets A and B like generate_reads(), as numpy arrays of
+# read codes (see generate_random_codes()) that HLL.insert_codes() takes directly,
+# without building any strings
+def generate_codes(sd, num_reads_a, num_reads_b, read_length, rng=None):
+    num_overlapped = overlapped_reads(sd, num_reads_a, num_reads_b)
+    if num_overlapped > num_reads_a or num_overlapped > num_reads_b:
+        return None, None, None
+    # the first num_overlapped codes are in both sets
+    codes = generate_random_codes(num_reads_a + num_reads_b - num_overlapped, read_length, rng)
+    a = codes[:num_reads_a]
+    b = np.concatenate([codes[:num_overlapped], codes[num_reads_a:]])
 
+    sd_val = num_overlapped / (num_reads_a * num_reads_b)
     return a, b, sd_val
 
 def main(argv):
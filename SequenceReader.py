@@ -0,0 +1,131 @@
+"""
+SequenceReader.py: Streaming FASTA/FASTQ reader for sketch construction
+
+Reads multi-line FASTA and FASTQ files, optionally gzip or bz2 compressed, one line at a time
+so that sketching a file only needs memory for one chunk of sequence.
+"""
+import bz2
+import gzip
+
+# file extensions that get_sketches() looks for
+EXTENSIONS = ['.fasta', '.fa', '.fna', '.fastq', '.fq']
+COMPRESSED_EXTENSIONS = ['', '.gz', '.bz2']
+
+"""
+SequenceReader.open_sequence_file():
+Opens a sequence file for reading text, detecting gzip or bz2 compression from its first bytes
+
+Input: path, a filename
+Output: a file object
+"""
+def open_sequence_file(path):
+    with open(path, 'rb') as f:
+        magic = f.read(3)
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(path, 'rt')
+    if magic == b'BZh':
+        return bz2.open(path, 'rt')
+    return open(path)
+
+"""
+SequenceReader.sequence_lines():
+Reads the sequence lines of a FASTA or FASTQ file, skipping headers and qualities
+
+Input: path, a filename
+Output: a generator of (new_record, line) tuples, new_record is True for the first line of each record
+"""
+def sequence_lines(path):
+    with open_sequence_file(path) as f:
+        new_record = False
+        fastq = None
+        for line in f:
+            line = line.rstrip()
+            if fastq is None:
+                if not line:
+                    continue
+                fastq = line[0] == '@'
+
+            if not fastq:
+                if line.startswith('>'):
+                    new_record = True
+                elif line:
+                    yield new_record, line
+                    new_record = False
+                continue
+
+            # FASTQ: header, sequence lines, '+' separator, as many quality characters as bases
+            if not line.startswith('@'):
+                continue
+            new_record = True
+            seq_len = 0
+            for line in f:
+                line = line.rstrip()
+                if line.startswith('+'):
+                    break
+                yield new_record, line
+                new_record = False
+                seq_len += len(line)
+            qual_len = 0
+            while qual_len < seq_len:
+                line = next(f, '')
+                if not line:
+                    break
+                qual_len += len(line.rstrip())
+
+"""
+SequenceReader.read_sequences():
+Reads every record of a FASTA or FASTQ file
+
+Input: path, a filename
+Output: a generator of sequences, one string per record
+"""
+def read_sequences(path):
+    seq = []
+    for new_record, line in sequence_lines(path):
+        if new_record and seq:
+            yield ''.join(seq)
+            seq = []
+        seq.append(line)
+    if seq:
+        yield ''.join(seq)
+
+"""
+SequenceReader.read_chunks():
+Reads a FASTA or FASTQ file in chunks of bounded size for batched k-mer insertion
+Records longer than chunk_size are split into fragments that overlap by k-1 bases,
+so every k-mer of a record appears in exactly one fragment
+
+Input: path, a filename; k, the k-mer length; chunk_size, the approximate number of bases per chunk
+Output: a generator of lists of sequences
+"""
+def read_chunks(path, k=25, chunk_size=1 << 22):
+    chunk = []
+    chunk_len = 0
+    seq = []
+    seq_len = 0
+    for new_record, line in sequence_lines(path):
+        if new_record and seq:
+            chunk.append(''.join(seq))
+            chunk_len += seq_len
+            seq = []
+            seq_len = 0
+            if chunk_len >= chunk_size:
+                yield chunk
+                chunk = []
+                chunk_len = 0
+
+        seq.append(line)
+        seq_len += len(line)
+        if seq_len >= chunk_size:
+            # emit the fragment so far, carrying over the last k-1 bases
+            fragment = ''.join(seq)
+            yield chunk + [fragment]
+            chunk = []
+            chunk_len = 0
+            seq = [fragment[len(fragment) - (k - 1):]] if k > 1 else []
+            seq_len = k - 1 if k > 1 else 0
+
+    if seq:
+        chunk.append(''.join(seq))
+    if chunk:
+        yield chunk
@@ -11,34 +11,68 @@ import numpy as np
 import math
 
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 from Random_Generators import Rangen_jaccard
 
-from scipy.optimize import fmin_bfgs
 from scipy.optimize import minimize
+from scipy.special import xlogy
 
 """
 Similarity.union():
 Calculate the HLL corresponding to the union of two sets, originates from Ertl, Algorithm 2
 
-Input: hll1, hll2; HLL objects corresponding to input sets
+Input: hll1, hll2; HLL objects corresponding to input sets, folded to the lower precision if they differ
 Returns: HLL object corresponding to estimated cardinality of intersection
 """
 def union(hll1, hll2):
-    # assume HLLs have the same number of registers
     assert isinstance(hll1, HLL)
     assert isinstance(hll2, HLL)
-    r1 = hll1.getRegisters()
-    r2 = hll2.getRegisters()
+    hll1, hll2 = common_precision(hll1, hll2)
+    new_hll = hll1.copy()
+    new_hll.merge_inplace(hll2)
+    return new_hll
+
+"""
+Similarity.common_precision():
+Folds the HLL with the higher precision down to the precision of the other (see HLL.reduce_precision()),
+so sketches built at different precisions can be compared without sketching the reads again
 
-    # create new registers that are the maximum of hll1 and hll2
-    r_new = [0 for i in range(len(r1))]
-    for i in range(len(r1)):
-        r_new[i] = max(r1[i],r2[i])
+Input: hll1, hll2; HLL objects
+Returns: two HLL objects with the lower of the two precisions; an HLL already at that precision is returned as is
+"""
+def common_precision(hll1, hll2):
+    p = min(hll1.p, hll2.p)
+    if hll1.p > p:
+        hll1 = hll1.reduce_precision(p)
+    if hll2.p > p:
+        hll2 = hll2.reduce_precision(p)
+    return hll1, hll2
 
-    # return a new HLL with the given registers
-    new_hll = HLL(hll1.p, r_new)
-    return new_hll
+"""
+Similarity.union_tree():
+Calculate the HLL corresponding to the union of many sets by a tree reduction: sketches are split into groups of
+fan_in, each group is merged with HLL.union_all(), and the results are merged the same way until one is left.
+With workers > 1 the groups of each level are merged by a process pool.
+
+Input: sketches, a list of compatible HLL objects (at least one)
+       fan_in, the number of sketches merged by one HLL.union_all() call
+       workers, the number of processes (1 to merge every group in this process)
+Returns: HLL object corresponding to the union of all input sets
+"""
+def union_tree(sketches, fan_in=256, workers=1):
+    assert fan_in > 1
+    level = list(sketches)
+    assert len(level) > 0
+    if workers > 1 and len(level) > fan_in:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while len(level) > fan_in:
+                level = list(pool.map(HLL.union_all, [level[i:i+fan_in] for i in range(0, len(level), fan_in)]))
+    # always merge at least once, so the result never aliases an input sketch
+    level = [HLL.union_all(level[i:i+fan_in]) for i in range(0, len(level), fan_in)]
+    while len(level) > 1:
+        level = [HLL.union_all(level[i:i+fan_in]) for i in range(0, len(level), fan_in)]
+    return level[0]
 
 """
 Similarity.intersection_inclusion_exclusion():
@@ -47,6 +81,7 @@ Calculate cardinality of the intersection through the inclusion-exclusion princi
 Input: hll1, hll2; HLL objects corresponding to input sets
 Returns: float corresponding to estimated cardinality of intersection of input sets"""
 def intersection_inclusion_exclusion(hll1, hll2):
+    hll1, hll2 = common_precision(hll1, hll2)
     return hll1.cardinality() + hll2.cardinality() - union(hll1,hll2).cardinality()
 
 """
@@ -64,38 +99,34 @@ def intersection(hll1, hll2):
 Similarity.getJointEstimators():
 Calculate the MLEs for the joint distribution of two HLLs (Ertl Algorithm 9)
 
-Input: hll1, hll2; HLL objects corresponding to input sets A and B
+Input: hll1, hll2; HLL objects corresponding to input sets A and B, folded to the lower precision if they differ
+       solver, 'newton' to use newton_joint_mle() or 'lbfgs' to use scipy's L-BFGS-B, which stops at Ertl's gradient
+       tolerance and is only accurate to a few parts in 1000 of the union, where Newton is accurate to about 1e-6
 Returns: float estimators (in order) for:
     |A \ B|
     |B \ A|
     |A intersect B|
 """
-def getJointEstimators(hll1, hll2):
-    # for now, assume hlls have same num. of registers
+def getJointEstimators(hll1, hll2, solver='newton'):
     assert isinstance(hll1, HLL)
     assert isinstance(hll2, HLL)
-    r1 = hll1.getRegisters()
-    r2 = hll2.getRegisters()
+    hll1, hll2 = common_precision(hll1, hll2)
+    hll1.check_compatible(hll2)
+    r1, r2, both_zero = register_pairs(hll1, hll2)
 
     q = hll1.q
     m = hll1.m
 
     # Calculate multiplicity vectors corresponding to comparisons between HLL1 and HLL2
-    C1_less = np.zeros(q+2)
-    C2_less = np.zeros(q+2)
-    C1_greater = np.zeros(q+2)
-    C2_greater = np.zeros(q+2)
-    C_equal = np.zeros(q+2)
-
-    for i in range(len(r1)):
-        if r1[i] < r2[i]:
-            C1_less[r1[i]] += 1
-            C2_greater[r2[i]] += 1
-        elif r1[i] > r2[i]:
-            C1_greater[r1[i]] += 1
-            C2_less[r2[i]] += 1
-        else:
-            C_equal[r1[i]] += 1
+    less = r1 < r2
+    greater = r1 > r2
+    equal = r1 == r2
+    C1_less = np.bincount(r1[less], minlength=q+2).astype(np.float64)
+    C2_greater = np.bincount(r2[less], minlength=q+2).astype(np.float64)
+    C1_greater = np.bincount(r1[greater], minlength=q+2).astype(np.float64)
+    C2_less = np.bincount(r2[greater], minlength=q+2).astype(np.float64)
+    C_equal = np.bincount(r1[equal], minlength=q+2).astype(np.float64)
+    C_equal[0] += both_zero
 
     # Get initial cardinality estimates as initial values for optimizer
     lambda_ax = Cardinality.estimateCardinality(C1_less + C_equal + C1_greater)
@@ -114,18 +145,78 @@ def getJointEstimators(hll1, hll2):
 
     delta = 0.01/np.sqrt(m) # tolerance for change in gradient
 
-    args = (C1_less, C2_less, C_equal, C1_greater, C2_greater, q, m)
+    S, C = stack_counts(C1_less, C2_less, C_equal, C1_greater, C2_greater, q, max(r1.max(initial=0), r2.max(initial=0)))
+    args = (S, C, q, m)
 
-    # maximize log-likelihood using L-BFGS-B
-    results = minimize(calculate_log_likelihood, np.array([phi_a+1, phi_b+1, phi_x+1]), method='L-BFGS-B', args=args, options={'gtol':delta, 'disp':False})
+    phi_0 = np.array([phi_a, phi_b, phi_x])
+    if solver == 'newton':
+        phi = newton_joint_mle(phi_0, args, gtol=delta)
+    else:
+        # maximize log-likelihood using L-BFGS-B, started above the inclusion-exclusion estimates
+        results = minimize(calculate_ll_and_gradient, phi_0 + 1, method='L-BFGS-B', jac=True, args=args, options={'gtol':delta})
+        phi = results.x
 
-    phi_a = results.x[0] # |A \ B|
-    phi_b = results.x[1] # |B \ A|
-    phi_x = results.x[2] # |A n B|
+    phi_a = phi[0] # |A \ B|
+    phi_b = phi[1] # |B \ A|
+    phi_x = phi[2] # |A n B|
 
     # re-exponentiate and return estimators
     return np.exp(phi_a), np.exp(phi_b), np.exp(phi_x)
 
+"""
+register_pairs():
+Returns the registers of two HLLs side by side. If both are sparse, only positions where at least one
+of them is nonzero are returned, so the registers are never expanded to length m.
+
+This is a helper method for the getJointEstimators() function.
+Input: hll1, hll2; compatible HLL objects
+Returns: r1, r2, numpy uint8 arrays of the same length; the number of other positions, where both registers are 0
+"""
+def register_pairs(hll1, hll2):
+    if not (hll1.sparse and hll2.sparse):
+        return hll1.getRegisters(), hll2.getRegisters(), 0
+    idx1, ranks1 = hll1.nonzero_registers()
+    idx2, ranks2 = hll2.nonzero_registers()
+    idx = np.union1d(idx1, idx2)
+    r1 = np.zeros(len(idx), dtype=np.uint8)
+    r2 = np.zeros(len(idx), dtype=np.uint8)
+    r1[np.searchsorted(idx, idx1)] = ranks1
+    r2[np.searchsorted(idx, idx2)] = ranks2
+    return r1, r2, hll1.m - len(idx)
+
+"""
+Similarity.getJointEstimatorsBatch():
+Batched form of getJointEstimators() with the Newton solver, for N pairs of HLLs at once
+
+Input: (N, q+2) arrays of the multiplicity vectors for each pair (see getJointEstimators()); q, m
+Returns: three arrays of N float estimators, for |A \ B|, |B \ A| and |A intersect B|
+"""
+def getJointEstimatorsBatch(C1_less, C2_less, C_equal, C1_greater, C2_greater, q, m):
+    # Get initial cardinality estimates as initial values for optimizer
+    lambda_ax = Cardinality.estimateCardinalities(C1_less + C_equal + C1_greater)
+    lambda_bx = Cardinality.estimateCardinalities(C2_greater + C_equal + C2_less)
+    lambda_abx = Cardinality.estimateCardinalities(C1_greater + C_equal + C2_greater)
+
+    a_excl, b_excl, intersection = lambda_ax.copy(), lambda_bx.copy(), np.zeros(len(lambda_ax))
+
+    # pairs where at least one HLL is 0 at every position have no intersect
+    solve = np.flatnonzero(C1_less[:, 0] + C_equal[:, 0] + C2_less[:, 0] != m)
+    if len(solve) == 0:
+        return a_excl, b_excl, intersection
+
+    # transfer variables to the log domain
+    lambda_ax, lambda_bx, lambda_abx = lambda_ax[solve], lambda_bx[solve], lambda_abx[solve]
+    phi_0 = np.log(np.maximum(1, np.stack([lambda_abx-lambda_bx, lambda_abx-lambda_ax, lambda_ax+lambda_bx-lambda_abx], axis=1)))
+
+    k_max = np.flatnonzero((C1_greater + C_equal + C2_greater)[solve].any(axis=0)).max()
+    S, C = stack_counts(C1_less[solve], C2_less[solve], C_equal[solve], C1_greater[solve], C2_greater[solve], q, k_max)
+    delta = 0.01/np.sqrt(m) # tolerance for change in gradient
+    phi = newton_joint_mle(phi_0, (S, C, q, m), gtol=delta)
+
+    # re-exponentiate and return estimators
+    a_excl[solve], b_excl[solve], intersection[solve] = np.exp(phi).T
+    return a_excl, b_excl, intersection
+
 """
 calculate_log_likelihood():
 Log-Likelihood for Joint Estimator. We want to find phi_A, phi_B, and phi_X that maximize (minimize the negative) this equation
@@ -134,56 +225,181 @@ Equation 72 from Ertl paper
 This is a helper method for the getJointEstimators() function.
 """
 def calculate_log_likelihood(phi, C1_less, C2_less, C_equal, C1_greater, C2_greater, q, m):
-    phi_a = phi[0]
-    phi_b = phi[1]
-    phi_x = phi[2]
-
-    # follow sum equation from Ertl paper
-    f = 0
-    (xa,ya,za) = calculate_xyz(phi_a, q, m)
-    (xb,yb,zb) = calculate_xyz(phi_b, q, m)
-    (xx,yx,zx) = calculate_xyz(phi_x, q, m)
-    for k in range(1,q+1):
-        (xak,yak,zak) = (xa[k],ya[k],za[k])
-        (xbk,ybk,zbk) = (xb[k],yb[k],zb[k])
-        (xxk,yxk,zxk) = (xx[k],yx[k],zx[k])
-        f += C1_less[k]*np.log(zxk+yxk*zak) + C2_less[k]*np.log(zxk+yxk*zbk) + C1_greater[k]*np.log(zak) + C2_greater[k]*np.log(zbk) + C_equal[k]*np.log(zxk+yxk*zak*zbk)
-    f += C1_greater[q+1]*np.log(za[q]) + C2_greater[q+1]*np.log(zb[q]) + C_equal[q+1]*np.log(zx[q]+yx[q]*za[q]*zb[q])
-    for k in range(0,q+1):
-        f -= (C1_less[k] + C_equal[k] + C1_greater[k])*xa[k] + (C2_less[k] + C_equal[k] + C2_greater[k])*xb[k] + (C1_less[k] + C_equal[k] + C2_less[k])*xx[k]
+    S, C = stack_counts(C1_less, C2_less, C_equal, C1_greater, C2_greater, q)
+    f, _, _ = joint_likelihood_terms(phi, S, C, q, m, 0)
     return -f
 
 """
 calculate_ll_gradient():
-Gradient of Log-Likelihood for use in optimization.
+Gradient of the negative Log-Likelihood returned by calculate_log_likelihood(), for use in optimization.
 Equation 75 from Ertl paper
 
 This is a helper method for the getJointEstimators() function.
-There is an error in this function so it is commented out, using a gradient-free optimizer instead.
-"""
-# def calculate_ll_gradient(phi, C1_less, C2_less, C_equal, C1_greater, C2_greater, q, m):
-#     phi_a = phi[0]
-#     phi_b = phi[1]
-#     phi_x = phi[2]
-#
-#     da = 0
-#     db = 0
-#     dx = 0
-#     (xa,ya,za) = calculate_xyz(phi_a, q, m)
-#     (xb,yb,zb) = calculate_xyz(phi_b, q, m)
-#     (xx,yx,zx) = calculate_xyz(phi_x, q, m)
-#     for k in range(1,q+1):
-#         da += C1_less[k]*(yx[k]*xa[k]*ya[k])/(zx[k]+yx[k]*za[k]) + C1_greater[k]*(xa[k]*ya[k])/(za[k]) + C_equal[k]*(yx[k]*xa[k]*ya[k]*zb[k])/(zx[k]+yx[k]*za[k]*zb[k])
-#         db += C2_less[k]*(yx[k]*xb[k]*yb[k])/(zx[k]+yx[k]*zb[k]) + C2_greater[k]*(xb[k]*yb[k])/(zb[k]) + C_equal[k]*(yx[k]*za[k]*xb[k]*yb[k])/(zx[k]+yx[k]*za[k]*zb[k])
-#         dx += C1_less[k]*(xx[k]*yx[k]*ya[k])/(zx[k]+yx[k]*za[k]) + C2_less[k]*(xx[k]*yx[k]*yb[k])/(zx[k]+yx[k]*zb[k]) + C_equal[k]*(xx[k]*yx[k]*(ya[k]+za[k]*yb[k]))/(zx[k]+yx[k]*za[k]*zb[k])
-#     da += C1_greater[q+1]*(xa[q]*ya[q])/(za[q]) + C_equal[q+1]*(yx[q]*xa[q]*ya[q]*zb[q])/(zx[q]+yx[q]*za[q]*zb[q])
-#     db += C2_greater[q+1]*(xb[q]*yb[q])/(zb[q]) + C_equal[q+1]*(yx[q]*za[q]*xb[q]*yb[q])/(zx[q]+yx[q]*za[q]*zb[q])
-#     dx += C_equal[q+1]*(xx[q]*yx[q]*(ya[q]+za[q]*yb[q]))/(zx[q]+yx[q]*za[q]*zb[q])
-#     for k in range(0,q+1):
-#         da -= (C1_less[k] + C_equal[k] + C1_greater[k])*xa[k]
-#         db -= (C2_less[k] + C_equal[k] + C2_greater[k])*xb[k]
-#         dx -= (C1_less[k] + C_equal[k] + C2_less[k])*xx[k]
-#     return np.array([da, db, dx])
+"""
+def calculate_ll_gradient(phi, C1_less, C2_less, C_equal, C1_greater, C2_greater, q, m):
+    S, C = stack_counts(C1_less, C2_less, C_equal, C1_greater, C2_greater, q)
+    _, grad, _ = joint_likelihood_terms(phi, S, C, q, m, 1)
+    return -grad
+
+"""
+stack_counts():
+Stacks the multiplicity vectors into the two arrays used by joint_likelihood_terms():
+    S, the (3, q+1) counts multiplying x for phi_a, phi_b and phi_x in the linear terms (k = 0..q)
+    C, the (5, q+1) counts of the log terms (k = 1..q+1), in the order C1_less, C2_less, C1_greater, C2_greater, C_equal
+The multiplicity vectors may also be (N, q+2) arrays for N pairs of HLLs, giving (N, 3, q+1) and (N, 5, q+1) arrays.
+If no register is above k_max < q+1, the arrays are cut off after k_max since all later counts are 0.
+
+This is a helper method for the getJointEstimators() function.
+"""
+def stack_counts(C1_less, C2_less, C_equal, C1_greater, C2_greater, q, k_max=None):
+    if k_max is None or k_max > q:
+        s_end, c_end = q+1, q+2
+    else:
+        s_end, c_end = k_max+1, k_max+1
+    S = np.stack([C1_less[..., :s_end] + C_equal[..., :s_end] + C1_greater[..., :s_end],
+                  C2_less[..., :s_end] + C_equal[..., :s_end] + C2_greater[..., :s_end],
+                  C1_less[..., :s_end] + C_equal[..., :s_end] + C2_less[..., :s_end]], axis=-2)
+    C = np.stack([C1_less[..., 1:c_end], C2_less[..., 1:c_end], C1_greater[..., 1:c_end], C2_greater[..., 1:c_end], C_equal[..., 1:c_end]], axis=-2)
+    return S, C
+
+"""
+joint_likelihood_terms():
+Vectorized log-likelihood (Equation 72) and, up to the given order, its gradient and Hessian with respect to
+(phi_a, phi_b, phi_x). Every log term has the form C[k] * log(D[k]), so its derivatives follow from those of D[k]:
+    d log D = dD / D,    d2 log D = d2D / D - dD dD^T / D^2
+where dz/dphi = x*y and d2z/dphi2 = x*y*(1-x) for the z of the same phi, and dy = -dz.
+All arrays may carry leading batch dimensions to evaluate many pairs of HLLs at once.
+
+This is a helper method for calculate_log_likelihood(), calculate_ll_gradient() and newton_joint_mle().
+Input: phi, (..., 3); S, C, from stack_counts(); q, m
+Returns: f, gradient (or None), Hessian (or None) of the log-likelihood (not its negative)
+"""
+def joint_likelihood_terms(phi, S, C, q, m, order=2):
+    (x,y,z) = calculate_xyz(phi, S.shape[-1]-1, m)
+
+    # linear terms over k = 0..q
+    lin = (S * x).sum(axis=-1)
+
+    # log terms over k = 1..q+1, where k = q+1 reuses the values at q
+    idx = np.minimum(np.arange(1, C.shape[-1]+1), q)
+    (xa,xb,xx) = x[..., idx].swapaxes(0, -2)
+    (ya,yb,yx) = y[..., idx].swapaxes(0, -2)
+    (za,zb,zx) = z[..., idx].swapaxes(0, -2)
+    D = np.stack([zx+yx*za, zx+yx*zb, za, zb, zx+yx*za*zb], axis=-2)
+
+    f = xlogy(C, D).sum(axis=(-2, -1)) - lin.sum(axis=-1)
+    if order < 1:
+        return f, None, None
+
+    R = np.divide(C, D, out=np.zeros(C.shape), where=C > 0)
+    ua, ub, ux = xa*ya, xb*yb, xx*yx
+    ya_eq = ya+za*yb  # 1 - za*zb
+    # dD of the log terms that depend on phi_a, phi_b and phi_x respectively
+    dDa = (yx*ua, ua, yx*ua*zb)  # C1_less, C1_greater, C_equal
+    dDb = (yx*ub, ub, yx*za*ub)  # C2_less, C2_greater, C_equal
+    dDx = (ux*ya, ux*yb, ux*ya_eq)  # C1_less, C2_less, C_equal
+    R = R.swapaxes(0, -2)
+    grad = np.stack([
+        (R[0]*dDa[0] + R[2]*dDa[1] + R[4]*dDa[2]).sum(axis=-1),
+        (R[1]*dDb[0] + R[3]*dDb[1] + R[4]*dDb[2]).sum(axis=-1),
+        (R[0]*dDx[0] + R[1]*dDx[1] + R[4]*dDx[2]).sum(axis=-1),
+    ], axis=-1) - lin
+    if order < 2:
+        return f, grad, None
+
+    W = np.divide(R, D.swapaxes(0, -2), out=np.zeros(R.shape), where=C.swapaxes(0, -2) > 0)
+    va, vb, vx = ua*(1-xa), ub*(1-xb), ux*(1-xx)
+    hess = np.empty(lin.shape + (3,))
+    hess[..., 0,0] = (R[0]*yx*va + R[2]*va + R[4]*yx*va*zb - W[0]*dDa[0]**2 - W[2]*dDa[1]**2 - W[4]*dDa[2]**2).sum(axis=-1) - lin[..., 0]
+    hess[..., 1,1] = (R[1]*yx*vb + R[3]*vb + R[4]*yx*za*vb - W[1]*dDb[0]**2 - W[3]*dDb[1]**2 - W[4]*dDb[2]**2).sum(axis=-1) - lin[..., 1]
+    hess[..., 2,2] = (R[0]*vx*ya + R[1]*vx*yb + R[4]*vx*ya_eq - W[0]*dDx[0]**2 - W[1]*dDx[1]**2 - W[4]*dDx[2]**2).sum(axis=-1) - lin[..., 2]
+    hess[..., 0,1] = hess[..., 1,0] = (R[4]*yx*ua*ub - W[4]*dDa[2]*dDb[2]).sum(axis=-1)
+    hess[..., 0,2] = hess[..., 2,0] = (-R[0]*ux*ua - R[4]*ux*ua*zb - W[0]*dDa[0]*dDx[0] - W[4]*dDa[2]*dDx[2]).sum(axis=-1)
+    hess[..., 1,2] = hess[..., 2,1] = (-R[1]*ux*ub - R[4]*ux*za*ub - W[1]*dDb[0]*dDx[1] - W[4]*dDb[2]*dDx[2]).sum(axis=-1)
+    return f, grad, hess
+
+"""
+calculate_ll_and_gradient():
+Negative Log-Likelihood and its gradient from a single evaluation, for optimizers that accept both at once
+
+This is a helper method for the getJointEstimators() function.
+"""
+def calculate_ll_and_gradient(phi, S, C, q, m):
+    f, grad, _ = joint_likelihood_terms(phi, S, C, q, m, 1)
+    return -f, -grad
+
+"""
+newton_joint_mle():
+Maximizes the joint log-likelihood by Newton's method with a backtracking line search,
+shifting the Hessian by a multiple of the identity where it is not negative definite
+phi may be an (N, 3) array with S and C from stack_counts() for N pairs, every pair is solved independently
+
+This is a helper method for the getJointEstimators() function.
+Input: phi, the initial values of (phi_a, phi_b, phi_x); args, the arguments of joint_likelihood_terms() after phi
+       tolerance, stop once a step changes every phi by less than this
+       gtol, stop once every component of the gradient is below this (estimators tending to 0 only have a vanishing gradient)
+       max_step, the largest change in any phi from one step
+Returns: the maximizing phi
+"""
+# estimators below this fraction of the union are in the tail of the likelihood, see newton_joint_mle()
+TAIL_FRACTION = 1e-4
+
+def newton_joint_mle(phi, args, tolerance=1e-10, gtol=1e-6, max_step=4, max_iterations=100):
+    S, C, q, m = args
+    phi = np.array(phi, dtype=np.float64)
+    single = phi.ndim == 1
+    if single:
+        phi, S, C = phi[None], S[None], C[None]
+
+    # only pairs that have not converged are evaluated
+    active = np.arange(len(phi))
+    f, grad, hess = joint_likelihood_terms(phi, S, C, q, m)
+    for _ in range(max_iterations):
+        keep = np.abs(grad).max(axis=1) >= gtol
+        active, f, grad, hess = active[keep], f[keep], grad[keep], hess[keep]
+        if len(active) == 0:
+            break
+
+        # Newton step, shifting the Hessian to be negative definite where the likelihood is not locally concave
+        eig = np.linalg.eigvalsh(-hess)
+        shift = np.where(eig[:, 0] > 0, 0, 1e-8 - 1.001 * eig[:, 0])
+        step = np.linalg.solve(shift[:, None, None] * np.eye(3) - hess, grad[..., None])[..., 0]
+        step /= np.maximum(1, np.abs(step).max(axis=1) / max_step)[:, None]
+
+        # an estimator tending to 0 is in the exponential tail of the likelihood, where Newton steps are about -1 and
+        # each only shrinks the estimator by a factor e; it is moved by max_step instead, where that still ascends
+        current = phi[active]
+        tail = (step < -0.5) & (current - np.log(np.exp(current).sum(axis=1))[:, None] < np.log(TAIL_FRACTION))
+        if tail.any():
+            extended = np.where(tail, -max_step, step)
+            ascends = np.sum(grad * extended, axis=1) > 0
+            step[ascends] = extended[ascends]
+
+        # the full step is evaluated with its derivatives, since it is almost always accepted near the maximum;
+        # pairs where it is not backtrack with function values only
+        slope = np.sum(grad * step, axis=1)
+        t = np.ones(len(active))
+        phi_new = phi[active] + step
+        f_new, grad_new, hess_new = joint_likelihood_terms(phi_new, S[active], C[active], q, m)
+        searching = f_new < f + 1e-4 * slope
+        backtracked = np.flatnonzero(searching)
+        while searching.any():
+            s = np.flatnonzero(searching)
+            t[s] /= 2
+            phi_new[s] = phi[active[s]] + t[s, None] * step[s]
+            f_s = joint_likelihood_terms(phi_new[s], S[active[s]], C[active[s]], q, m, order=0)[0]
+            done = (f_s >= f[s] + 1e-4 * t[s] * slope[s]) | (t[s] < 1e-10)
+            searching[s[done]] = False
+        if len(backtracked):
+            b = backtracked
+            f_new[b], grad_new[b], hess_new[b] = joint_likelihood_terms(phi_new[b], S[active[b]], C[active[b]], q, m)
+        phi[active] = phi_new
+
+        keep = np.abs(t[:, None] * step).max(axis=1) >= tolerance
+        active, f, grad, hess = active[keep], f_new[keep], grad_new[keep], hess_new[keep]
+        if len(active) == 0:
+            break
+    return phi[0] if single else phi
 
 """
 calculate_xyz():
@@ -191,19 +407,13 @@ Calculates expressions for log-likelihood.
 Equation 73 from Ertl paper
 
 This is a helper method for the calculate_log_likelihood() function.
+phi may be a single value or an array, in which case each row of x, y, z corresponds to one entry of phi.
+The 1/(m*2^k) factors come from Cardinality.scale_table(), which is computed once per (q, m).
 """
 def calculate_xyz(phi, q, m):
-    x = np.zeros(q+1)
-    z = np.zeros(q+1)
-    y = np.zeros(q+1)
-    for k in range(0,q+1):
-        x[k] = np.exp(phi) / (m*(2 ** k))
-        if x[k] < np.log(2):
-            z[k] = -np.expm1(-x[k])
-            y[k] = 1 - z[k]
-        else:
-            y[k] = np.exp(-x[k])
-            z[k] = 1 - y[k]
+    x = np.exp(np.asarray(phi))[..., None] * Cardinality.scale_table(q, m)
+    y = np.exp(-x)
+    z = -np.expm1(-x)
     return (x,y,z)
 
 """
@@ -220,13 +430,11 @@ def main(args):
     card_b = int(args[1])
 
     # Generate random data
-    a,b,jac,_,_ = Rangen_jaccard.generate_reads(jac, card_a, card_b, 50)
+    a,b,jac,_,_ = Rangen_jaccard.generate_codes(jac, card_a, card_b, 50)
 
     # add to HLLs
-    for r in a:
-        h1.insert(r)
-    for r in b:
-        h2.insert(r)
+    h1.insert_codes(a)
+    h2.insert_codes(b)
 
     # test estimators
     print('Actual Cardinalities: '+str(card_a)+','+str(card_b))
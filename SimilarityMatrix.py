@@ -0,0 +1,232 @@
+"""
+SimilarityMatrix.py: All-vs-all similarity estimation for a collection of HLLs
+
+Instead of building a union HLL and running a separate joint MLE for every pair, sketches are stacked into an
+(n, m) register array, cardinalities are estimated once per sketch, and the union and joint multiplicity vectors
+of whole blocks of pairs are computed with array operations before running a batched joint MLE.
+Blocks can be spread over a process pool, see similarity_matrices().
+"""
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import Cardinality
+import Similarity
+
+"""
+SimilarityMatrix.stack_registers():
+Stacks the registers of a list of HLLs into one array
+
+Input: sketches, a list of compatible HLLs (same p and hash function)
+Output: an (n, m) numpy uint8 array
+"""
+def stack_registers(sketches):
+    for h in sketches[1:]:
+        sketches[0].check_compatible(h)
+    return np.stack([h.getRegisters() for h in sketches]).astype(np.uint8, copy=False)
+
+"""
+SimilarityMatrix.multiplicities():
+Count vectors for each row of a register array, as Cardinality.getMultiplicity() does for one HLL
+
+Input: registers, an (n, m) array; q, the number of rank bits
+Output: an (n, q+2) array of counts
+"""
+def multiplicities(registers, q):
+    n = len(registers)
+    keys = registers.astype(np.int64) + (q+2) * np.arange(n)[:, None]
+    return np.bincount(keys.ravel(), minlength=n*(q+2)).reshape(n, q+2)
+
+"""
+SimilarityMatrix.pair_histograms():
+Joint histograms of register values for pairs of HLLs, H[i, j, k] counts registers equal to j in the first
+and k in the second HLL of pair i
+
+Input: r1, r2, (P, m) register arrays for P pairs; q, the number of rank bits
+Output: a (P, q+2, q+2) array of counts
+"""
+def pair_histograms(r1, r2, q):
+    P = len(r1)
+    K = q + 2
+    keys = (r1.astype(np.int64) * K + r2) + (K * K) * np.arange(P)[:, None]
+    return np.bincount(keys.ravel(), minlength=P*K*K).reshape(P, K, K)
+
+"""
+SimilarityMatrix.pair_counts():
+Splits joint histograms into the multiplicity vectors used by Similarity.getJointEstimators()
+and the count vector of the union of each pair
+
+Input: H, from pair_histograms()
+Output: C1_less, C2_less, C_equal, C1_greater, C2_greater, C_union; each a (P, q+2) float array
+"""
+def pair_counts(H):
+    H = H.astype(np.float64)
+    upper = np.triu(H, 1)  # first register less than second
+    lower = np.tril(H, -1)
+
+    C1_less = upper.sum(axis=2)
+    C2_greater = upper.sum(axis=1)
+    C1_greater = lower.sum(axis=2)
+    C2_less = lower.sum(axis=1)
+    C_equal = np.diagonal(H, axis1=1, axis2=2).copy()
+
+    # the union register is the maximum of the two
+    C_union = C_equal + C1_greater + C2_greater
+    return C1_less, C2_less, C_equal, C1_greater, C2_greater, C_union
+
+"""
+SimilarityMatrix.block_similarities():
+Estimates Jaccard, Sorensen-Dice and Forbes similarity for a block of pairs
+
+Input: registers, an (n, m) register array; cardinalities, the estimated cardinality of each row
+       i, j, arrays of row indices of the pairs; q, the number of rank bits
+Output: jaccard, sd and forbes; arrays with one value per pair (nan if a sketch is empty)
+"""
+def block_similarities(registers, cardinalities, i, j, q):
+    m = registers.shape[1]
+    C1_less, C2_less, C_equal, C1_greater, C2_greater, C_union = pair_counts(pair_histograms(registers[i], registers[j], q))
+
+    union = Cardinality.estimateCardinalities(C_union)
+    a_excl, b_excl, intersection = Similarity.getJointEstimatorsBatch(C1_less, C2_less, C_equal, C1_greater, C2_greater, q, m)
+    a = cardinalities[i]
+    b = cardinalities[j]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = intersection / union
+        sd = 2*intersection/(a + b)
+        forbes = (intersection*union)/(intersection*union + 1.5*a_excl*b_excl)
+    return jaccard, sd, forbes
+
+# state of each worker process, set up by _init_worker()
+_worker = {}
+
+def _init_worker(shm_name, shape, cardinalities, q):
+    # the block is created and unlinked by the parent, workers only attach to it
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['registers'] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    _worker['cardinalities'] = cardinalities
+    _worker['q'] = q
+
+def _tile_similarities(tile):
+    i, j = tile
+    return block_similarities(_worker['registers'], _worker['cardinalities'], i, j, _worker['q'])
+
+"""
+SimilarityMatrix.tile_mapper():
+Context manager giving a function that estimates a list of tiles of pairs, see pair_similarities()
+With workers > 1 the registers are copied once into shared memory and the tiles are sent to a process pool,
+which stays up for every call made inside the with block.
+
+Input: registers, an (n, m) numpy uint8 array; cardinalities, the estimated cardinality of each row
+       q, the number of rank bits; workers, the number of processes (1 to compute every tile in this process)
+Output: a function taking a list of (rows, cols) tiles and returning a list of (jaccard, sd, forbes) per tile
+"""
+@contextlib.contextmanager
+def tile_mapper(registers, cardinalities, q, workers=1):
+    if workers <= 1:
+        yield lambda tiles: [block_similarities(registers, cardinalities, i, j, q) for i, j in tiles]
+        return
+    shm = shared_memory.SharedMemory(create=True, size=max(registers.nbytes, 1))
+    try:
+        np.ndarray(registers.shape, dtype=np.uint8, buffer=shm.buf)[:] = registers
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shm.name, registers.shape, cardinalities, q)) as pool:
+            yield lambda tiles: list(pool.map(_tile_similarities, tiles))
+    finally:
+        shm.close()
+        shm.unlink()
+
+"""
+SimilarityMatrix.pair_similarities():
+Estimates Jaccard, Sorensen-Dice and Forbes similarity for a list of pairs of rows of a register array
+The pairs are split into tiles of block_size; with workers > 1 the tiles are sent to a process pool
+and the registers are shared with the workers through shared memory instead of being pickled for every tile.
+Each pair is estimated independently, so the output does not depend on the number of workers.
+
+Input: registers, an (n, m) numpy uint8 array; cardinalities, the estimated cardinality of each row
+       rows, cols, arrays of row indices of the pairs; q, the number of rank bits
+       block_size, the number of pairs processed at once; memory use grows with block_size * m
+       workers, the number of processes (1 to compute every tile in this process)
+Output: jaccard, sd and forbes; arrays with one value per pair
+"""
+def pair_similarities(registers, cardinalities, rows, cols, q, block_size=1024, workers=1):
+    tiles = [(rows[start:start+block_size], cols[start:start+block_size]) for start in range(0, len(rows), block_size)]
+    if len(tiles) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+
+    with tile_mapper(registers, cardinalities, q, workers if len(tiles) > 1 else 1) as map_tiles:
+        results = map_tiles(tiles)
+
+    jaccard, sd, forbes = (np.concatenate(values) for values in zip(*results))
+    return jaccard, sd, forbes
+
+"""
+SimilarityMatrix.iter_similarities():
+Estimates Jaccard, Sorensen-Dice and Forbes similarity for every pair of HLLs (i, j) with i <= j, rows_per_block
+rows of the upper triangle at a time, so all-vs-all results can be written out as they are computed
+without holding every pair in memory. The process pool, if any, is shared by all the blocks.
+
+Input: sketches, a list of compatible HLLs (or an (n, m) register array and p)
+       rows_per_block, the number of rows of the upper triangle per block
+       block_size, workers, as in pair_similarities()
+Output: a generator of (rows, cols, jaccard, sd, forbes) tuples of arrays with one value per pair, in row order
+"""
+def iter_similarities(sketches, p=None, rows_per_block=64, block_size=1024, workers=1):
+    if isinstance(sketches, np.ndarray):
+        registers = np.ascontiguousarray(sketches, dtype=np.uint8)
+    else:
+        registers = stack_registers(sketches)
+        p = sketches[0].p
+    n = len(registers)
+    q = 64 - p
+    cardinalities = Cardinality.estimateCardinalities(multiplicities(registers, q))
+
+    with tile_mapper(registers, cardinalities, q, workers) as map_tiles:
+        for start in range(0, n, rows_per_block):
+            block = np.arange(start, min(start + rows_per_block, n))
+            rows = np.repeat(block, n - block)
+            # the columns of row i are i..n-1, counted from each row's own first pair
+            first = np.repeat(np.cumsum(n - block) - (n - block), n - block)
+            cols = rows + np.arange(len(rows)) - first
+            tiles = [(rows[s:s+block_size], cols[s:s+block_size]) for s in range(0, len(rows), block_size)]
+            yield (rows, cols) + tuple(np.concatenate(values) for values in zip(*map_tiles(tiles)))
+
+"""
+SimilarityMatrix.similarity_matrices():
+Estimates Jaccard, Sorensen-Dice and Forbes similarity for every pair of HLLs, see pair_similarities()
+
+Input: sketches, a list of compatible HLLs (or an (n, m) register array and p)
+       block_size, workers, as in pair_similarities()
+Output: jaccard, sd and forbes; symmetric (n, n) numpy arrays
+"""
+def similarity_matrices(sketches, p=None, block_size=1024, workers=1):
+    if isinstance(sketches, np.ndarray):
+        registers = np.ascontiguousarray(sketches, dtype=np.uint8)
+    else:
+        registers = stack_registers(sketches)
+        p = sketches[0].p
+    n, m = registers.shape
+    q = 64 - p
+
+    # per-sketch cardinalities are only estimated once
+    cardinalities = Cardinality.estimateCardinalities(multiplicities(registers, q))
+
+    rows, cols = np.triu_indices(n)
+    return fill_matrices(n, rows, cols, *pair_similarities(registers, cardinalities, rows, cols, q, block_size, workers))
+
+"""
+SimilarityMatrix.fill_matrices():
+Builds symmetric similarity matrices from the values of a list of pairs
+
+Input: n, the number of sketches; rows, cols, arrays of indices of the pairs; jaccard, sd, forbes, one value per pair
+Output: jaccard, sd and forbes; symmetric (n, n) numpy arrays
+"""
+def fill_matrices(n, rows, cols, jaccard_pairs, sd_pairs, forbes_pairs):
+    jaccard = np.zeros((n, n))
+    sd = np.zeros((n, n))
+    forbes = np.zeros((n, n))
+    jaccard[rows, cols] = jaccard[cols, rows] = jaccard_pairs
+    sd[rows, cols] = sd[cols, rows] = sd_pairs
+    forbes[rows, cols] = forbes[cols, rows] = forbes_pairs
+    return jaccard, sd, forbes
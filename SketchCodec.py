@@ -0,0 +1,544 @@
+"""
+SketchCodec.py: Compressed, streamable encoding of collections of HLL sketches
+
+Registers of a sketch are concentrated around log2(n/m), so most of them fit in a few bits above a base value.
+Each sketch is encoded with a patched frame of reference chosen from its register histogram: a base b and a
+width w in WIDTHS, every register in [b, b + 2^w) stored as its w-bit offset from b, and the few registers
+outside that window stored as exceptions (register index, value). The (b, w) pair minimizing the encoded size
+is chosen per sketch, falling back to plain bytes (w = 8) when the registers are spread out. Windows are taken
+modulo 256, so a window can wrap around from 255 to 0.
+
+With entropy coding (the entropy option), every sketch is instead coded with rANS, an arithmetic coder, against
+a static model: its own register histogram, quantized to frequencies summing to 2^PROB_BITS and stored with the
+sketch. This comes close to the entropy of the histogram, which is below the cost of the best frame whenever the
+registers are spread over more than a window of 2^w values. A sketch is split into LANES interleaved rANS streams
+(register j in lane j mod LANES), and one decoding step takes the next register of every lane of every sketch of
+the chunk with a few operations on whole arrays, but the steps still run one after another, so entropy coded
+streams decode several times slower than frames. The frames are the default, and entropy coding is for
+archival and slow links.
+
+There is no delta coding against a reference sketch such as the union of a clade: a register of a clade member
+is the maximum over a random part of the clade's k-mers, so the union's register tells little about it. On
+related genomes the entropy of a register given the union's was 2.80 bits against 2.84 bits without it.
+
+A compressed stream (all integers little-endian):
+    header:
+        magic           8 bytes     b'GNOMESKZ'
+        version         uint16      currently 2 (version 1 streams could be delta coded, and are not read)
+        p               uint8       precision, every sketch has 2^p registers
+        hash id         uint8       hash function (see SketchFile.HASH_IDS)
+        k               uint8       k-mer size
+        flags           uint8       bit 1 canonical k-mers, bit 2 entropy coded, bit 3 zlib compressed chunks
+        (padding)       2 bytes
+    chunks of up to chunk_size sketches, each:
+        count           uint32      number of sketches n in the chunk, 0 ends the stream
+        size            uint32      bytes of the chunk body that follows (after zlib, if used)
+        body:
+            n+1 uint32 offsets into the name data, then the UTF-8 name data
+            with frames:
+                n uint8 widths, n uint8 bases, n uint32 exception counts
+                w-bit offsets of the sketches of each width, widths in increasing order and sketches in chunk order
+                exception register indices (uint16, or uint32 for p > 16), in chunk and register order
+                exception values (uint8), in the same order
+            with entropy coding:
+                n uint8 model sizes s - 1, the model of a sketch being the frequencies of the values 0 to s - 1
+                the uint16 frequencies of every model, in chunk order
+                n * LANES uint32 final rANS states (min(LANES, m) lanes for small m), in chunk and lane order
+                uint16 renormalization words, in the order they are decoded
+Chunks are encoded and decoded whole, and the sketches of a chunk that share a width are unpacked together
+with a few integer operations on whole arrays.
+"""
+import struct
+import zlib
+import numpy as np
+import SketchFile
+from HLL import HLL
+
+MAGIC = b'GNOMESKZ'
+VERSION = 2
+HEADER = struct.Struct('<8sHBBBB2x')
+CHUNK = struct.Struct('<II')
+FLAG_CANONICAL = SketchFile.FLAG_CANONICAL
+FLAG_ENTROPY = 4
+FLAG_ZLIB = 8
+WIDTHS = (0, 1, 2, 4, 8)
+
+# rANS with 32-bit states kept in [RANS_LOW, 2^32) by moving 16-bit words in and out, and models quantized to
+# 2^PROB_BITS; every sketch is coded as LANES interleaved streams
+PROB_BITS = 12
+RANS_LOW = 1 << 16
+LANES = 32
+
+# unpacking a byte of 8/w values of w bits into 8/w bytes, lowest bits first: the byte is widened to an integer of
+# 8/w bytes and each (shift, mask) step moves the upper half of every group of values up into its own lane
+SPREAD = {
+    1: (np.uint64, [(28, 0x0000000F0000000F), (14, 0x0003000300030003), (7, 0x0101010101010101)]),
+    2: (np.uint32, [(12, 0x000F000F), (6, 0x03030303)]),
+    4: (np.uint16, [(4, 0x0F0F)]),
+    8: (np.uint8, []),
+}
+# the base of a sketch added to every byte lane of an unpacked integer at once
+LANE_ONES = {np.uint64: 0x0101010101010101, np.uint32: 0x01010101, np.uint16: 0x0101, np.uint8: 0x01}
+
+"""
+SketchCodec.unpack():
+Unpacks the w-bit offsets of a group of sketches of the same width and adds their bases
+
+Input: payload, an (n, m*w/8) uint8 array; w, the width (1, 2, 4 or 8); bases, a uint8 array of n bases
+       out, an (n, m) uint8 array to write the values to (optional)
+Output: an (n, m) uint8 array of values
+"""
+def unpack(payload, w, bases, out=None):
+    dtype, steps = SPREAD[w]
+    x = payload.astype(dtype, copy=False)
+    if steps:
+        shifted = np.empty_like(x)
+        for shift, mask in steps:
+            np.left_shift(x, dtype(shift), out=shifted)
+            x |= shifted
+            x &= dtype(mask)
+    if out is None:
+        out = np.empty((len(payload), x.shape[1] * x.itemsize), dtype=np.uint8)
+    if bases.max(initial=0) <= 256 - (1 << w):
+        # no lane carries into the next when no window wraps around
+        np.add(x, (bases.astype(dtype) * dtype(LANE_ONES[dtype]))[:, None], out=out.view(dtype))
+    else:
+        np.add(x.view(np.uint8).reshape(len(payload), -1), bases[:, None], out=out)
+    return out
+
+"""
+SketchCodec.index_dtype():
+Dtype of exception register indices for precision p
+"""
+def index_dtype(p):
+    return np.dtype('<u2') if p <= 16 else np.dtype('<u4')
+
+"""
+SketchCodec.register_histograms():
+256-bin histograms of the register values of every sketch
+
+Input: values, an (n, m) uint8 array
+Output: an (n, 256) int64 array of counts
+"""
+def register_histograms(values):
+    keys = (np.arange(len(values), dtype=np.int32)[:, None] << 8) | values
+    return np.bincount(keys.ravel(), minlength=len(values) * 256).reshape(len(values), 256)
+
+"""
+SketchCodec.choose_frames():
+Picks the base and width of each sketch minimizing its encoded size
+
+Input: values, an (n, m) uint8 array of registers; p, the precision
+Output: widths, bases, uint8 arrays with one entry per sketch
+"""
+def choose_frames(values, p):
+    n, m = values.shape
+    exception_bytes = index_dtype(p).itemsize + 1
+    # histograms repeated so that windows can wrap around
+    histograms = register_histograms(values)
+    cumulative = np.zeros((n, 513), dtype=np.int64)
+    np.cumsum(np.concatenate([histograms, histograms], axis=1), axis=1, out=cumulative[:, 1:])
+
+    best_size = np.full(n, m, dtype=np.int64)  # plain bytes
+    widths = np.full(n, 8, dtype=np.uint8)
+    bases = np.zeros(n, dtype=np.uint8)
+    for w in WIDTHS[:-1]:
+        window = 1 << w
+        # values in [b, b + window) modulo 256 for every base b
+        covered = cumulative[:, window:window + 256] - cumulative[:, :256]
+        base = np.argmax(covered, axis=1)
+        size = m * w // 8 + (m - covered[np.arange(n), base]) * exception_bytes
+        better = size < best_size
+        best_size[better] = size[better]
+        widths[better] = w
+        bases[better] = base[better]
+    return widths, bases
+
+"""
+SketchCodec.quantize_frequencies():
+rANS models of a group of sketches: their register histograms scaled to sum to 2^PROB_BITS, every value that
+occurs keeping a frequency of at least 1, and the rounding error taken from or given to the most frequent value
+
+Input: histograms, an (n, 256) array of counts from register_histograms(); m, the number of registers
+Output: an (n, 256) int64 array of frequencies
+"""
+def quantize_frequencies(histograms, m):
+    total = 1 << PROB_BITS
+    frequencies = histograms * total // m
+    frequencies[(histograms > 0) & (frequencies == 0)] = 1
+    top = np.argmax(frequencies, axis=1)
+    frequencies[np.arange(len(frequencies)), top] += total - frequencies.sum(axis=1)
+    return frequencies
+
+"""
+SketchCodec.encode_entropy():
+rANS codes the registers of a chunk of sketches, LANES interleaved streams per sketch and one step per register
+of a lane, see the module docstring. Registers are coded last to first so that they decode first to last.
+
+Input: values, an (n, m) uint8 array of registers
+Output: a list of byte strings, the parts of the chunk body after the names
+"""
+def encode_entropy(values):
+    n, m = values.shape
+    lanes = min(LANES, m)
+    frequencies = quantize_frequencies(register_histograms(values), m)
+    starts = np.cumsum(frequencies, axis=1) - frequencies
+    sizes = 256 - np.argmax(frequencies[:, ::-1] > 0, axis=1)
+    rows = (np.arange(n) * 256)[:, None]
+    flat_frequencies = frequencies.ravel().astype(np.uint64)
+    flat_starts = starts.ravel().astype(np.uint64)
+
+    steps = values.reshape(n, m // lanes, lanes)
+    states = np.full((n, lanes), RANS_LOW, dtype=np.uint64)
+    words = []
+    for t in range(m // lanes - 1, -1, -1):
+        keys = rows + steps[:, t]
+        frequency = flat_frequencies[keys]
+        # a state that coding the register would take past 2^32 first moves its low 16 bits out
+        spill = np.flatnonzero(states >= frequency << np.uint64(32 - PROB_BITS))
+        flat_states = states.reshape(-1)
+        words.append(flat_states[spill].astype('<u2'))
+        flat_states[spill] >>= np.uint64(16)
+        quotient, remainder = np.divmod(states, frequency)
+        states = (quotient << np.uint64(PROB_BITS)) + remainder + flat_starts[keys]
+    models = np.arange(256) < sizes[:, None]
+    return [(sizes - 1).astype(np.uint8).tobytes(), frequencies[models].astype('<u2').tobytes(),
+            states.astype('<u4').tobytes()] + [w.tobytes() for w in reversed(words)]
+
+"""
+SketchCodec.decode_entropy():
+Decodes the registers of a chunk coded by encode_entropy()
+Every slot of a model, i.e. every value of the low PROB_BITS bits of a state, is looked up in one table of
+uint32 entries packing the register it decodes to (8 bits), the frequency of that register less 1 and the slot's
+offset into the register's range of slots (PROB_BITS bits each), so each step gathers a single array
+
+Input: data, the uint8 chunk body after the names; n, the number of sketches; m, the number of registers
+       out, an (n, m) uint8 array to write the registers to
+"""
+def decode_entropy(data, n, m, out):
+    lanes = min(LANES, m)
+    sizes = data[:n].astype(np.intp) + 1
+    position = n
+    total = int(sizes.sum())
+    frequencies = np.zeros((n, 256), dtype=np.uint32)
+    frequencies[np.arange(256) < sizes[:, None]] = data[position:position + 2 * total].view('<u2')
+    position += 2 * total
+    states = data[position:position + 4 * n * lanes].view('<u4').reshape(n, lanes).astype(np.uint32)
+    position += 4 * n * lanes
+    words = data[position:].view('<u2')
+
+    mask = np.uint32((1 << PROB_BITS) - 1)
+    counts = frequencies.ravel()
+    starts = (np.cumsum(frequencies, axis=1) - frequencies).ravel()
+    values = np.tile(np.arange(256, dtype=np.uint32), n)
+    entries = np.repeat((values << np.uint32(2 * PROB_BITS)) | ((counts - np.uint32(1)) << np.uint32(PROB_BITS)), counts)
+    entries |= (np.arange(n << PROB_BITS, dtype=np.uint32) & mask) - np.repeat(starts, counts)
+    rows = (np.arange(n, dtype=np.uint32) << np.uint32(PROB_BITS))[:, None]
+
+    steps = out.reshape(n, m // lanes, lanes)
+    flat_states = states.reshape(-1)
+    position = 0
+    for t in range(m // lanes):
+        entry = entries[rows | (states & mask)]
+        steps[:, t] = entry >> np.uint32(2 * PROB_BITS)
+        # the state becomes frequency * (state >> PROB_BITS) + offset
+        states >>= np.uint32(PROB_BITS)
+        states += states * ((entry >> np.uint32(PROB_BITS)) & mask) + (entry & mask)
+        refill = np.flatnonzero(flat_states < RANS_LOW)
+        flat_states[refill] = (flat_states[refill] << np.uint32(16)) | words[position:position + len(refill)]
+        position += len(refill)
+    return
+
+"""
+SketchCodec.encode_chunk():
+Encodes the registers of up to a chunk of sketches, see the module docstring
+
+Input: registers, an (n, m) uint8 array; names, a list of n strings; p, the precision
+       entropy, whether to rANS code the registers instead of using frames
+Output: the chunk body as bytes
+"""
+def encode_chunk(registers, names, p, entropy=False):
+    n, m = registers.shape
+    encoded = [name.encode('utf-8') for name in names]
+    name_offsets = np.zeros(n + 1, dtype='<u4')
+    name_offsets[1:] = np.cumsum([len(name) for name in encoded])
+    parts = [name_offsets.tobytes(), b''.join(encoded)]
+    if entropy:
+        return b''.join(parts + encode_entropy(registers))
+
+    widths, bases = choose_frames(registers, p)
+    offsets = registers - bases[:, None]  # modulo 256, like the windows
+    exceptions = offsets >= (np.uint16(1) << widths.astype(np.uint16))[:, None]
+    exceptions[widths == 8] = False
+    rows, columns = np.nonzero(exceptions)
+    offsets[exceptions] = 0
+
+    parts += [widths.tobytes(), bases.tobytes(), exceptions.sum(axis=1).astype('<u4').tobytes()]
+    for w in WIDTHS[1:]:
+        group = offsets[widths == w]
+        if len(group) == 0:
+            continue
+        if w < 8:
+            # 8/w values per byte, lowest bits first: the byte lanes of each integer of 8/w bytes are gathered
+            dtype = SPREAD[w][0]
+            lanes = np.ascontiguousarray(group).view(dtype)
+            packed = lanes & dtype(0xFF)
+            for j in range(1, 8 // w):
+                packed |= ((lanes >> dtype(8 * j)) & dtype(0xFF)) << dtype(w * j)
+            group = packed.astype(np.uint8)
+        parts.append(group.tobytes())
+    parts.append(columns.astype(index_dtype(p)).tobytes())
+    parts.append(registers[rows, columns].tobytes())
+    return b''.join(parts)
+
+"""
+SketchCodec.decode_chunk():
+Decodes a chunk body produced by encode_chunk()
+
+Input: body, bytes; n, the number of sketches; p, the precision; entropy, as given to encode_chunk()
+       out, an (n, m) uint8 array to decode the registers into (optional)
+Output: registers, an (n, m) uint8 array; names, a list of n strings
+"""
+def decode_chunk(body, n, p, entropy=False, out=None):
+    m = 2 ** p
+    data = np.frombuffer(body, dtype=np.uint8)
+    name_offsets = data[:4 * (n + 1)].view('<u4')
+    position = 4 * (n + 1)
+    names_data = bytes(data[position:position + int(name_offsets[-1])])
+    bounds = name_offsets.tolist()
+    if names_data.isascii():
+        # byte offsets are character offsets, so the names are sliced from one decoded string
+        names_data = names_data.decode('ascii')
+    names = [names_data[bounds[i]:bounds[i + 1]] for i in range(n)]
+    if not isinstance(names_data, str):
+        names = [name.decode('utf-8') for name in names]
+    position += int(name_offsets[-1])
+    registers = np.empty((n, m), dtype=np.uint8) if out is None else out
+    if entropy:
+        decode_entropy(data[position:], n, m, registers)
+        return registers, names
+
+    widths = data[position:position + n]
+    bases = data[position + n:position + 2 * n]
+    counts = data[position + 2 * n:position + 6 * n].view('<u4')
+    position += 6 * n
+    for w in WIDTHS:
+        rows = np.flatnonzero(widths == w)
+        if len(rows) == 0:
+            continue
+        size = len(rows) * m * w // 8
+        payload = data[position:position + size].reshape(len(rows), m * w // 8)
+        position += size
+        if w == 0:
+            registers[rows] = bases[rows, None]
+        elif len(rows) == n:
+            unpack(payload, w, bases, registers)
+        else:
+            registers[rows] = unpack(payload, w, bases[rows])
+
+    total = int(counts.sum())
+    if total:
+        index_size = index_dtype(p).itemsize
+        columns = data[position:position + total * index_size].view(index_dtype(p))
+        position += total * index_size
+        registers[np.repeat(np.arange(n), counts), columns] = data[position:position + total]
+    return registers, names
+
+class SketchWriter:
+    """Writes sketches to a compressed stream a chunk at a time"""
+
+    def __init__(self, f, p, hash_name, k=25, canonical=False, entropy=False, chunk_size=1024, zlib_level=0):
+        # f is a binary file object, e.g. an open file or a socket's makefile('wb')
+        self.f = f
+        self.p = p
+        self.m = 2 ** p
+        self.hash_name = hash_name
+        self.entropy = entropy
+        self.chunk_size = chunk_size
+        self.zlib_level = zlib_level
+        self.names = []
+        self.blocks = []
+
+        flags = ((FLAG_CANONICAL if canonical else 0) | (FLAG_ENTROPY if entropy else 0) |
+                 (FLAG_ZLIB if zlib_level else 0))
+        f.write(HEADER.pack(MAGIC, VERSION, p, SketchFile.HASH_IDS[hash_name], k, flags))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    SketchWriter.write():
+    Adds a sketch to the stream, writing a chunk every chunk_size sketches
+
+    Input: name, a string; hll, an HLL with the writer's p and hash function
+    """
+    def write(self, name, hll):
+        if hll.p != self.p or hll.hash_name != self.hash_name:
+            raise ValueError('Cannot write a sketch with p = {} and hash {} to a stream with p = {} and hash {}'.format(
+                hll.p, hll.hash_name, self.p, self.hash_name))
+        self.names.append(name)
+        self.blocks.append(hll.getRegisters())
+        if len(self.names) >= self.chunk_size:
+            self.flush()
+        return
+
+    """
+    SketchWriter.flush():
+    Writes the buffered sketches as a chunk
+    """
+    def flush(self):
+        if not self.names:
+            return
+        body = encode_chunk(np.stack(self.blocks), self.names, self.p, self.entropy)
+        if self.zlib_level:
+            body = zlib.compress(body, self.zlib_level)
+        self.f.write(CHUNK.pack(len(self.names), len(body)))
+        self.f.write(body)
+        self.names = []
+        self.blocks = []
+        return
+
+    """
+    SketchWriter.close():
+    Writes the last chunk and the end of the stream; the file object is left open
+    """
+    def close(self):
+        self.flush()
+        self.f.write(CHUNK.pack(0, 0))
+        self.f.flush()
+        return
+
+class SketchReader:
+    """Reads sketches from a compressed stream a chunk at a time"""
+
+    def __init__(self, f):
+        self.f = f
+        magic, version, self.p, hash_id, self.k, flags = HEADER.unpack(read_exactly(f, HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('Not a compressed sketch stream')
+        if version != VERSION:
+            raise ValueError('Unsupported compressed sketch stream version {}'.format(version))
+        if hash_id not in SketchFile.HASH_NAMES:
+            raise ValueError('Unknown hash id {}'.format(hash_id))
+        self.hash_name = SketchFile.HASH_NAMES[hash_id]
+        self.m = 2 ** self.p
+        self.canonical = bool(flags & FLAG_CANONICAL)
+        self.entropy = bool(flags & FLAG_ENTROPY)
+        self.compressed = bool(flags & FLAG_ZLIB)
+
+    """
+    SketchReader.bodies():
+    Reads the stream a chunk at a time, without decoding
+
+    Output: yields (n, body) for each chunk, its number of sketches and its body after zlib decompression
+    """
+    def bodies(self):
+        while True:
+            n, size = CHUNK.unpack(read_exactly(self.f, CHUNK.size))
+            if n == 0:
+                return
+            body = read_exactly(self.f, size)
+            if self.compressed:
+                body = zlib.decompress(body)
+            yield n, body
+
+    """
+    SketchReader.chunks():
+    Decodes the stream a chunk at a time
+
+    Output: yields (registers, names) for each chunk, an (n, m) uint8 array and a list of n strings
+    """
+    def chunks(self):
+        for n, body in self.bodies():
+            yield decode_chunk(body, n, self.p, self.entropy)
+
+    """
+    SketchReader.read_registers():
+    Decodes the rest of the stream
+    The chunks are read first, so that they can be decoded straight into one array of registers
+
+    Output: registers, an (n, m) uint8 array; names, a list of n strings
+    """
+    def read_registers(self):
+        bodies = list(self.bodies())
+        registers = np.empty((sum(n for n, _ in bodies), self.m), dtype=np.uint8)
+        names = []
+        start = 0
+        for n, body in bodies:
+            names += decode_chunk(body, n, self.p, self.entropy, registers[start:start + n])[1]
+            start += n
+        return registers, names
+
+    def __iter__(self):
+        for registers, names in self.chunks():
+            for name, row in zip(names, registers):
+                yield name, HLL(self.p, row, hash_name=self.hash_name)
+
+"""
+SketchCodec.read_exactly():
+Reads size bytes from a file object, raising an EOFError if the stream ends first
+"""
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError('Compressed sketch stream ended after {} of {} bytes'.format(len(data), size))
+    return data
+
+"""
+SketchCodec.write_sketches():
+Writes a list of HLLs and their names to a compressed sketch file
+
+Input: path, sketches, names, k, canonical, as in SketchFile.write_sketches()
+       entropy, whether to rANS code the registers, which is smaller but slower to decode
+       chunk_size, sketches per chunk; zlib_level, zlib level for the chunks (0 for none)
+"""
+def write_sketches(path, sketches, names, k=25, canonical=False, entropy=False, chunk_size=1024, zlib_level=0):
+    if len(sketches) != len(names):
+        raise ValueError('Got {} sketches but {} names'.format(len(sketches), len(names)))
+    if len(sketches) == 0:
+        raise ValueError('Cannot write a sketch file without sketches')
+    for h in sketches[1:]:
+        sketches[0].check_compatible(h)
+    with open(path, 'wb') as f:
+        with SketchWriter(f, sketches[0].p, sketches[0].hash_name, k, canonical, entropy, chunk_size, zlib_level) as writer:
+            for name, hll in zip(names, sketches):
+                writer.write(name, hll)
+    return
+
+"""
+SketchCodec.is_compressed_file():
+Checks whether a file is a compressed sketch file
+
+Input: path, a filename
+Output: True if the file starts with the compressed sketch magic bytes
+"""
+def is_compressed_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+"""
+SketchCodec.read_registers():
+Decodes every sketch of a compressed sketch file
+
+Input: path, a filename
+Output: registers, an (n, m) uint8 array; names, a list of n strings; the SketchReader, for p, k and the hash function
+"""
+def read_registers(path):
+    with open(path, 'rb') as f:
+        reader = SketchReader(f)
+        registers, names = reader.read_registers()
+    return registers, names, reader
+
+"""
+SketchCodec.read_sketches():
+Loads every sketch in a compressed sketch file into memory
+
+Input: path, a filename
+Output: sketches, a list of HLLs; names, a list of names the same length as sketches
+"""
+def read_sketches(path):
+    registers, names, reader = read_registers(path)
+    return [HLL(reader.p, row, hash_name=reader.hash_name) for row in registers], names
@@ -0,0 +1,308 @@
+"""
+SketchDatabase.py: Persistent collection of named HLL sketches with cached cardinalities and pairwise similarities
+
+A database is a directory:
+    index.json      format version, p, hash function, k, canonical, and for each sketch its name,
+                    content digest, estimated cardinality and, for sketches of files, the file's size and mtime
+    sketches/       one <digest>.npy file of dense registers per distinct sketch
+    pairs.bin       append-only records of PAIR_DTYPE, the Jaccard, Sorensen-Dice and Forbes similarity
+                    of two sketches keyed by their content digests
+
+Pairs are keyed by content rather than by name, so renaming or re-adding an identical sketch keeps its results.
+The cache is held as a sorted array of keys (the two digests, smaller first) and looked up for every pair of a
+collection at once with searchsorted, so a run over n sketches does no per-pair Python work.
+Adding a sketch to a database of n sketches costs n new comparisons the next time the similarity matrices
+are requested; removing one only drops it from the index.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import Cardinality
+import Hash
+import SimilarityMatrix
+from HLL import HLL
+
+VERSION = 1
+DIGEST_SIZE = 16
+# digests are stored as hex, numpy bytes fields would drop trailing zero bytes
+PAIR_DTYPE = np.dtype([('a', 'S{}'.format(2 * DIGEST_SIZE)), ('b', 'S{}'.format(2 * DIGEST_SIZE)),
+                       ('jaccard', '<f8'), ('sd', '<f8'), ('forbes', '<f8')])
+# a pair key is the two hex digests of a record side by side
+KEY_DTYPE = np.dtype('S{}'.format(4 * DIGEST_SIZE))
+
+"""
+SketchDatabase.pair_keys():
+Keys of pairs of sketches, the digest that sorts first followed by the other
+
+Input: a, b, numpy arrays of hex digests (dtype S32)
+Output: a numpy array of keys (dtype KEY_DTYPE)
+"""
+def pair_keys(a, b):
+    first = np.where(a <= b, a, b)
+    second = np.where(a <= b, b, a)
+    size = 2 * DIGEST_SIZE
+    keys = np.empty((len(a), 2 * size), dtype=np.uint8)
+    keys[:, :size] = np.ascontiguousarray(first).view(np.uint8).reshape(-1, size)
+    keys[:, size:] = np.ascontiguousarray(second).view(np.uint8).reshape(-1, size)
+    return keys.view(KEY_DTYPE).ravel()
+
+"""
+SketchDatabase.file_stamp():
+Size and modification time of a file, stored with its sketch to detect files changed since they were sketched
+
+Input: path, a filename
+Output: a [size, mtime in nanoseconds] list
+"""
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+"""
+SketchDatabase.sketch_digest():
+Content hash of an HLL, identifying a sketch in the pair cache
+
+Input: hll, an HLL
+Output: a hex string of DIGEST_SIZE bytes
+"""
+def sketch_digest(hll):
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    h.update('{}:{}:'.format(hll.p, hll.hash_name).encode('utf-8'))
+    h.update(np.ascontiguousarray(hll.getRegisters(), dtype=np.uint8).tobytes())
+    return h.hexdigest()
+
+class SketchDatabase:
+    """Directory of named sketches with a cache of pairwise similarities"""
+
+    def __init__(self, path, p=None, hash_name=None, k=None, canonical=None):
+        # parameters that are given must match an existing database, the rest are read from it
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.sketch_dir = os.path.join(path, 'sketches')
+        self.pairs_path = os.path.join(path, 'pairs.bin')
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index['version'] != VERSION:
+                raise ValueError('Unsupported sketch database version {}'.format(index['version']))
+            for name, value in (('p', p), ('hash', hash_name), ('k', k), ('canonical', canonical)):
+                if value is not None and value != index[name]:
+                    raise ValueError('Sketch database {} has {} = {}, not {}'.format(path, name, index[name], value))
+            self.p, self.hash_name, self.k, self.canonical = index['p'], index['hash'], index['k'], index['canonical']
+            self.entries = {e['name']: (e['digest'], e['cardinality']) for e in index['sketches']}
+            self.stamps = {e['name']: e['stamp'] for e in index['sketches'] if e.get('stamp') is not None}
+        else:
+            self.p = 12 if p is None else p
+            self.hash_name = Hash.DEFAULT_HASH if hash_name is None else hash_name
+            self.k = 25 if k is None else k
+            self.canonical = False if canonical is None else canonical
+            self.entries = {}
+            self.stamps = {}
+        os.makedirs(self.sketch_dir, exist_ok=True)
+
+        # sorted, distinct pair keys and their (jaccard, sd, forbes) values
+        self.pair_keys = np.zeros(0, dtype=KEY_DTYPE)
+        self.pair_values = np.zeros((0, 3))
+        if os.path.exists(self.pairs_path):
+            records = np.fromfile(self.pairs_path, dtype=PAIR_DTYPE)
+            self._merge_pairs(pair_keys(records['a'], records['b']),
+                              np.stack([records['jaccard'], records['sd'], records['forbes']], axis=1))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    """
+    SketchDatabase.is_current():
+    Whether the sketch of a file is up to date: the file has the size and mtime it had when it was added
+
+    Input: name, the name of a sketch; path, the file it was built from
+    Output: False if there is no such sketch, it was added without a file, or the file changed since
+    """
+    def is_current(self, name, path):
+        return name in self.entries and self.stamps.get(name) == file_stamp(path)
+
+    """
+    SketchDatabase.names():
+    Returns the names of all sketches, sorted
+    """
+    def names(self):
+        return sorted(self.entries)
+
+    """
+    SketchDatabase.get():
+    Reads a sketch from the database
+
+    Input: name, the name of a sketch
+    Output: an HLL (sparse where few registers are set)
+    """
+    def get(self, name):
+        digest, _ = self.entries[name]
+        registers = np.load(self._sketch_path(digest))
+        return HLL(self.p, registers, hash_name=self.hash_name, sparse=True)
+
+    """
+    SketchDatabase.cardinality():
+    Returns the cached cardinality estimate of a sketch
+
+    Input: name, the name of a sketch
+    Output: a float
+    """
+    def cardinality(self, name):
+        return self.entries[name][1]
+
+    """
+    SketchDatabase.add():
+    Adds a sketch to the database, replacing any sketch of the same name
+    The registers are written immediately, the index on save()
+
+    Input: name, a string; hll, an HLL built with the database's p and hash function
+           source, the file the sketch was built from (optional), whose size and mtime are kept for is_current()
+    """
+    def add(self, name, hll, source=None):
+        if hll.p != self.p or hll.hash_name != self.hash_name:
+            raise ValueError('Cannot add a sketch with p = {} and hash {} to a database with p = {} and hash {}'.format(
+                hll.p, hll.hash_name, self.p, self.hash_name))
+        digest = sketch_digest(hll)
+        sketch_path = self._sketch_path(digest)
+        if not os.path.exists(sketch_path):
+            np.save(sketch_path, hll.getRegisters())
+        # estimated the same way as SimilarityMatrix does, so cached and recomputed values agree
+        cardinality = Cardinality.estimateCardinalities(Cardinality.getMultiplicity(hll))[0]
+        self.entries[name] = (digest, float(cardinality))
+        if source is not None:
+            self.stamps[name] = file_stamp(source)
+        else:
+            self.stamps.pop(name, None)
+        return
+
+    """
+    SketchDatabase.remove():
+    Removes a sketch from the database; cached pairs are kept until compact()
+
+    Input: name, the name of a sketch
+    """
+    def remove(self, name):
+        del self.entries[name]
+        self.stamps.pop(name, None)
+        return
+
+    """
+    SketchDatabase.save():
+    Writes the index, replacing the previous one atomically
+    """
+    def save(self):
+        index = {'version': VERSION, 'p': self.p, 'hash': self.hash_name, 'k': self.k, 'canonical': self.canonical,
+                 'sketches': [{'name': name, 'digest': digest, 'cardinality': cardinality, 'stamp': self.stamps.get(name)}
+                              for name, (digest, cardinality) in sorted(self.entries.items())]}
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+        return
+
+    """
+    SketchDatabase.compact():
+    Deletes sketch files and cached pairs of sketches that are no longer in the index, and saves the index
+    """
+    def compact(self):
+        self.save()
+        live = {digest for digest, _ in self.entries.values()}
+        for filename in os.listdir(self.sketch_dir):
+            digest = os.path.splitext(filename)[0]
+            if digest not in live:
+                os.remove(os.path.join(self.sketch_dir, filename))
+
+        halves = self.pair_keys.view(np.uint8).reshape(-1, 2, 2 * DIGEST_SIZE)
+        live = np.array(sorted(live), dtype='S{}'.format(2 * DIGEST_SIZE))
+        keep = (np.isin(np.ascontiguousarray(halves[:, 0]).view(live.dtype).ravel(), live) &
+                np.isin(np.ascontiguousarray(halves[:, 1]).view(live.dtype).ravel(), live))
+        self.pair_keys = self.pair_keys[keep]
+        self.pair_values = self.pair_values[keep]
+        tmp_path = self.pairs_path + '.tmp'
+        self._pair_records(self.pair_keys, self.pair_values).tofile(tmp_path)
+        os.replace(tmp_path, self.pairs_path)
+        return
+
+    """
+    SketchDatabase.similarity_matrices():
+    Jaccard, Sorensen-Dice and Forbes similarity matrices for a list of sketches, as SimilarityMatrix.similarity_matrices()
+    computes them. Pairs found in the cache are not recomputed; the others are computed with
+    SimilarityMatrix.pair_similarities() and appended to the cache.
+
+    Input: sketches, a list of HLLs built with the database's p and hash function (default: every sketch in names() order)
+           block_size, workers, as in SimilarityMatrix.pair_similarities()
+    Output: jaccard, sd and forbes; symmetric (n, n) numpy arrays
+    """
+    def similarity_matrices(self, sketches=None, block_size=1024, workers=1):
+        if sketches is None:
+            sketches = [self.get(name) for name in self.names()]
+        for h in sketches:
+            if h.p != self.p or h.hash_name != self.hash_name:
+                raise ValueError('Sketch with p = {} and hash {} does not match the database'.format(h.p, h.hash_name))
+        n = len(sketches)
+        digests = np.array([sketch_digest(h) for h in sketches], dtype='S{}'.format(2 * DIGEST_SIZE))
+
+        rows, cols = np.triu_indices(n)
+        # each pair is keyed and computed with the smaller digest first
+        keys = pair_keys(digests[rows], digests[cols])
+        positions = np.searchsorted(self.pair_keys, keys)
+        found = positions < len(self.pair_keys)
+        found[found] = self.pair_keys[positions[found]] == keys[found]
+        values = np.zeros((len(keys), 3))
+        values[found] = self.pair_values[positions[found]]
+
+        if not found.all():
+            # identical sketches under different names give the same key, each missing key is computed once
+            missing_keys, inverse = np.unique(keys[~found], return_inverse=True)
+            halves = missing_keys.view(np.uint8).reshape(-1, 2, 2 * DIGEST_SIZE)
+            first = np.ascontiguousarray(halves[:, 0]).view(digests.dtype).ravel()
+            second = np.ascontiguousarray(halves[:, 1]).view(digests.dtype).ravel()
+
+            # only the sketches of missing pairs are stacked
+            needed = np.unique(np.concatenate([first, second]))
+            by_digest = dict(zip(digests.tolist(), sketches))
+            registers = SimilarityMatrix.stack_registers([by_digest[digest] for digest in needed.tolist()])
+            q = 64 - self.p
+
+            # cardinalities of sketches in the database are cached, the others are estimated
+            cached = {digest.encode('ascii'): cardinality for digest, cardinality in self.entries.values()}
+            cardinalities = Cardinality.estimateCardinalities(SimilarityMatrix.multiplicities(registers, q))
+            for r, digest in enumerate(needed.tolist()):
+                if digest in cached:
+                    cardinalities[r] = cached[digest]
+
+            a = np.searchsorted(needed, first)
+            b = np.searchsorted(needed, second)
+            computed = np.stack(SimilarityMatrix.pair_similarities(registers, cardinalities, a, b, q, block_size, workers), axis=1)
+            values[~found] = computed[inverse.ravel()]
+
+            self._merge_pairs(missing_keys, computed)
+            with open(self.pairs_path, 'ab') as f:
+                f.write(self._pair_records(missing_keys, computed).tobytes())
+
+        return SimilarityMatrix.fill_matrices(n, rows, cols, values[:, 0], values[:, 1], values[:, 2])
+
+    def _sketch_path(self, digest):
+        return os.path.join(self.sketch_dir, digest + '.npy')
+
+    def _merge_pairs(self, keys, values):
+        # a key added twice keeps its latest values
+        keys = np.concatenate([self.pair_keys, keys])
+        values = np.concatenate([self.pair_values, values])
+        order = np.argsort(keys, kind='stable')[::-1]
+        keys, first = np.unique(keys[order], return_index=True)
+        self.pair_keys = keys
+        self.pair_values = values[order][first]
+
+    @staticmethod
+    def _pair_records(keys, values):
+        halves = keys.view(np.uint8).reshape(-1, 2, 2 * DIGEST_SIZE)
+        records = np.zeros(len(keys), dtype=PAIR_DTYPE)
+        records['a'] = np.ascontiguousarray(halves[:, 0]).view(PAIR_DTYPE['a']).ravel()
+        records['b'] = np.ascontiguousarray(halves[:, 1]).view(PAIR_DTYPE['b']).ravel()
+        records['jaccard'], records['sd'], records['forbes'] = values.T
+        return records
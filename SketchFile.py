@@ -0,0 +1,180 @@
+"""
+SketchFile.py: Versioned binary file format for collections of HLL sketches
+
+Replaces pickling lists of HLL objects. Files are read through np.memmap, so opening a file only
+parses the header and each sketch is read from disk when it is accessed.
+
+File layout (all integers little-endian):
+    header, 64 bytes:
+        magic           8 bytes     b'GNOMESKT'
+        version         uint16      currently 1
+        p               uint8       precision, every sketch has 2^p registers
+        hash id         uint8       hash function used to build the sketches (see HASH_IDS)
+        k               uint8       k-mer size
+        flags           uint8       bit 0 set if register blocks are 6-bit packed,
+                                    bit 1 set if the sketches were built from canonical k-mers
+        (padding)       2 bytes
+        count           uint64      number of sketches n
+        names offset    uint64      offset of the name index
+        registers offset uint64     offset of the first register block, a multiple of PAGE_SIZE
+        block size      uint64      bytes per register block (m, or 3m/4 if packed)
+        (reserved)      16 bytes
+    name index:
+        n+1 uint64 offsets into the name data, followed by the UTF-8 name data
+    register blocks:
+        n contiguous blocks of block size bytes, in the same order as the names
+"""
+import struct
+import numpy as np
+from HLL import HLL
+
+MAGIC = b'GNOMESKT'
+VERSION = 1
+HEADER = struct.Struct('<8sHBBBB2xQQQQ16x')
+PAGE_SIZE = 4096
+FLAG_PACKED = 1
+FLAG_CANONICAL = 2
+
+# ids of the hash functions in Hash.HASHES, stored in the header
+HASH_IDS = {'wang64': 0, 'murmur3': 1, 'xxhash64': 2}
+HASH_NAMES = {hash_id: name for name, hash_id in HASH_IDS.items()}
+
+"""
+SketchFile.write_sketches():
+Writes a list of HLLs and their names to a sketch file
+
+Input: path, the output filename; sketches, a non-empty list of compatible HLLs (same p and hash function, all packed
+       or none); names, a list of strings; k, the k-mer size the sketches were built with; canonical, whether the
+       sketches were built from canonical k-mers
+Raises a ValueError for an empty list, or sketches and names of different lengths
+"""
+def write_sketches(path, sketches, names, k=25, canonical=False):
+    if len(sketches) != len(names):
+        raise ValueError('Got {} sketches but {} names'.format(len(sketches), len(names)))
+    if len(sketches) == 0:
+        raise ValueError('Cannot write a sketch file without sketches')
+    p = sketches[0].p
+    packed = sketches[0].packed
+    hash_name = sketches[0].hash_name
+    for h in sketches[1:]:
+        sketches[0].check_compatible(h)
+    if not all(h.packed == packed for h in sketches):
+        raise ValueError('Cannot write packed and unpacked sketches to the same sketch file')
+
+    # packed sketches are written as stored, sparse ones are expanded
+    blocks = [np.asarray(h.registers if h.packed else h.getRegisters(), dtype=np.uint8) for h in sketches]
+    block_size = len(blocks[0])
+
+    encoded = [name.encode('utf-8') for name in names]
+    name_offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    name_offsets[1:] = np.cumsum([len(name) for name in encoded])
+
+    names_offset = HEADER.size
+    names_end = names_offset + name_offsets.nbytes + int(name_offsets[-1])
+    registers_offset = -(-names_end // PAGE_SIZE) * PAGE_SIZE  # round up to a page boundary
+
+    flags = (FLAG_PACKED if packed else 0) | (FLAG_CANONICAL if canonical else 0)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, p, HASH_IDS[hash_name], k, flags,
+                            len(sketches), names_offset, registers_offset, block_size))
+        f.write(name_offsets.tobytes())
+        f.write(b''.join(encoded))
+        f.write(b'\0' * (registers_offset - names_end))
+        for block in blocks:
+            f.write(block.tobytes())
+    return
+
+"""
+SketchFile.is_sketch_file():
+Checks whether a file is in this format (as opposed to a legacy pickled .sketch file)
+
+Input: path, a filename
+Output: True if the file starts with the sketch file magic bytes
+"""
+def is_sketch_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class SketchFile:
+    """Memory-mapped reader for a sketch file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        (magic, version, self.p, self.hash_id, self.k, self.flags, self.count,
+         names_offset, registers_offset, self.block_size) = HEADER.unpack(self.data[:HEADER.size].tobytes())
+        if magic != MAGIC:
+            raise ValueError('{} is not a sketch file'.format(path))
+        if version != VERSION:
+            raise ValueError('Unsupported sketch file version {}'.format(version))
+
+        if self.hash_id not in HASH_NAMES:
+            raise ValueError('Unknown hash id {} in {}'.format(self.hash_id, path))
+        self.hash_name = HASH_NAMES[self.hash_id]
+        self.packed = bool(self.flags & FLAG_PACKED)
+        self.canonical = bool(self.flags & FLAG_CANONICAL)
+        n = self.count
+        self.name_offsets = self.data[names_offset:names_offset + 8 * (n + 1)].view('<u8')
+        self.names_data = names_offset + 8 * (n + 1)
+        self.blocks = self.data[registers_offset:registers_offset + n * self.block_size].reshape(n, self.block_size)
+
+    def __len__(self):
+        return self.count
+
+    """
+    SketchFile.name():
+    Returns the name of the i-th sketch
+
+    Input: i, a sketch index
+    Output: the name as a string
+    """
+    def name(self, i):
+        start = self.names_data + int(self.name_offsets[i])
+        end = self.names_data + int(self.name_offsets[i + 1])
+        return self.data[start:end].tobytes().decode('utf-8')
+
+    """
+    SketchFile.names():
+    Returns the names of all sketches, in file order
+    """
+    def names(self):
+        return [self.name(i) for i in range(self.count)]
+
+    """
+    SketchFile.registers():
+    Returns a read-only view of the i-th register block, as stored (packed or not)
+
+    Input: i, a sketch index
+    Output: a numpy uint8 array backed by the file
+    """
+    def registers(self, i):
+        return self.blocks[i]
+
+    """
+    SketchFile.__getitem__():
+    Reads the i-th sketch into memory
+
+    Input: i, a sketch index
+    Output: an HLL
+    """
+    def __getitem__(self, i):
+        hll = HLL(self.p, packed=self.packed, hash_name=self.hash_name)
+        hll.registers = np.array(self.blocks[i])
+        return hll
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+"""
+SketchFile.read_sketches():
+Loads every sketch in a sketch file into memory
+
+Input: path, a filename
+Output:
+    sketches, a list of HLLs
+    names, a list of names the same length as sketches
+"""
+def read_sketches(path):
+    sketch_file = SketchFile(path)
+    return list(sketch_file), sketch_file.names()
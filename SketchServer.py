@@ -0,0 +1,400 @@
+"""
+SketchServer.py: Long-running service that sketches samples and compares them to a reference collection
+
+Usage: python SketchServer.py REFERENCES [--host 127.0.0.1] [--port 8765 | --unix PATH] [--jobs N]
+                              [-k K] [--canonical] [--batch-size 64] [--batch-delay 0.005]
+
+       REFERENCES is a sketch file (plain or compressed) or a sketch database directory, as for Query.py
+
+The references are loaded once by the server, and their registers and cardinalities are shared with the worker
+processes through shared memory (see Query.ReferenceIndex.share()), so a request pays neither interpreter startup
+nor loading the collection, and the workers do not each hold a copy of it.
+The server speaks plain HTTP/1.1 over TCP or a Unix socket:
+    GET  /status                    JSON: the references' size, p, hash function, k and canonical flag, and
+                                    request counters
+    POST /sketch?name=NAME          body: a FASTA/FASTQ file (optionally gzip or bz2 compressed), sketched with the
+                                    references' k, canonical flag, p and hash function
+                                    response: the sketch as a compressed sketch stream (see SketchCodec.py)
+    POST /query?n=10&measure=jaccard&name=NAME
+                                    body: a FASTA/FASTQ file, or a compressed sketch stream of one or more sketches
+                                    with the references' hash function, k and canonical flag
+                                    response: JSON {"queries": [{"name", "matches": [{"name", "similarity"}],
+                                    "estimated"}]}, the top n references of each query as in Query.py
+Both POST endpoints also take k=K and canonical=0/1; a request whose k-mers differ from the references' is an error.
+
+Uploads are sketched with the k-mer length and canonical flag recorded with the references, as in Query.py.
+-k and --canonical only matter for references that do not record them, and the server refuses to start when they
+conflict with the references.
+
+Sketching and comparisons run in a process pool, the event loop only parses requests and decodes sketch streams.
+Queries arriving together are batched: the first query of a batch waits up to --batch-delay seconds for up to
+--batch-size queries in total, and the whole batch is estimated by one Query.ReferenceIndex.query_batch() call.
+Errors in a request are answered with a 4xx status and JSON {"error": message}.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import signal
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import Query
+import SketchCodec
+import Sketching
+from HLL import HLL
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+# state of each worker process, set up by _init_worker()
+_worker = {}
+
+def _init_worker(state):
+    # the block is created and unlinked by the server, workers only attach to it
+    _worker['index'] = Query.ReferenceIndex.attach(state)
+
+def _index_info(index, k, canonical):
+    # raises a ValueError when k or canonical conflict with the references
+    k, canonical = index.sketch_options(k, canonical)
+    return {'references': len(index), 'p': index.p, 'hash': index.hash_name, 'k': k, 'canonical': canonical}
+
+def _sketch_upload(data, k, canonical):
+    # SequenceReader detects the format and compression from the file itself
+    index = _worker['index']
+    with tempfile.NamedTemporaryFile(suffix='.upload') as f:
+        f.write(data)
+        f.flush()
+        return Sketching.sketch_file(f.name, k, index.p, canonical, index.hash_name)
+
+def _query_batch(queries, ks, measures):
+    hlls = [HLL(p, registers, hash_name=hash_name) for registers, p, hash_name in queries]
+    return _worker['index'].query_batch(hlls, ks, measures)
+
+class RequestError(Exception):
+    """An invalid request, answered with its HTTP status and message"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class SketchServer:
+    """Sketching and query service over a reference collection loaded in a process pool"""
+
+    def __init__(self, references, jobs=1, k=None, canonical=None, batch_size=64, batch_delay=0.005,
+                 max_upload=1 << 30):
+        # k and canonical default to the values recorded with the references
+        self.references = references
+        self.jobs = jobs
+        self.k = k
+        self.canonical = canonical
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_upload = max_upload
+        self.pool = None
+        self.shared_memory = None
+        self.info = None
+        self.queue = None
+        self.batcher = None
+        self.running = set()
+        self.counters = {'sketches': 0, 'queries': 0, 'batches': 0, 'largest_batch': 0}
+
+    """
+    SketchServer.start():
+    Loads the references, starts the process pool with the index shared by every worker and starts listening
+    Raises a ValueError, before starting the pool, if k or canonical conflict with the references
+
+    Input: host, port, the TCP address to listen on; unix, a Unix socket path to listen on instead
+    Output: the asyncio server
+    """
+    async def start(self, host='127.0.0.1', port=8765, unix=None):
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, Query.ReferenceIndex.from_path, self.references)
+        self.info = _index_info(index, self.k, self.canonical)
+        self.shared_memory, state = index.share()
+        # the workers map the shared block, the server does not need its own copy of the arrays
+        del index
+        self.pool = ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker, initargs=(state,))
+        self.k, self.canonical = self.info['k'], self.info['canonical']
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.batch_queries())
+        try:
+            if unix is not None:
+                return await asyncio.start_unix_server(self.handle, path=unix)
+            return await asyncio.start_server(self.handle, host, port)
+        except BaseException:
+            await self.close()
+            raise
+
+    """
+    SketchServer.close():
+    Stops batching, shuts the process pool down and frees the shared references
+    """
+    async def close(self):
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        self.pool.shutdown()
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+    """
+    SketchServer.handle():
+    Serves the requests of one connection, keeping it open between requests unless the client closes it
+    """
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split(None, 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = content_length(headers)
+                    if length > self.max_upload:
+                        raise RequestError(413, 'Upload larger than {} bytes'.format(self.max_upload))
+                except RequestError as e:
+                    # the body cannot be skipped, so the connection is closed after the response
+                    status, content_type, body = error_response(e)
+                    keep_alive = False
+                else:
+                    data = await reader.readexactly(length)
+                    try:
+                        status, content_type, body = await self.dispatch(method, target, data)
+                    except RequestError as e:
+                        status, content_type, body = error_response(e)
+                    except ValueError as e:
+                        status, content_type, body = error_response(RequestError(400, str(e)))
+                    except Exception as e:
+                        status, content_type, body = error_response(RequestError(500, repr(e)))
+                    keep_alive = version.strip() == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, STATUS_TEXT[status], content_type, len(body), 'keep-alive' if keep_alive else 'close'
+                ).encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # a connection closed mid-request or a malformed request line
+            pass
+        finally:
+            writer.close()
+
+    """
+    SketchServer.dispatch():
+    Answers one request
+
+    Input: method, the HTTP method; target, the request path and query string; data, the request body
+    Output: the HTTP status, content type and response body
+    """
+    async def dispatch(self, method, target, data):
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        routes = {'/status': ('GET', self.status), '/sketch': ('POST', self.sketch), '/query': ('POST', self.query)}
+        if url.path not in routes:
+            raise RequestError(404, 'Unknown path {}'.format(url.path))
+        expected, handler = routes[url.path]
+        if method != expected:
+            raise RequestError(405, '{} expects {}'.format(url.path, expected))
+        return await handler(params, data)
+
+    async def status(self, params, data):
+        return json_response(dict(self.info, jobs=self.jobs, **self.counters))
+
+    """
+    SketchServer.check_kmers():
+    Checks that a k-mer length and canonical flag match the references'
+
+    Input: k, an int or None; canonical, a bool or None; what, the subject of the error message
+    """
+    def check_kmers(self, k, canonical, what):
+        if k is not None and k != self.k:
+            raise RequestError(400, '{} with k = {} cannot be compared to references sketched with k = {}'.format(
+                what, k, self.k))
+        if canonical is not None and canonical != self.canonical:
+            raise RequestError(400, '{} {}canonical k-mers cannot be compared to references sketched {}them'.format(
+                what, 'with ' if canonical else 'without ', 'with ' if self.canonical else 'without '))
+
+    """
+    SketchServer.check_params():
+    Checks the optional k and canonical parameters of a request against the references'
+    """
+    def check_params(self, params):
+        k = int(params['k']) if 'k' in params else None
+        canonical = params['canonical'] not in ('0', 'false') if 'canonical' in params else None
+        self.check_kmers(k, canonical, 'Sketches')
+
+    async def sketch(self, params, data):
+        self.check_params(params)
+        registers = await self.sketch_sequences(data)
+        f = io.BytesIO()
+        with SketchCodec.SketchWriter(f, self.info['p'], self.info['hash'], self.k, self.canonical) as writer:
+            writer.write(params.get('name', 'sketch'), HLL(self.info['p'], registers, hash_name=self.info['hash']))
+        return 200, 'application/octet-stream', f.getvalue()
+
+    async def query(self, params, data):
+        n = int(params.get('n', 10))
+        measure = params.get('measure', 'jaccard')
+        if measure not in Query.MEASURES:
+            raise RequestError(400, 'Unknown measure {}, expected one of {}'.format(measure, ', '.join(Query.MEASURES)))
+        self.check_params(params)
+
+        if data.startswith(SketchCodec.MAGIC):
+            reader = SketchCodec.SketchReader(io.BytesIO(data))
+            registers, names = reader.read_registers()
+            p, hash_name = reader.p, reader.hash_name
+            if hash_name != self.info['hash']:
+                raise RequestError(400, 'Sketches built with hash {} cannot be compared to references built with {}'.format(
+                    hash_name, self.info['hash']))
+            if p < self.info['p']:
+                raise RequestError(400, 'Sketches with p = {} cannot be compared to references with p = {}'.format(
+                    p, self.info['p']))
+            self.check_kmers(reader.k, reader.canonical, 'Sketches')
+        else:
+            registers = [await self.sketch_sequences(data)]
+            names = [params.get('name', 'query')]
+            p, hash_name = self.info['p'], self.info['hash']
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for row in registers:
+            future = loop.create_future()
+            await self.queue.put(((row, p, hash_name), n, measure, future))
+            futures.append(future)
+        results = await asyncio.gather(*futures)
+        return json_response({'queries': [
+            {'name': name, 'matches': [{'name': match, 'similarity': similarity} for match, similarity in matches],
+             'estimated': estimated}
+            for name, (matches, estimated) in zip(names, results)]})
+
+    """
+    SketchServer.sketch_sequences():
+    Sketches an uploaded FASTA/FASTQ file in the process pool
+
+    Input: data, the bytes of the file
+    Output: the registers of its sketch
+    """
+    async def sketch_sequences(self, data):
+        if not data:
+            raise RequestError(400, 'Empty upload')
+        loop = asyncio.get_running_loop()
+        registers = await loop.run_in_executor(self.pool, _sketch_upload, data, self.k, self.canonical)
+        self.counters['sketches'] += 1
+        return registers
+
+    """
+    SketchServer.batch_queries():
+    Collects queued queries into batches and sends each batch to the process pool, see the module docstring
+    Batches are sent without waiting for the previous one, so up to jobs batches run at once
+    """
+    async def batch_queries(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # the event loop only keeps weak references to tasks
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run_batch(self, batch):
+        queries, ks, measures, futures = zip(*batch)
+        self.counters['queries'] += len(batch)
+        self.counters['batches'] += 1
+        self.counters['largest_batch'] = max(self.counters['largest_batch'], len(batch))
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.pool, _query_batch, list(queries), list(ks), list(measures))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+"""
+content_length():
+Length of a request body from its headers
+
+Input: headers, a dict of lower case header names to values
+Output: the length in bytes, 0 without a Content-Length header; raises a RequestError (400) if it is not a number
+"""
+def content_length(headers):
+    value = headers.get('content-length', '0')
+    if not (value.isascii() and value.isdigit()):
+        raise RequestError(400, 'Invalid Content-Length {!r}'.format(value))
+    return int(value)
+
+def json_response(value, status=200):
+    return status, 'application/json', json.dumps(value).encode()
+
+def error_response(error):
+    return json_response({'error': str(error)}, error.status)
+
+async def serve(args):
+    server = SketchServer(args.references, jobs=args.jobs, k=args.k, canonical=args.canonical,
+                          batch_size=args.batch_size, batch_delay=args.batch_delay)
+    listener = await server.start(args.host, args.port, args.unix)
+    # on SIGTERM, stop serving and fall through to close(), which frees the shared references
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, listener.close)
+    print('Serving {} references (p = {}, hash {}, k = {}{}) on {}'.format(
+        server.info['references'], server.info['p'], server.info['hash'], server.k,
+        ', canonical' if server.canonical else '',
+        args.unix if args.unix is not None else 'http://{}:{}'.format(args.host, args.port)), flush=True)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+        if args.unix is not None and os.path.exists(args.unix):
+            os.remove(args.unix)
+
+def main():
+    parser = argparse.ArgumentParser(description='Sketching and similarity query service over a reference collection')
+    parser.add_argument('references', help='sketch file or sketch database directory of the references')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on (default 8765)')
+    parser.add_argument('--unix', help='Unix socket path to listen on instead of TCP')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes (default: every CPU)')
+    parser.add_argument('-k', type=int, default=None,
+                        help='k-mer length of uploads (default: the references\', or 25 if they do not record it)')
+    parser.add_argument('--canonical', action='store_const', const=True, default=None,
+                        help='sketch uploads from canonical k-mers (default: as the references were sketched)')
+    parser.add_argument('--batch-size', type=int, default=64, help='largest number of queries per batch (default 64)')
+    parser.add_argument('--batch-delay', type=float, default=0.005,
+                        help='seconds a batch waits for more queries (default 0.005)')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Sketching.py: Sketching FASTA/FASTQ files and folders of them into HLLs
+
+Used by GNome.py, Query.py, SketchServer.py and Benchmark.py. It imports none of them, so they share it without
+importing each other.
+"""
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+import Hash
+import SequenceReader
+from HLL import HLL
+
+"""
+Sketching.sketch_file():
+Sketches a single FASTA or FASTQ file (optionally gzip or bz2 compressed), streaming it in chunks
+so memory use does not grow with the file size. Every k-mer of each read is inserted.
+
+Input: filename, a path to a sequence file containing Illumina reads
+       k, the k-mer length; p, the HLL precision; canonical, whether to insert canonical k-mers
+       hash_name, the hash function (a key of Hash.HASHES)
+Output: the registers of the file's HLL, a numpy uint8 array
+"""
+def sketch_file(filename, k=25, p=12, canonical=False, hash_name=Hash.DEFAULT_HASH):
+    hll = HLL(p, hash_name=hash_name)
+    for chunk in SequenceReader.read_chunks(filename, k):
+        hll.insert_many(chunk, k, canonical)
+    return hll.getRegisters()
+
+"""
+Sketching.get_sketches():
+Generates a set of sketches given a folder_path
+
+Input: folder_path, a string containing a path to a folder of FASTA/FASTQ files containing Illumina reads,
+       or a list of such folders and of FASTA/FASTQ files (see sequence_files())
+       workers, the number of processes sketching files concurrently (1 to sketch in this process)
+       k, the k-mer length; p, the HLL precision; canonical, whether to insert canonical k-mers
+       hash_name, the hash function (a key of Hash.HASHES)
+       database, a SketchDatabase.SketchDatabase built with the same parameters (optional); files already in it
+       are not sketched again unless their size or mtime changed, and new sketches are added to it
+Output:
+    sketches, a list of HLLs for each FASTA file, sparse where few registers are set (see HLL.to_sparse())
+    species, a list of filenames the same length as sketches
+"""
+def get_sketches(folder_path, workers=1, k=25, p=12, canonical=False, hash_name=Hash.DEFAULT_HASH, database=None):
+    sketches = []
+    species = []
+
+    files = sequence_files([folder_path] if isinstance(folder_path, str) else folder_path)
+    if database is not None:
+        # a file changed in place since it was sketched is sketched again
+        current = [database.is_current(filename, filename) for filename in files]
+        known = [filename for filename, is_current in zip(files, current) if is_current]
+        files = [filename for filename, is_current in zip(files, current) if not is_current]
+        for filename in known:
+            print('\tLoaded sketch: {}'.format(filename))
+            species.append(filename)
+            sketches.append(database.get(filename))
+    if workers > 1:
+        # workers send back register arrays only, map() keeps the sorted file order
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            n = len(files)
+            results = pool.map(sketch_file, files, [k] * n, [p] * n, [canonical] * n, [hash_name] * n)
+            for filename, registers in zip(files, results):
+                print('\tRead file: {}'.format(filename))
+                species.append(filename)
+                sketches.append(HLL(p, registers, hash_name=hash_name, sparse=True))
+    else:
+        for filename in files:
+            species.append(filename)
+            print('\tReading file: {}'.format(filename))
+            sketches.append(HLL(p, sketch_file(filename, k, p, canonical, hash_name), hash_name=hash_name, sparse=True))
+
+    if database is not None:
+        for filename, hll in zip(species[len(known):], sketches[len(known):]):
+            database.add(filename, hll, source=filename)
+        # keep the sorted file order
+        order = sorted(range(len(species)), key=species.__getitem__)
+        sketches = [sketches[i] for i in order]
+        species = [species[i] for i in order]
+    return sketches, species
+
+"""
+Sketching.sequence_files():
+Lists the FASTA/FASTQ files to sketch: every file with a sequence extension in each folder, and the other paths
+as given
+
+Input: paths, a list of folders and files
+Output: a sorted list of filenames
+"""
+def sequence_files(paths):
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for extension in SequenceReader.EXTENSIONS:
+            for compression in SequenceReader.COMPRESSED_EXTENSIONS:
+                files += glob.glob(os.path.join(path, '*' + extension + compression))
+    return sorted(set(files))
@@ -0,0 +1,73 @@
+"""
+test_genome_rankings.py: Checks GenomeRankings against scipy's rankdata() and kendalltau(), including ties and nan
+"""
+import numpy as np
+import pytest
+from scipy.stats import kendalltau, rankdata
+
+import GenomeRankings
+
+
+def similarity_rows(rng, rows=40, n=25):
+    # few distinct values so that rows have many ties
+    values = rng.integers(0, 6, (rows, n)).astype(np.float64) / 5
+    values[3, 7] = np.nan
+    values[11, :] = np.nan
+    values[17, :] = 0.5
+    return values
+
+
+def test_rank_rows_matches_rankdata():
+    values = similarity_rows(np.random.default_rng(0))
+    expected = np.array([rankdata(row, method='min') for row in values])
+    np.testing.assert_array_equal(GenomeRankings.rank_rows(values), expected)
+
+
+def test_rank_genomes_gives_nan_rows_nan_rankings():
+    sim = np.triu(np.random.default_rng(1).random((6, 6)))
+    sim[1, 4] = np.nan
+    rankings = GenomeRankings.rank_genomes(sim)
+    assert np.isnan(rankings[[1, 4]]).all()
+    assert not np.isnan(np.delete(rankings, [1, 4], axis=0)).any()
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 64])
+def test_kendall_tau_rows_matches_kendalltau(block_size):
+    rng = np.random.default_rng(2)
+    x = similarity_rows(rng)
+    y = similarity_rows(rng)
+    y[5, 2] = np.nan
+    expected = np.array([kendalltau(a, b).statistic for a, b in zip(x, y)])
+    tau = GenomeRankings.kendall_tau_rows(x, y, block_size=block_size)
+    np.testing.assert_allclose(tau, expected, equal_nan=True)
+    assert np.isnan(tau[[3, 5, 11, 17]]).all()
+
+
+def test_kendall_tau_rows_of_rankings():
+    rng = np.random.default_rng(3)
+    a = GenomeRankings.rank_genomes(np.triu(rng.integers(0, 4, (30, 30)) / 3))
+    b = GenomeRankings.rank_genomes(np.triu(rng.random((30, 30))))
+    expected = np.array([kendalltau(x, y).statistic for x, y in zip(a, b)])
+    np.testing.assert_allclose(GenomeRankings.kendall_tau_rows(a, b), expected)
+
+
+def test_kendall_tau_rows_nan_row():
+    tau = GenomeRankings.kendall_tau_rows([[np.nan, 1, 2]], [[1, 2, 3]])
+    assert np.isnan(tau).all()
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 31, 64, 100])
+def test_count_inversions_matches_brute_force(n):
+    values = np.random.default_rng(n).integers(0, n + 1, (9, n))
+    values[0] = np.arange(n)
+    values[1] = np.arange(n)[::-1]
+    expected = [sum(row[i] > row[j] for i in range(n) for j in range(i + 1, n)) for row in values]
+    np.testing.assert_array_equal(GenomeRankings.count_inversions(values), expected)
+
+
+def test_count_inversions_int64_keys():
+    # the merge keys of 40000 columns do not fit int32
+    n = 40000
+    assert GenomeRankings.key_dtype(2 * (n + 1) ** 2) == np.int64
+    values = np.stack([np.arange(n), np.arange(n)[::-1], np.arange(n).reshape(-1, 100)[:, ::-1].ravel()])
+    np.testing.assert_array_equal(GenomeRankings.count_inversions(values), [0, n * (n - 1) // 2, n // 100 * 4950])
@@ -0,0 +1,61 @@
+"""
+test_gnome.py: GNome.py subcommands on small sketch collections
+"""
+import os
+import numpy as np
+import pytest
+
+import GNome
+import SketchFile
+from HLL import HLL
+
+
+def random_sketches(n, p=8, seed=0):
+    rng = np.random.default_rng(seed)
+    shared = rng.integers(0, 2**62, 2000, dtype=np.uint64)
+    sketches = []
+    for i in range(n):
+        hll = HLL(p)
+        hll.insert_codes(shared[:200 * (i + 1)])
+        hll.insert_codes(rng.integers(0, 2**62, 300, dtype=np.uint64))
+        sketches.append(hll)
+    return sketches
+
+
+@pytest.fixture
+def sketch_path(tmp_path):
+    path = str(tmp_path / 'genomes.sketch')
+    SketchFile.write_sketches(path, random_sketches(6), ['g{}'.format(i) for i in range(6)], k=21)
+    return path
+
+
+def test_rank_uses_the_database(tmp_path, sketch_path):
+    plain = str(tmp_path / 'plain.tsv')
+    cached = str(tmp_path / 'cached.tsv')
+    database = str(tmp_path / 'db')
+    GNome.main(['rank', sketch_path, '-o', plain, '-p', '8', '-k', '21'])
+    GNome.main(['rank', sketch_path, '-o', cached, '-p', '8', '-k', '21', '--db', database])
+    with open(plain) as f, open(cached) as g:
+        assert f.read() == g.read()
+    pairs = os.path.getsize(os.path.join(database, 'pairs.bin'))
+    assert pairs > 0
+    # a second run answers every pair from the cache
+    GNome.main(['rank', sketch_path, '-o', cached, '-p', '8', '-k', '21', '--db', database])
+    assert os.path.getsize(os.path.join(database, 'pairs.bin')) == pairs
+
+
+def test_ground_truth_shape_is_checked(tmp_path, sketch_path):
+    with pytest.raises(SystemExit, match='Ground truth is 10x10 but there are 6 genomes'):
+        GNome.main([sketch_path])
+    with pytest.raises(SystemExit, match='Ground truth is 10x10 but there are 6 genomes'):
+        GNome.main(['evaluate', sketch_path, '-o', str(tmp_path / 'tau.tsv')])
+
+
+def test_query_rejects_other_kmers(tmp_path, sketch_path):
+    with pytest.raises(SystemExit, match='k = 21, not k = 25'):
+        GNome.main(['query', sketch_path, sketch_path, '-k', '25', '-o', str(tmp_path / 'q.tsv')])
+    out = str(tmp_path / 'q.tsv')
+    GNome.main(['query', sketch_path, sketch_path, '-n', '1', '-o', out])
+    with open(out) as f:
+        rows = [line.split('\t') for line in f.read().splitlines()[1:]]
+    assert [row[0] for row in rows] == [row[2] for row in rows]
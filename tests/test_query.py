@@ -0,0 +1,80 @@
+"""
+test_query.py: Checks that Query.ReferenceIndex gives the top k of estimating every reference with the joint MLE,
+on a collection of clades and on a collection of unrelated references
+"""
+import numpy as np
+import pytest
+
+import Query
+import SimilarityMatrix
+from HLL import HLL
+
+
+def sketch(*codes, p=12):
+    h = HLL(p)
+    for c in codes:
+        h.insert_codes(c)
+    return h
+
+
+def clustered(rng, codes):
+    # clades sharing 60-100% of a core, with sizes spread over two orders of magnitude
+    sketches = []
+    for size in (2000, 20000, 200000):
+        core = codes(size)
+        sketches += [sketch(core[rng.random(size) < rng.uniform(0.6, 1)], codes(int(rng.integers(100, 5000))))
+                     for _ in range(25)]
+    return sketches, sketch(core[rng.random(len(core)) < 0.9])
+
+
+def unrelated(rng, codes):
+    return [sketch(codes(int(n))) for n in 10 ** rng.uniform(2, 5.5, 80)], sketch(codes(30000))
+
+
+def brute_force(index, hll, k, measure):
+    registers = np.concatenate([hll.getRegisters()[None], index.registers])
+    cardinalities = np.concatenate([[hll.cardinality()], index.cardinalities])
+    similarities = SimilarityMatrix.pair_similarities(registers, cardinalities, np.zeros(len(index), dtype=np.intp),
+                                                      np.arange(1, len(index) + 1), index.q)
+    values = np.nan_to_num(similarities[Query.MEASURES.index(measure)])
+    top = np.argsort(-values, kind='stable')[:k]
+    return [index.names[i] for i in top], values[top]
+
+
+@pytest.mark.parametrize('collection', [clustered, unrelated])
+@pytest.mark.parametrize('measure', Query.MEASURES)
+def test_query_matches_brute_force(collection, measure):
+    rng = np.random.default_rng(0)
+    codes = lambda n: rng.integers(0, 2**62, n, dtype=np.uint64)
+    sketches, query = collection(rng, codes)
+    index = Query.ReferenceIndex.from_sketches(sketches, ['ref_{}'.format(i) for i in range(len(sketches))],
+                                               block_size=16)
+    for k in (1, 5, 20):
+        names, values = brute_force(index, query, k, measure)
+        results, estimated = index.query(query, k, measure, block_size=8)
+        np.testing.assert_allclose([similarity for _, similarity in results], values, rtol=1e-9, atol=1e-12)
+        # ties aside, the same references are found
+        assert {name for name, _ in results} == set(names) or len(set(np.round(values, 9))) < len(values)
+        assert estimated <= len(index)
+
+
+def test_bounds_are_above_estimates():
+    rng = np.random.default_rng(1)
+    codes = lambda n: rng.integers(0, 2**62, n, dtype=np.uint64)
+    sketches, query = clustered(rng, codes)
+    sketches += unrelated(rng, codes)[0]
+    index = Query.ReferenceIndex.from_sketches(sketches, ['ref_{}'.format(i) for i in range(len(sketches))])
+    for measure in ('jaccard', 'sd'):
+        estimates = brute_force(index, query, len(index), measure)
+        by_name = dict(zip(*estimates))
+        high, _ = index.bounds(query, measure)
+        assert all(by_name[name] <= bound for name, bound in zip(index.names, high))
+
+
+def test_clustered_query_prunes():
+    rng = np.random.default_rng(2)
+    codes = lambda n: rng.integers(0, 2**62, n, dtype=np.uint64)
+    sketches, query = clustered(rng, codes)
+    index = Query.ReferenceIndex.from_sketches(sketches, ['ref_{}'.format(i) for i in range(len(sketches))])
+    _, estimated = index.query(query, 5, 'jaccard', block_size=8)
+    assert estimated < len(index) / 2
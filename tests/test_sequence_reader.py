@@ -0,0 +1,86 @@
+"""
+test_sequence_reader.py: Streaming FASTA/FASTQ parsing of SequenceReader against whole-file parsing
+"""
+import bz2
+import collections
+import gzip
+import numpy as np
+import pytest
+
+import SequenceReader
+from HLL import HLL
+
+K = 5
+
+
+def random_records(seed=0, lengths=(1, 4, 5, 9, 60, 61, 200, 3)):
+    rng = np.random.default_rng(seed)
+    return [''.join(rng.choice(list('ACGT'), n)) for n in lengths]
+
+
+def fasta_text(records, width=7):
+    lines = []
+    for i, seq in enumerate(records):
+        lines.append('>record {} description'.format(i))
+        lines += [seq[j:j + width] for j in range(0, len(seq), width)]
+    return '\n'.join(lines) + '\n'
+
+
+def fastq_text(records, width=7):
+    lines = []
+    for i, seq in enumerate(records):
+        lines.append('@read{}'.format(i))
+        lines += [seq[j:j + width] for j in range(0, len(seq), width)]
+        lines.append('+')
+        # quality lines that start with '@' or '+' must not be taken for headers or separators
+        quality = ('@+' * len(seq))[:len(seq)]
+        lines += [quality[j:j + width] for j in range(0, len(quality), width)]
+    return '\n'.join(lines) + '\n'
+
+
+def kmers(sequences, k=K):
+    return collections.Counter(seq[i:i + k] for seq in sequences for i in range(len(seq) - k + 1))
+
+
+def write(path, text, compression):
+    opener = {'': open, 'gz': gzip.open, 'bz2': bz2.open}[compression]
+    with opener(str(path), 'wt') as f:
+        f.write(text)
+    return str(path)
+
+
+@pytest.mark.parametrize('format_text', [fasta_text, fastq_text])
+@pytest.mark.parametrize('compression', ['', 'gz', 'bz2'])
+def test_read_sequences(tmp_path, format_text, compression):
+    records = random_records()
+    # compression is detected from the content, not the file name
+    path = write(tmp_path / 'reads.txt', format_text(records), compression)
+    assert list(SequenceReader.read_sequences(path)) == records
+
+
+@pytest.mark.parametrize('format_text', [fasta_text, fastq_text])
+@pytest.mark.parametrize('chunk_size', [1, 4, 5, 6, 13, 64, 1000])
+def test_chunks_keep_every_kmer_once(tmp_path, format_text, chunk_size):
+    records = random_records(1)
+    path = write(tmp_path / 'reads.fa', format_text(records), '')
+    chunks = list(SequenceReader.read_chunks(path, K, chunk_size))
+    assert kmers(seq for chunk in chunks for seq in chunk) == kmers(records)
+
+
+@pytest.mark.parametrize('compression', ['', 'gz'])
+@pytest.mark.parametrize('chunk_size', [3, 17, 1 << 22])
+def test_chunked_sketch_matches_whole_file(tmp_path, compression, chunk_size):
+    records = random_records(2, lengths=(500, 31, 1000, 2, 250))
+    path = write(tmp_path / 'reads.fasta', fasta_text(records, width=60), compression)
+    whole = HLL(8)
+    whole.insert_many(records, K)
+    streamed = HLL(8)
+    for chunk in SequenceReader.read_chunks(path, K, chunk_size):
+        streamed.insert_many(chunk, K)
+    np.testing.assert_array_equal(streamed.getRegisters(), whole.getRegisters())
+
+
+def test_blank_lines_and_record_starts(tmp_path):
+    path = write(tmp_path / 'reads.fa', '\n\n>a\nACGT\n\nACGT\n>b\n>c\nGG\n', '')
+    assert list(SequenceReader.sequence_lines(path)) == [(True, 'ACGT'), (False, 'ACGT'), (True, 'GG')]
+    assert list(SequenceReader.read_sequences(path)) == ['ACGTACGT', 'GG']
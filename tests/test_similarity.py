@@ -0,0 +1,120 @@
+"""
+test_similarity.py: Checks the derivatives of the joint log-likelihood against finite differences, and both solvers
+of the joint MLE against scipy's trust-region solver converged to a tight tolerance
+"""
+import numpy as np
+import pytest
+from scipy.optimize import minimize
+
+import Cardinality
+import Similarity
+import SimilarityMatrix
+from HLL import HLL
+
+
+def sketch(*codes, p=12):
+    h = HLL(p)
+    for c in codes:
+        h.insert_codes(c)
+    return h
+
+
+def sketch_pairs():
+    rng = np.random.default_rng(0)
+    codes = lambda n: rng.integers(0, 2**62, n, dtype=np.uint64)
+    shared, a, b = codes(50000), codes(200000), codes(3000)
+    return [
+        (sketch(a[:20000]), sketch(b)),  # unrelated
+        (sketch(shared, a), sketch(shared[:10000])),  # nested
+        (sketch(shared, b), sketch(shared, a[:30000])),  # overlapping
+        (sketch(shared), sketch(shared)),  # identical
+        (sketch(a[:500]), sketch(a[:500], b[:40])),  # small
+        (sketch(a), sketch(b[:100])),  # very different sizes
+    ]
+
+
+def stacked_counts(pairs):
+    r1 = np.stack([a.getRegisters() for a, _ in pairs])
+    r2 = np.stack([b.getRegisters() for _, b in pairs])
+    q = pairs[0][0].q
+    C1_less, C2_less, C_equal, C1_greater, C2_greater, _ = SimilarityMatrix.pair_counts(SimilarityMatrix.pair_histograms(r1, r2, q))
+    return (C1_less, C2_less, C_equal, C1_greater, C2_greater), q, r1.shape[1]
+
+
+def reference_estimators(counts, q, m):
+    # maximum of the likelihood from scipy's trust-region Newton solver, independent of newton_joint_mle()
+    S, C = Similarity.stack_counts(*counts, q)
+    negative = lambda phi: -Similarity.joint_likelihood_terms(phi, S, C, q, m, 0)[0]
+    jac = lambda phi: -Similarity.joint_likelihood_terms(phi, S, C, q, m, 1)[1]
+    hess = lambda phi: -Similarity.joint_likelihood_terms(phi, S, C, q, m, 2)[2]
+    a, b = Cardinality.estimateCardinality(counts[0] + counts[2] + counts[3]), Cardinality.estimateCardinality(counts[1] + counts[2] + counts[4])
+    phi_0 = np.log(np.array([a, b, min(a, b)]) / 2 + 1)
+    result = minimize(negative, phi_0, method='trust-exact', jac=jac, hess=hess, options={'gtol': 1e-11})
+    return np.exp(result.x)
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_derivatives_match_finite_differences(batch):
+    counts, q, m = stacked_counts(sketch_pairs())
+    S, C = Similarity.stack_counts(*counts, q)
+    phi = np.log([[30000, 3000, 20000], [150000, 1, 10000], [3000, 150000, 40000],
+                  [10, 10, 50000], [480, 40, 20], [200000, 100, 5]])
+    if not batch:
+        phi, S, C = phi[2], S[2], C[2]
+    f, grad, hess = Similarity.joint_likelihood_terms(phi, S, C, q, m)
+
+    h = 1e-5
+    for i in range(3):
+        e = np.zeros(3)
+        e[i] = h
+        f_plus, grad_plus, _ = Similarity.joint_likelihood_terms(phi + e, S, C, q, m, 1)
+        f_minus, grad_minus, _ = Similarity.joint_likelihood_terms(phi - e, S, C, q, m, 1)
+        np.testing.assert_allclose(grad[..., i], (f_plus - f_minus) / (2*h), rtol=1e-6, atol=1e-4)
+        np.testing.assert_allclose(hess[..., i, :], (grad_plus - grad_minus) / (2*h), rtol=1e-6, atol=1e-4)
+    np.testing.assert_array_equal(hess, np.swapaxes(hess, -1, -2))
+
+
+def test_likelihood_matches_single_pair_helpers():
+    counts, q, m = stacked_counts(sketch_pairs()[2:3])
+    counts = [c[0] for c in counts]
+    S, C = Similarity.stack_counts(*counts, q)
+    phi = np.log([3000, 150000, 40000])
+    f, grad, _ = Similarity.joint_likelihood_terms(phi, S, C, q, m, 1)
+    assert Similarity.calculate_log_likelihood(phi, *counts, q, m) == pytest.approx(-f)
+    np.testing.assert_allclose(Similarity.calculate_ll_gradient(phi, *counts, q, m), -grad)
+
+
+@pytest.mark.parametrize('solver, tolerance', [('newton', 1e-6), ('lbfgs', 1e-2)])
+def test_solvers_match_reference(solver, tolerance):
+    pairs = sketch_pairs()
+    counts, q, m = stacked_counts(pairs)
+    for i, (a, b) in enumerate(pairs):
+        expected = reference_estimators([c[i] for c in counts], q, m)
+        estimators = np.array(Similarity.getJointEstimators(a, b, solver=solver))
+        # estimators tending to 0 have no meaningful relative error, so errors are relative to the union
+        np.testing.assert_allclose(estimators, expected, rtol=0, atol=tolerance * expected.sum())
+
+
+def test_batch_matches_reference():
+    pairs = sketch_pairs()
+    counts, q, m = stacked_counts(pairs)
+    estimators = np.stack(Similarity.getJointEstimatorsBatch(*counts, q, m), axis=1)
+    for i in range(len(pairs)):
+        expected = reference_estimators([c[i] for c in counts], q, m)
+        np.testing.assert_allclose(estimators[i], expected, rtol=0, atol=1e-6 * expected.sum())
+
+
+def test_batch_matches_single_pairs():
+    pairs = sketch_pairs()
+    counts, q, m = stacked_counts(pairs)
+    estimators = np.stack(Similarity.getJointEstimatorsBatch(*counts, q, m), axis=1)
+    for (a, b), batched in zip(pairs, estimators):
+        np.testing.assert_allclose(batched, Similarity.getJointEstimators(a, b), rtol=0, atol=1e-6 * batched.sum())
+
+
+def test_empty_sketch_has_no_intersection():
+    a = sketch(np.arange(1000, dtype=np.uint64))
+    a_excl, b_excl, intersection = Similarity.getJointEstimators(a, HLL(12))
+    assert intersection == 0
+    assert b_excl == 0
+    assert a_excl == pytest.approx(a.cardinality())
@@ -0,0 +1,106 @@
+"""
+test_sketch_codec.py: Round trips of the compressed sketch stream format of SketchCodec
+"""
+import io
+import numpy as np
+import pytest
+
+import SketchCodec
+from HLL import HLL
+
+
+def frame_registers(rng, p):
+    # one group of sketches for every width, with and without exceptions, and windows wrapping around 256
+    m = 2 ** p
+    rows = [
+        np.full(m, 7),                               # w = 0
+        rng.integers(5, 7, m),                       # w = 1
+        rng.integers(3, 7, m),                       # w = 2
+        rng.integers(0, 16, m),                      # w = 4
+        rng.integers(0, 256, m),                     # w = 8
+        (rng.integers(-2, 2, m) % 256),              # window wrapping around 0
+        np.where(rng.random(m) < 0.01, 200, rng.integers(10, 14, m)),  # w = 2 with exceptions
+        np.zeros(m),
+    ]
+    return np.array(rows, dtype=np.uint8)
+
+
+def round_trip(registers, names, p, **options):
+    f = io.BytesIO()
+    with SketchCodec.SketchWriter(f, p, 'murmur3', k=21, canonical=True, **options) as writer:
+        for name, row in zip(names, registers):
+            writer.write(name, HLL(p, row.copy(), hash_name='murmur3'))
+    reader = SketchCodec.SketchReader(io.BytesIO(f.getvalue()))
+    assert (reader.p, reader.k, reader.canonical, reader.hash_name) == (p, 21, True, 'murmur3')
+    return reader.read_registers()
+
+
+def test_frames_cover_every_width():
+    registers = frame_registers(np.random.default_rng(0), 10)
+    widths, _ = SketchCodec.choose_frames(registers, 10)
+    assert set(widths.tolist()) == set(SketchCodec.WIDTHS)
+
+
+@pytest.mark.parametrize('p', [4, 10, 17])
+@pytest.mark.parametrize('chunk_size', [1, 3, 1024])
+@pytest.mark.parametrize('entropy', [False, True])
+@pytest.mark.parametrize('zlib_level', [0, 6])
+def test_round_trip(p, chunk_size, entropy, zlib_level):
+    rng = np.random.default_rng(p)
+    registers = frame_registers(rng, p)
+    names = ['genome_{}'.format(i) for i in range(len(registers))]
+    names[1] = 'Staphylococcus aureus Größe'
+    names[4] = '大肠杆菌'
+    names[5] = ''
+    decoded, decoded_names = round_trip(registers, names, p, entropy=entropy, chunk_size=chunk_size,
+                                        zlib_level=zlib_level)
+    np.testing.assert_array_equal(decoded, registers)
+    assert decoded_names == names
+
+
+@pytest.mark.parametrize('entropy', [False, True])
+def test_round_trip_of_sketches(entropy):
+    rng = np.random.default_rng(1)
+    sketches = []
+    for cardinality in (0, 10, 1000, 100000):
+        hll = HLL(12)
+        hll.insert_codes(rng.integers(0, 2**62, cardinality, dtype=np.uint64))
+        sketches.append(hll)
+    registers = np.array([h.getRegisters() for h in sketches])
+    decoded, _ = round_trip(registers, ['a', 'b', 'c', 'd'], 12, entropy=entropy, chunk_size=2)
+    np.testing.assert_array_equal(decoded, registers)
+
+
+def test_models_sum_to_the_probability_scale():
+    registers = frame_registers(np.random.default_rng(2), 14)
+    registers[0, :255] = np.arange(255)  # every value once but the most frequent one
+    histograms = SketchCodec.register_histograms(registers)
+    frequencies = SketchCodec.quantize_frequencies(histograms, 2 ** 14)
+    assert (frequencies.sum(axis=1) == 1 << SketchCodec.PROB_BITS).all()
+    assert ((frequencies > 0) == (histograms > 0)).all()
+
+
+def test_entropy_coding_approaches_the_entropy():
+    rng = np.random.default_rng(3)
+    hll = HLL(14)
+    hll.insert_codes(rng.integers(0, 2**62, 200000, dtype=np.uint64))
+    registers = hll.getRegisters()[None]
+    counts = np.bincount(registers[0])
+    probabilities = counts[counts > 0] / registers.size
+    entropy_bytes = -(probabilities * np.log2(probabilities)).sum() * registers.size / 8
+    body = SketchCodec.encode_chunk(registers, ['a'], 14, entropy=True)
+    assert len(body) < 1.05 * entropy_bytes + 4 * SketchCodec.LANES + 2 * len(counts) + 16
+    assert len(body) < len(SketchCodec.encode_chunk(registers, ['a'], 14))
+
+
+def test_empty_stream():
+    decoded, names = round_trip(np.zeros((0, 16), dtype=np.uint8), [], 4)
+    assert decoded.shape == (0, 16) and names == []
+
+
+def test_truncated_stream():
+    f = io.BytesIO()
+    with SketchCodec.SketchWriter(f, 4, 'murmur3') as writer:
+        writer.write('a', HLL(4, np.arange(16, dtype=np.uint8), hash_name='murmur3'))
+    with pytest.raises(EOFError):
+        SketchCodec.SketchReader(io.BytesIO(f.getvalue()[:-12])).read_registers()
@@ -0,0 +1,145 @@
+"""
+test_sketch_database.py: Stamps, the pair cache and compaction of SketchDatabase
+"""
+import contextlib
+import io
+import os
+import numpy as np
+import pytest
+
+import SimilarityMatrix
+import SketchDatabase
+import Sketching
+from HLL import HLL
+
+
+def random_sketches(n, p=8, seed=0):
+    rng = np.random.default_rng(seed)
+    sketches = []
+    for i in range(n):
+        hll = HLL(p)
+        hll.insert_codes(rng.integers(0, 2**62, 50 * (i + 1), dtype=np.uint64))
+        sketches.append(hll)
+    return sketches
+
+
+def pair_count(database):
+    return os.path.getsize(database.pairs_path) // SketchDatabase.PAIR_DTYPE.itemsize
+
+
+def assert_matrices_equal(actual, expected):
+    for a, e in zip(actual, expected):
+        np.testing.assert_allclose(a, e, rtol=1e-12)
+
+
+def test_pairs_are_appended_and_looked_up(tmp_path, monkeypatch):
+    path = str(tmp_path / 'db')
+    sketches = random_sketches(5)
+    database = SketchDatabase.SketchDatabase(path, p=8)
+    for i, hll in enumerate(sketches[:4]):
+        database.add('s{}'.format(i), hll)
+    database.save()
+    expected = SimilarityMatrix.similarity_matrices(sketches[:4])
+    assert_matrices_equal(database.similarity_matrices(sketches[:4]), expected)
+    assert pair_count(database) == 4 * 5 // 2
+
+    # a reopened database answers every pair from pairs.bin
+    reopened = SketchDatabase.SketchDatabase(path)
+    def fail(*args, **kwargs):
+        raise AssertionError('pair recomputed')
+    monkeypatch.setattr(SimilarityMatrix, 'pair_similarities', fail)
+    assert_matrices_equal(reopened.similarity_matrices(sketches[:4]), expected)
+    assert_matrices_equal(reopened.similarity_matrices(), expected)
+    monkeypatch.undo()
+
+    # a new sketch costs one comparison with each sketch and itself, in any order of the collection
+    order = [4, 2, 0, 3, 1]
+    matrices = reopened.similarity_matrices([sketches[i] for i in order])
+    assert pair_count(reopened) == 4 * 5 // 2 + 5
+    assert_matrices_equal(matrices, SimilarityMatrix.similarity_matrices([sketches[i] for i in order]))
+
+
+def test_identical_sketches_share_pairs(tmp_path):
+    database = SketchDatabase.SketchDatabase(str(tmp_path / 'db'), p=8)
+    a, b = random_sketches(2)
+    copy = HLL(8, a.getRegisters())
+    matrices = database.similarity_matrices([a, b, copy])
+    assert pair_count(database) == 3
+    assert_matrices_equal(matrices, SimilarityMatrix.similarity_matrices([a, b, copy]))
+
+
+def test_compact_drops_removed_sketches(tmp_path):
+    path = str(tmp_path / 'db')
+    sketches = random_sketches(3)
+    database = SketchDatabase.SketchDatabase(path, p=8)
+    for i, hll in enumerate(sketches):
+        database.add('s{}'.format(i), hll)
+    database.similarity_matrices()
+    removed = SketchDatabase.sketch_digest(sketches[1])
+    database.remove('s1')
+    assert pair_count(database) == 6
+    database.compact()
+
+    assert sorted(os.listdir(database.sketch_dir)) == sorted(
+        SketchDatabase.sketch_digest(h) + '.npy' for h in (sketches[0], sketches[2]))
+    records = np.fromfile(database.pairs_path, dtype=SketchDatabase.PAIR_DTYPE)
+    assert len(records) == 3
+    assert removed.encode() not in set(records['a']) | set(records['b'])
+
+    reopened = SketchDatabase.SketchDatabase(path)
+    assert reopened.names() == ['s0', 's2']
+    assert_matrices_equal(reopened.similarity_matrices(),
+                          SimilarityMatrix.similarity_matrices([sketches[0], sketches[2]]))
+    assert pair_count(reopened) == 3
+
+
+def test_parameters_must_match(tmp_path):
+    path = str(tmp_path / 'db')
+    database = SketchDatabase.SketchDatabase(path, p=8, k=21)
+    database.save()
+    with pytest.raises(ValueError):
+        SketchDatabase.SketchDatabase(path, k=25)
+    with pytest.raises(ValueError):
+        database.add('wrong', HLL(10))
+    assert SketchDatabase.SketchDatabase(path).k == 21
+
+
+def write_reads(path, seed, count=20):
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write('>read{}\n{}\n'.format(i, ''.join(rng.choice(list('ACGT'), 100))))
+
+
+def test_changed_files_are_sketched_again(tmp_path, monkeypatch):
+    reads = tmp_path / 'reads'
+    reads.mkdir()
+    for i in range(3):
+        write_reads(str(reads / 'genome{}.fasta'.format(i)), i)
+    path = str(tmp_path / 'db')
+
+    database = SketchDatabase.SketchDatabase(path, p=8, k=21)
+    with contextlib.redirect_stdout(io.StringIO()):
+        first, names = Sketching.get_sketches(str(reads), k=21, p=8, database=database)
+    database.save()
+    assert all(database.is_current(name, name) for name in names)
+
+    changed = str(reads / 'genome1.fasta')
+    # a different size, so the change is seen even where mtimes are coarse
+    write_reads(changed, 10, count=21)
+    database = SketchDatabase.SketchDatabase(path)
+    assert not database.is_current(changed, changed)
+    assert database.is_current(names[0], names[0])
+
+    sketched = []
+    original = Sketching.sketch_file
+    monkeypatch.setattr(Sketching, 'sketch_file', lambda filename, *args: sketched.append(filename) or
+                        original(filename, *args))
+    with contextlib.redirect_stdout(io.StringIO()):
+        second, second_names = Sketching.get_sketches(str(reads), k=21, p=8, database=database)
+    assert sketched == [changed]
+    assert second_names == names
+    np.testing.assert_array_equal(second[0].getRegisters(), first[0].getRegisters())
+    assert not np.array_equal(second[1].getRegisters(), first[1].getRegisters())
+    database.save()
+    assert SketchDatabase.SketchDatabase(path).is_current(changed, changed)
@@ -0,0 +1,80 @@
+"""
+test_sketch_file.py: Round trips of the SketchFile format through its header, name index and memory map
+"""
+import numpy as np
+import pytest
+
+import SketchFile
+from HLL import HLL
+
+
+def random_sketches(n, p=10, hash_name='wang64', seed=0):
+    rng = np.random.default_rng(seed)
+    sketches = []
+    for i in range(n):
+        hll = HLL(p, hash_name=hash_name)
+        hll.insert_codes(rng.integers(0, 2**62, 10 ** (i % 4 + 1), dtype=np.uint64))
+        sketches.append(hll)
+    return sketches
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_round_trip(tmp_path, packed):
+    path = str(tmp_path / 'genomes.sketch')
+    sketches = random_sketches(5, hash_name='xxhash64')
+    if packed:
+        for hll in sketches:
+            hll.pack()
+    names = ['E coli', 'Größe', '大肠杆菌', '', 'S aureus']
+    SketchFile.write_sketches(path, sketches, names, k=21, canonical=True)
+
+    assert SketchFile.is_sketch_file(path)
+    sketch_file = SketchFile.SketchFile(path)
+    assert (len(sketch_file), sketch_file.p, sketch_file.k, sketch_file.hash_name) == (5, 10, 21, 'xxhash64')
+    assert sketch_file.canonical and sketch_file.packed == packed
+    assert sketch_file.names() == names
+    assert sketch_file.name(2) == '大肠杆菌'
+    # register blocks start on a page boundary of the memory map and are read-only views of it
+    assert (sketch_file.blocks.ctypes.data - sketch_file.data.ctypes.data) % SketchFile.PAGE_SIZE == 0
+    assert not sketch_file.registers(0).flags.writeable
+    for hll, read in zip(sketches, sketch_file):
+        assert read.packed == packed and read.hash_name == 'xxhash64'
+        np.testing.assert_array_equal(read.getRegisters(), hll.getRegisters())
+
+    sketches_read, names_read = SketchFile.read_sketches(path)
+    assert names_read == names
+    np.testing.assert_array_equal(sketches_read[3].getRegisters(), sketches[3].getRegisters())
+
+
+def test_sparse_sketches_are_expanded(tmp_path):
+    path = str(tmp_path / 'sparse.sketch')
+    sketches = random_sketches(3)
+    sparse = [HLL(10, h.getRegisters(), sparse=True) for h in sketches]
+    assert sparse[0].sparse
+    SketchFile.write_sketches(path, sparse, ['a', 'b', 'c'])
+    sketch_file = SketchFile.SketchFile(path)
+    assert sketch_file.block_size == 2 ** 10
+    for hll, read in zip(sketches, sketch_file):
+        np.testing.assert_array_equal(read.getRegisters(), hll.getRegisters())
+
+
+def test_invalid_input(tmp_path):
+    path = str(tmp_path / 'invalid.sketch')
+    with pytest.raises(ValueError):
+        SketchFile.write_sketches(path, [], [])
+    with pytest.raises(ValueError):
+        SketchFile.write_sketches(path, random_sketches(2), ['a'])
+    with pytest.raises(ValueError):
+        SketchFile.write_sketches(path, random_sketches(1) + [HLL(10, hash_name='murmur3')], ['a', 'b'])
+    mixed = random_sketches(2)
+    mixed[1].pack()
+    with pytest.raises(ValueError):
+        SketchFile.write_sketches(path, mixed, ['a', 'b'])
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.sketch'
+    path.write_bytes(b'not a sketch file' * 10)
+    assert not SketchFile.is_sketch_file(str(path))
+    with pytest.raises(ValueError):
+        SketchFile.SketchFile(str(path))
@@ -0,0 +1,46 @@
+"""
+test_sketch_index.py: Checks SketchIndex candidate retrieval on related and unrelated sketches, and its handling of
+queries at another precision
+"""
+import numpy as np
+import pytest
+
+import Query
+import SketchIndex
+from HLL import HLL
+
+
+def sketch(*codes, p=12):
+    h = HLL(p)
+    for c in codes:
+        h.insert_codes(c)
+    return h
+
+
+@pytest.fixture(scope='module')
+def collection():
+    rng = np.random.default_rng(0)
+    codes = lambda n: rng.integers(0, 2**62, n, dtype=np.uint64)
+    query = codes(100000)
+    # 20 unrelated references, then 10 that share half of the query
+    related = [np.concatenate([query[rng.random(len(query)) < 0.5], codes(50000)]) for _ in range(10)]
+    sketches = [sketch(codes(int(n))) for n in rng.uniform(5e4, 2e5, 20)] + [sketch(c) for c in related]
+    references = Query.ReferenceIndex.from_sketches(sketches, ['sketch_{}'.format(i) for i in range(30)])
+    return SketchIndex.SketchIndex(references), query
+
+
+def test_candidates_are_the_related_references(collection):
+    index, query = collection
+    np.testing.assert_array_equal(index.candidates(sketch(query)), np.arange(20, 30))
+
+
+def test_higher_precision_query_is_folded(collection):
+    index, query = collection
+    np.testing.assert_array_equal(index.band_hits(sketch(query, p=14)), index.band_hits(sketch(query)))
+    assert index.query(sketch(query, p=14)) == index.query(sketch(query))
+
+
+def test_lower_precision_query_is_rejected(collection):
+    index, query = collection
+    with pytest.raises(ValueError, match='p = 10'):
+        index.band_hits(sketch(query, p=10))
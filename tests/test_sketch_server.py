@@ -0,0 +1,149 @@
+"""
+test_sketch_server.py: Starts SketchServer.py on localhost against references sketched with k = 21 and queries it
+"""
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+
+import Query
+import SketchCodec
+import SketchFile
+import Sketching
+from HLL import HLL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'Data', '0.5x')
+GENOMES = ['S aureus', 'S epidermidis', 'S pneumoniae']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(references, *options, jobs=1):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'SketchServer.py'), references, '--port', str(port),
+                                '--jobs', str(jobs)] + list(options),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=ROOT)
+    return process, port
+
+
+@pytest.fixture(scope='module')
+def references(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('references') / 'references.sketch')
+    sketches = [HLL(12, Sketching.sketch_file(os.path.join(DATA, name + '.fasta'), 21, 12)) for name in GENOMES]
+    SketchFile.write_sketches(path, sketches, GENOMES, k=21)
+    return path
+
+
+@pytest.fixture(scope='module')
+def server(references):
+    # two workers attach to the same shared index
+    process, port = start_server(references, jobs=2)
+    # the server prints its address once the references are loaded
+    line = process.stdout.readline()
+    assert line.startswith('Serving 3 references'), line + process.stderr.read()
+    yield 'http://127.0.0.1:{}'.format(port)
+    process.terminate()
+    process.wait(10)
+
+
+def request(url, data=None):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=60) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_status_reports_reference_kmers(server):
+    status, body = request(server + '/status')
+    info = json.loads(body)
+    assert status == 200
+    assert (info['references'], info['p'], info['k'], info['canonical']) == (3, 12, 21, False)
+
+
+def test_fasta_query_matches_itself(server):
+    with open(os.path.join(DATA, 'S aureus.fasta'), 'rb') as f:
+        status, body = request(server + '/query?n=3&measure=jaccard&name=sample', f.read())
+    assert status == 200
+    query, = json.loads(body)['queries']
+    assert query['name'] == 'sample'
+    best = query['matches'][0]
+    assert best['name'] == 'S aureus'
+    assert best['similarity'] == pytest.approx(1, abs=0.01)
+
+
+def test_sketch_then_query_stream(server):
+    with open(os.path.join(DATA, 'S pneumoniae.fasta'), 'rb') as f:
+        status, stream = request(server + '/sketch?name=sample', f.read())
+    assert status == 200
+    reader = SketchCodec.SketchReader(io.BytesIO(stream))
+    assert (reader.k, reader.canonical) == (21, False)
+    status, body = request(server + '/query?n=1', stream)
+    assert status == 200
+    assert json.loads(body)['queries'][0]['matches'][0]['name'] == 'S pneumoniae'
+
+
+def test_mismatched_kmers_are_rejected(server):
+    f = io.BytesIO()
+    with SketchCodec.SketchWriter(f, 12, 'wang64', k=25) as writer:
+        writer.write('sample', HLL(12, np.ones(4096, dtype=np.uint8)))
+    status, body = request(server + '/query', f.getvalue())
+    assert status == 400 and b'k = 25' in body
+
+    with open(os.path.join(DATA, 'S aureus.fasta'), 'rb') as f:
+        data = f.read()
+    assert request(server + '/query?k=25', data)[0] == 400
+    assert request(server + '/sketch?canonical=1', data)[0] == 400
+
+
+def test_invalid_content_length(server):
+    host, port = server[len('http://'):].split(':')
+    with socket.create_connection((host, int(port)), timeout=60) as s:
+        s.sendall(b'POST /query HTTP/1.1\r\nContent-Length: lots\r\n\r\n')
+        response = s.makefile('rb').read()
+    assert response.startswith(b'HTTP/1.1 400 ')
+    assert b'Invalid Content-Length' in response
+
+
+def test_conflicting_k_refuses_to_start(references):
+    process, _ = start_server(references, '-k', '25')
+    _, stderr = process.communicate(timeout=60)
+    assert process.returncode != 0
+    assert 'k = 21' in stderr
+
+
+def test_shared_index_matches_loaded_index(references):
+    index = Query.ReferenceIndex.from_path(references)
+    shm, state = index.share()
+    try:
+        shared = Query.ReferenceIndex.attach(state)
+        for name in ('registers', 'multiplicities', 'cardinalities'):
+            np.testing.assert_array_equal(getattr(shared, name), getattr(index, name))
+            assert not getattr(shared, name).flags.writeable
+        assert (shared.names, shared.p, shared.k) == (index.names, index.p, index.k)
+        query = HLL(12, index.registers[1])
+        assert shared.query(query, 3) == index.query(query, 3)
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_terminated_server_frees_shared_index(references):
+    process, _ = start_server(references)
+    assert process.stdout.readline().startswith('Serving')
+    process.terminate()
+    _, stderr = process.communicate(timeout=60)
+    assert process.returncode == 0
+    assert 'leaked' not in stderr